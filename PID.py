@@ -1,53 +1,98 @@
 import time
 
 class PIDController:
-    def __init__(self, kp, ki, kd, base_speed, setpoint=0):
+    def __init__(self, kp, ki, kd, base_speed, setpoint=0, integral_limit=None, derivative_tau=0, kh=0):
         # PID parameters
         self.kp = kp  # Proportional gain
         self.ki = ki  # Integral gain
         self.kd = kd  # Derivative gain
+        self.kh = kh  # Heading gain: steers on the direction of the line ahead before the offset builds up
         self.base_speed = base_speed
         self.setpoint = setpoint  # Desired target value
-        
+        self.integral_limit = integral_limit  # bound of the integral term (same unit as the output), None for none
+        self.derivative_tau = derivative_tau  # time constant of the derivative low-pass filter in seconds, 0 for none
+
         # State variables
         self.previous_error = 0
         self.integral = 0
+        self.derivative = 0  # filtered derivative
+        self.first_update = True
+        self.output = 0  # last control output, before the motor speeds are clamped
+
+    def reset(self):
+        """Forget the past errors, e.g. after a turn during which the controller was not used."""
+        self.previous_error = 0
+        self.integral = 0
+        self.derivative = 0
+        self.first_update = True
 
 
 
-    def update(self, dt, current_value):
+    def update(self, dt, current_value, heading=0.0):
         """
         Calculate the control output for adjusting motor speeds.
         
         :param base_speed: Base speed for the motors when the car is on the line.
         :param current_value: Current measured value (e.g., distance from the line).
         :param dt: Time difference between measurements (in seconds).
+        :param heading: Angle of the line ahead in radians (LineFollower.heading), positive when it bends left.
         :return: Tuple (left_motor_speed, right_motor_speed)
         """
         # Calculate the error between the setpoint and the current value
         error = self.setpoint - current_value
         
-        # Proportional term
-        p_term = self.kp * error
-        
-        # Integral term
-        self.integral += error * dt  # Sum of errors over time
-        i_term = self.ki * self.integral
-        
-        # Derivative term
-        derivative = (error - self.previous_error) / dt if dt > 0 else 0  # Change in error
-        d_term = self.kd * derivative
+        # Proportional term, and the heading as a leading term of the same sign as the error it announces
+        p_term = self.kp * error - self.kh * heading
         
+        # Derivative term, low-pass filtered: the error is a pixel position and jumps from frame to frame
+        if dt > 0 and not self.first_update:
+            raw_derivative = (error - self.previous_error) / dt  # Change in error
+            alpha = dt / (self.derivative_tau + dt)
+            self.derivative += alpha * (raw_derivative - self.derivative)
+        d_term = self.kd * self.derivative
+        self.first_update = False
+
         # Update the previous error for the next iteration
         self.previous_error = error
-        
+
+        # Integral term, with anti-windup: the error is not integrated while the motors are saturated by it.
+        # Only one motor clamped (e.g. base_speed 255) still steers: the other one keeps slowing down
+        integral = self.integral + error * dt  # Sum of errors over time
+        if self.integral_limit is not None and self.ki:
+            bound = self.integral_limit / abs(self.ki)
+            integral = max(-bound, min(bound, integral))
+        output = p_term + self.ki * integral + d_term
+        if not self._saturated(output) or abs(integral) < abs(self.integral):
+            self.integral = integral
+        i_term = self.ki * self.integral
+
         # Calculate the total control output
         output = p_term + i_term + d_term
-        
+        self.output = output
+
+        return self._motor_speeds(output)
+
+    def predict(self, elapsed):
+        """Measured value expected elapsed seconds after the last update, following the filtered derivative."""
+        return self.setpoint - (self.previous_error + self.derivative * elapsed)
+
+    def steer(self, current_value, heading=0.0):
+        """
+        Motor speeds for current_value (e.g. a predicted value) with the integral and the derivative of the last
+        update: neither is changed, so it can run any number of times between two measurements.
+        """
+        error = self.setpoint - current_value
+        output = self.kp * error - self.kh * heading + self.ki * self.integral + self.kd * self.derivative
+        self.output = output
+        return self._motor_speeds(output)
+
+    def _motor_speeds(self, output):
         # Calculate motor speeds with output adjustment
         left_motor_speed = int(max(0, min(255, self.base_speed + output)))
         right_motor_speed = int(max(0, min(255, self.base_speed - output)))
 
         return left_motor_speed, right_motor_speed
 
-
+    def _saturated(self, output):
+        """Both motor commands are clamped: a larger output would not steer harder."""
+        return self.base_speed + abs(output) >= 255 and self.base_speed - abs(output) <= 0
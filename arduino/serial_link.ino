@@ -8,7 +8,7 @@
 // fichier : serial_link.ino
 // auteur  : P.BENABES
 // Copyright (c) 2024 CENTRALE-SUPELEC
-// Revision: 1.0  Date: 20/08/2024
+// Revision: 2.0  Date: 20/08/2024
 //
 // //////////////////////////////////////////////////-
 //
@@ -42,8 +42,29 @@ bool obst=false ;           // obstacle détecté
 char c,CharIn,m;
 bool ConnOn ;          // indique si la carte est connectée
 int commode=0 ;        // indique le mode de communication 0=tout en ASCII, 1 les commandes sont en binaire et les retours en ascii, 2 tout est en binaire
+                       // 3 protocole v2 : commandes et retours en trames binaires (voir LES FONCTIONS DE TRAMES)
 char retstring[96] ;   // chaine de retour de commande
 
+// protocole v2 en trames
+// commande : 0xA5 LEN SEQ CMD arguments[LEN-2] CRC8(LEN..arguments)
+// réponse  : 0x5A SEQ STATUS LEN données[LEN] CRC8(SEQ..données)
+#define PROTOCOL_VERSION 2
+#define FRAME_SYNC 0xA5
+#define REPLY_SYNC 0x5A
+#define FRAME_MAX_LEN 16
+#define STATUS_OK 0
+#define STATUS_OBSTACLE 1
+#define STATUS_ERROR 2
+#define STATUS_BAD_CRC 3
+uint8_t frame_buf[FRAME_MAX_LEN] ;   // SEQ CMD arguments de la trame en cours de réception
+uint8_t frame_len ;                  // nombre d'octets attendus dans frame_buf
+uint8_t frame_cnt ;                  // nombre d'octets reçus dans frame_buf
+uint8_t frame_state=0 ;              // 0 attente synchro, 1 attente longueur, 2 réception, 3 attente CRC
+uint8_t frame_pos ;                  // position de lecture des arguments dans frame_buf
+uint8_t frame_status ;               // status renvoyé dans la réponse
+uint8_t reply_buf[FRAME_MAX_LEN] ;   // données de la réponse
+uint8_t reply_len ;
+
 // variables de la gestion des moteurs
 long int volatile CountIncr1,CountIncr2 =0 ;  // valeur des compteurs incrémentaux en 32 bits
 int nivM1,nivM2 ;         // tension appliquée au moteur
@@ -91,7 +112,10 @@ inline void Task5On()
 //
 /////////////////////////////////////////////////////////////////////////
 
-void dummy() {  Serial.println("ER"); }
+void dummy() {
+  if (commode==3) frame_status=STATUS_ERROR ;   // en protocole v2 l'erreur est dans le status de la réponse
+  else Serial.println("ER");
+}
 
 void init_arduino() {
 
@@ -148,7 +172,8 @@ void loop() {
   if (Serial.available() > 0) {
     // on lit le premier caractère qui arrive
     CharIn = Serial.read();
-    if (CharIn=='A') CONNECT_code();        // demande de connection
+    if (ConnOn && (commode==3)) FrameByte(CharIn);  // protocole v2, les commandes arrivent en trames
+    else if (CharIn=='A') CONNECT_code();        // demande de connection
     else if (ConnOn)     decod_serial(CharIn);  // on ne fait un decodage de commande que si on est connecté
   }
 
@@ -171,6 +196,9 @@ void loop() {
 // Routine de recuperation d'un caractere
 char GetChar(char def)
 {
+    if (commode==3)
+    { FrameGetBytes((uint8_t*)&def,1) ;  // def n'est remplacé que si la trame contient encore un octet
+      return(def) ; }
     if (Serial.available()>0)  // liaison série vide
       return(Serial.read());
     else
@@ -189,6 +217,11 @@ int GetInt(int def)
         return(Serial.parseInt()); // on recupere la commande du moteur
       else
         return(def) ; }  // renvoie la valeur par défaut
+    else if (commode==3) {
+      tmp=def ;
+      FrameGetBytes((uint8_t*)&tmp,2);
+      return(tmp) ;
+    }
     else {
       Serial.readBytes((char*)&tmp,2);
       return(tmp) ;
@@ -211,6 +244,11 @@ long int GetLong(long def)
       }
       else
         return(def) ; }  // renvoie la valeur par défaut
+    else if (commode==3) {
+      tmp=def ;
+      FrameGetBytes((uint8_t*)&tmp,4);
+      return(tmp) ;
+    }
     else {
       Serial.readBytes((char*)&tmp,4);
       return(tmp) ;
@@ -218,14 +256,95 @@ long int GetLong(long def)
 }
 
 // bibliothèque de renvoi de valeurs binaires sur la liaison série
+// en protocole v2 les valeurs sont ajoutées aux données de la réponse
 inline void write_i8(char num)
-{ Serial.write(num); }
+{ if (commode==3) ReplyAppend((uint8_t*)&num, 1); else Serial.write(num); }
 
 void write_i16(int num)
-{ Serial.write((uint8_t*)&num, 2); }
+{ if (commode==3) ReplyAppend((uint8_t*)&num, 2); else Serial.write((uint8_t*)&num, 2); }
 
 void write_i32(long num)
-{ Serial.write((uint8_t*)&num, 4); }
+{ if (commode==3) ReplyAppend((uint8_t*)&num, 4); else Serial.write((uint8_t*)&num, 4); }
+
+//////////////////////////////////////////////////////////////////////////
+//
+// LES FONCTIONS DE TRAMES (protocole v2)
+//
+//////////////////////////////////////////////////////////////////////////
+
+// CRC 8 bits, polynome 0x07
+uint8_t crc8(uint8_t crc, uint8_t data)
+{
+    crc ^= data ;
+    for (uint8_t i=0 ; i<8 ; i++)
+      crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : (crc << 1) ;
+    return(crc) ;
+}
+
+// lecture de n octets des arguments de la trame, renvoie false si la trame est trop courte
+bool FrameGetBytes(uint8_t *dst, uint8_t n)
+{
+    if (frame_pos+n > frame_len) return(false) ;
+    for (uint8_t i=0 ; i<n ; i++) dst[i]=frame_buf[frame_pos++] ;
+    return(true) ;
+}
+
+// ajout de données à la réponse de la trame en cours
+void ReplyAppend(uint8_t *src, uint8_t n)
+{
+    for (uint8_t i=0 ; (i<n) && (reply_len<FRAME_MAX_LEN) ; i++) reply_buf[reply_len++]=src[i] ;
+}
+
+// envoi de la réponse : 0x5A SEQ STATUS LEN données CRC
+void SendReply(uint8_t seq, uint8_t status)
+{
+    uint8_t crc=0 ;
+    uint8_t head[4]={REPLY_SYNC, seq, status, reply_len} ;
+    for (uint8_t i=1 ; i<4 ; i++) crc=crc8(crc,head[i]) ;
+    for (uint8_t i=0 ; i<reply_len ; i++) crc=crc8(crc,reply_buf[i]) ;
+    Serial.write(head,4) ;
+    Serial.write(reply_buf,reply_len) ;
+    Serial.write(crc) ;
+}
+
+// exécution d'une trame complète et valide
+void FrameExecute()
+{
+    uint8_t seq=frame_buf[0] ;
+    frame_pos=2 ;           // les arguments commencent après SEQ et CMD
+    reply_len=0 ;
+    frame_status=STATUS_OK ;
+    decod_serial((char)frame_buf[1]) ;
+    if ((frame_status==STATUS_OK) && obst) frame_status=STATUS_OBSTACLE ;
+    SendReply(seq,frame_status) ;
+}
+
+// automate de réception des trames, appelé pour chaque octet reçu
+// un octet de synchro, de longueur ou de CRC invalide fait repartir à la recherche de la synchro
+void FrameByte(uint8_t b)
+{
+    static uint8_t crc ;
+    switch (frame_state) {
+      case 0 :                    // attente de l'octet de synchro
+        if (b==FRAME_SYNC) frame_state=1 ;
+        break ;
+      case 1 :                    // longueur SEQ+CMD+arguments
+        if ((b<2) || (b>FRAME_MAX_LEN)) { frame_state=(b==FRAME_SYNC) ? 1 : 0 ; break ; }
+        frame_len=b ; frame_cnt=0 ; crc=crc8(0,b) ;
+        frame_state=2 ;
+        break ;
+      case 2 :                    // SEQ, CMD et arguments
+        frame_buf[frame_cnt++]=b ;
+        crc=crc8(crc,b) ;
+        if (frame_cnt==frame_len) frame_state=3 ;
+        break ;
+      case 3 :                    // CRC
+        frame_state=0 ;
+        if (b==crc) FrameExecute() ;
+        else { reply_len=0 ; SendReply(frame_buf[0],STATUS_BAD_CRC) ; }
+        break ;
+    }
+}
 
 /////////////////////////////////////////////////
 //  LES FONCTIONS MOTEUR
@@ -264,6 +383,7 @@ inline void RetAcquitSimpl()
 // code de connection de la carte
 void CONNECT_code() {
   delay(1); // indispensable et pas trop long sinon le caractère suivant n'est pas arrivé
+  commode=0 ;  // la demande de connection est toujours en ASCII, même après une session en protocole v2
   c=GetChar(0);
   feedback=c-'0' ;
   ConnOn = true ;
@@ -274,16 +394,19 @@ void CONNECT_code() {
   RetAcquitSimpl();
   if (feedback==2)
   {
-    sprintf(retstring,"OK Arduino connecte version 1.0 en mode %d",commode);
+    sprintf(retstring,"OK Arduino connecte version %d.0 en mode %d",PROTOCOL_VERSION,commode);
     Serial.println(retstring);
   }
+  if (commode==3)
+  { feedback=0 ;       // en protocole v2 chaque trame reçoit une réponse binaire, pas de texte
+    frame_state=0 ; }
 
 }
 
 // code de deconnection de la carte
 void DISCONNECT_code() {
   init_arduino();
-  Serial.println("OK Arduino deconnecte");
+  if (commode!=3) Serial.println("OK Arduino deconnecte");
   ConnOn = false ;
 }
 
@@ -320,6 +443,8 @@ void SINGLEMOTOR_code() {
       else
         Serial.println("OB stacle détecté moteur non allumé");
   }
+  else if (commode==3)
+    frame_status=STATUS_ERROR ;   // en protocole v2 l'erreur est dans le status de la réponse
   else
   { Serial.readString() ;
     Serial.println("Erreur commande incomplète");
@@ -445,7 +570,7 @@ void PROTECT_IR_code() {
 // renvoie la position de 2 encodeurs
 void  ENCODER_DUAL_code() {
   v1=CountIncr1; v2=CountIncr2 ;
-  if (commode==2)
+  if (commode>=2)
   {  write_i32(v1); write_i32(v2); }
   else
   {
@@ -465,7 +590,7 @@ void  ENCODERS_TIME_code() {
     v2=CountIncr2 ;
 
   v1=millis() ;
-  if (commode==2)
+  if (commode>=2)
   {  write_i32(v1); write_i32(v2); }
   else
   { Serial.print(v1);
@@ -475,7 +600,7 @@ void  ENCODERS_TIME_code() {
 
 // renvoie la vitesse des 2 moteurs
 void SPEED_DUAL_code() {
-  if (commode==2)
+  if (commode>=2)
   {  write_i16(vitesse1); write_i16(vitesse2); write_i16(0);  write_i16(0); }
   else
   { Serial.print(vitesse1);
@@ -486,7 +611,7 @@ void SPEED_DUAL_code() {
 // renvoie le temps courant et la valeur du capteur infrarouge
 void  INFRARED_TIME_code() {
   v1=millis() ;
-  if (commode==2)
+  if (commode>=2)
   {  write_i32(v1); write_i16(analogRead(IR_pin));  write_i16(0);   }
   else
   {
@@ -498,7 +623,7 @@ void  INFRARED_TIME_code() {
 // renvoie la valeur du capteur ultrasons
 void  ULTRASON_code() {
   a=UltrasonicDistance();
-  if (commode==2)
+  if (commode>=2)
     write_i16(a);
   else
     Serial.println(a);
@@ -506,7 +631,7 @@ void  ULTRASON_code() {
 
 // renvoie la tension sur le moteur
 void  VALMOTOR_code() {
-  if (commode==2)
+  if (commode>=2)
   { write_i16(nivM1);
     write_i16(nivM2);  write_i16(0);  write_i16(0);}
   else
@@ -0,0 +1,77 @@
+import math
+import time
+import numpy as np
+
+from croisement import pairwise_intersections
+
+
+def intersections_loop(lines, angle_threshold=20, distance_threshold=5):
+    """Reference: the pair loop detect_intersections used before it was vectorized."""
+    intersections = []
+
+    def calculate_angle(line1, line2):
+        x1, y1, x2, y2 = line1
+        x3, y3, x4, y4 = line2
+        angle1 = math.atan2(y2 - y1, x2 - x1)
+        angle2 = math.atan2(y4 - y3, x4 - x3)
+        angle = abs(math.degrees(angle1 - angle2))
+        return min(angle, 180 - angle)
+
+    def is_near_point(p1, p2, threshold):
+        return np.linalg.norm(np.array(p1) - np.array(p2)) < threshold
+
+    for i in range(len(lines)):
+        for j in range(i + 1, len(lines)):
+            line1 = lines[i][0]
+            line2 = lines[j][0]
+            x1, y1, x2, y2 = line1
+            x3, y3, x4, y4 = line2
+            if calculate_angle(line1, line2) < angle_threshold:
+                continue
+            A1 = y2 - y1
+            B1 = x1 - x2
+            C1 = x2 * y1 - x1 * y2
+            A2 = y4 - y3
+            B2 = x3 - x4
+            C2 = x4 * y3 - x3 * y4
+            denom = A1 * B2 - A2 * B1
+            if denom != 0:
+                intersection_point = (int((B1 * C2 - B2 * C1) / denom), int((A2 * C1 - A1 * C2) / denom))
+                if (is_near_point(intersection_point, (x1, y1), distance_threshold) or
+                    is_near_point(intersection_point, (x2, y2), distance_threshold) or
+                    is_near_point(intersection_point, (x3, y3), distance_threshold) or
+                    is_near_point(intersection_point, (x4, y4), distance_threshold)):
+                    continue
+                intersections.append(intersection_point)
+    return intersections
+
+
+def random_segments(n, rng, width=160, height=128):
+    """Segments shaped like the output of HoughLinesP on a 160x128 frame."""
+    x = rng.integers(0, width, size=(n, 1, 2))
+    y = rng.integers(0, height, size=(n, 1, 2))
+    return np.stack((x[..., 0], y[..., 0], x[..., 1], y[..., 1]), axis=-1).astype(np.int32)
+
+
+def best_of(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    print(f"{'segments':>8} {'loop (ms)':>10} {'numpy (ms)':>11} {'speedup':>8}")
+    for n in (5, 10, 20, 50, 100, 200):
+        lines = random_segments(n, rng)
+        expected = intersections_loop(lines)
+        got = [tuple(p) for p in pairwise_intersections(lines).tolist()]
+        assert got == expected, f"Mismatch for {n} segments"
+
+        repeat = 3 if n > 50 else 20
+        t_loop = best_of(lambda: intersections_loop(lines), repeat)
+        t_numpy = best_of(lambda: pairwise_intersections(lines), repeat)
+        print(f"{n:>8} {t_loop * 1e3:>10.2f} {t_numpy * 1e3:>11.3f} {t_loop / t_numpy:>7.1f}x")
@@ -3,37 +3,38 @@ import logging
 from car_lib import *
 import cv2
 import os
-from picamera import PiCamera
-from picamera.array import PiRGBArray
+from camera_stream import FrameGrabber, PiCameraSource
 from croisement import detect_intersections
 from time import perf_counter, sleep
 
 
 
 def initilize():
-    global camera, raw_capture, urkab
-    # Initialize the PiCamera
-    camera = PiCamera()
-    camera.resolution = (160, 128)
-    camera.framerate = 32
-    raw_capture = PiRGBArray(camera, size=camera.resolution)
-    sleep(0.1)  # Allow the camera to warm up
+    global grabber, urkab
+    # Start capturing frames from the PiCamera on a separate thread
+    grabber = FrameGrabber(PiCameraSource(resolution=(160, 128), framerate=32)).start()
 
     urkab = Urkab()
     urkab.carResetEmergencyStop()
 
 
 def calibrate_turning():
-    global camera, raw_capture, urkab
+    global grabber, urkab
     # Initialize variables tracking
     previous_intersection = False
     frames_without_intersection = 0  # Counter for consecutive frames without intersection
 
+    urkab.resetENC()
     urkab.carTurnRight(250,250)
     start_time = perf_counter()
     lost_intersection = False
-    for frame in camera.capture_continuous(raw_capture, format="bgr", use_video_port=True):
-        image = frame.array  # Get the current frame as an array
+    while True:
+        frame = grabber.read()
+        if frame is None:
+            if not grabber.running:
+                break
+            continue
+        _, _, image = frame  # Get the newest frame as an array
 
         # Check for intersection
         intersection_detected = detect_intersections(image)
@@ -57,37 +58,37 @@ def calibrate_turning():
                 lost_intersection = True
 
             cv2.imshow("Camera feed", image)
-        raw_capture.truncate(0)
 
     end_time = perf_counter()
     urkab.carStop()
-    return end_time - start_time
+    enc1, enc2 = urkab.recupCmdl(b'N')
+    ticks = (abs(enc1) + abs(enc2)) / 2  # mean ticks of the two wheels
+    return end_time - start_time, ticks
 
 def main():
-    global camera, raw_capture, urkab
+    global grabber, urkab
     try:
         print("HighFive Calibration system: Place Urkab in front of an intersection")
         input("Press enter to start calibration")
         initilize()
-        time_to_turn = calibrate_turning()
-        print(f"Time to turn: {time_to_turn}")
+        time_to_turn, ticks_to_turn = calibrate_turning()
+        print(f"Time to turn: {time_to_turn}, encoder ticks: {ticks_to_turn}")
     except KeyboardInterrupt:
         urkab.carStop()
-        camera.close()
+        grabber.stop()
         print("Calibration stopped by user")
         exit()
     finally:
         # Release resources and stop the car
         try:
             time_to_turn = time_to_turn * (360/380)
+            ticks_to_turn = ticks_to_turn * (360/380)
 
-            variable_name = "TIME_TO_TURN"
-            variable_value = str(time_to_turn)
             env_file_path = "./turning_const.env"
             with open(env_file_path, "a") as env_file:
-                env_file.write(f"{variable_name}={variable_value}\n")
-
-            logging.debug(f"Added {variable_name} to {env_file_path}.")
+                for variable_name, variable_value in (("TIME_TO_TURN", time_to_turn), ("TICKS_PER_TURN", ticks_to_turn)):
+                    env_file.write(f"{variable_name}={variable_value}\n")
+                    logging.debug(f"Added {variable_name} to {env_file_path}.")
 
             cv2.destroyAllWindows()
             urkab.carStop()
@@ -0,0 +1,194 @@
+import logging
+import threading
+import time
+import cv2
+import numpy as np
+
+try:
+    from picamera import PiCamera
+    from picamera.array import PiRGBArray
+except ImportError:  # not running on the Pi
+    PiCamera = None
+    PiRGBArray = None
+
+
+def yuv_shape(resolution):
+    """Shape of an I420 frame of the camera: the camera pads the width to 32 and the height to 16."""
+    width, height = (resolution[0] + 31) // 32 * 32, (resolution[1] + 15) // 16 * 16
+    return height * 3 // 2, width
+
+
+class YUVFrame:
+    """
+    I420 frame (luma plane, then the quarter size U and V planes) as captured in "yuv" format.
+    y is a view of the luma plane, without copy; the colour is only converted to BGR when bgr() is called,
+    once per frame, into dst if given.
+    """
+    def __init__(self, buffer, resolution, dst=None):
+        width, height = resolution
+        self.buffer = buffer
+        self.resolution = resolution
+        self.y = buffer[:height, :width]
+        self._dst = dst
+        self._bgr = None
+
+    def bgr(self):
+        if self._bgr is None:
+            width, height = self.resolution
+            if self.buffer.shape[1] == width and self.buffer.shape[0] * 2 // 3 == height:
+                self._bgr = cv2.cvtColor(self.buffer, cv2.COLOR_YUV2BGR_I420, dst=self._dst)
+            else:
+                self._bgr = cv2.cvtColor(self.buffer, cv2.COLOR_YUV2BGR_I420)[:height, :width]
+        return self._bgr
+
+
+class _ArrayOutput:
+    """picamera output writing each frame into a preallocated array instead of a growing stream."""
+    def __init__(self, shape):
+        self.array = np.empty(shape, np.uint8)
+        self._flat = self.array.reshape(-1)
+        self._offset = 0
+
+    def write(self, data):
+        size = min(len(data), len(self._flat) - self._offset)
+        self._flat[self._offset:self._offset + size] = np.frombuffer(data, np.uint8, size)
+        self._offset += size
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        self._offset = offset
+
+    def truncate(self, size=None):
+        if size is not None:
+            self._offset = size
+
+    def flush(self):
+        pass
+
+
+class PiCameraSource:
+    """
+    Frame source reading frames from the Pi camera video port.
+    format "bgr": BGR frames of shape (height, width, 3).
+    format "yuv": raw I420 frames (see YUVFrame), without the colour conversion of the camera.
+    """
+    def __init__(self, resolution=(160, 128), framerate=32, format="bgr"):
+        self.resolution = resolution
+        self.framerate = framerate
+        self.format = format
+        self.frame_shape = yuv_shape(resolution) if format == "yuv" else (resolution[1], resolution[0], 3)
+        self.camera = None
+
+    def open(self):
+        if PiCamera is None:
+            raise RuntimeError("picamera is not available on this machine")
+        self.camera = PiCamera()
+        self.camera.resolution = self.resolution
+        self.camera.framerate = self.framerate
+        if self.format == "yuv":
+            self.raw_capture = _ArrayOutput(self.frame_shape)
+        else:
+            self.raw_capture = PiRGBArray(self.camera, size=self.resolution)
+        time.sleep(0.1)  # Allow the camera to warm up
+
+    def frames(self):
+        """Yield the frames as arrays, each one is only valid until the next one is requested."""
+        for frame in self.camera.capture_continuous(self.raw_capture, format=self.format, use_video_port=True):
+            yield frame.array
+            # Clear the stream for the next frame
+            self.raw_capture.truncate(0)
+
+    def close(self):
+        if self.camera is not None:
+            self.camera.close()
+            self.camera = None
+
+
+class FrameGrabber:
+    """
+    Captures frames on its own thread into a small ring of preallocated buffers.
+    read() always returns the newest frame, the frames nobody read in time are dropped and counted.
+    """
+    def __init__(self, source, ring_size=3):
+        if ring_size < 3:
+            raise ValueError("The ring needs at least 3 buffers: one being written, the latest and the one being read")
+        self.source = source
+        self.format = getattr(source, "format", "bgr")
+        self.ring = [np.empty(source.frame_shape, np.uint8) for _ in range(ring_size)]
+        self.timestamps = [0.0] * ring_size
+
+        self.captured = 0   # frames written into the ring
+        self.dropped = 0    # frames overwritten before being read
+
+        self._cond = threading.Condition()
+        self._latest = None     # slot of the newest frame
+        self._held = None       # slot handed to the consumer by the last read()
+        self._read_seq = 0      # sequence number of the last frame read
+        self._running = False
+        self._error = None
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        self.source.open()
+        self._running = True
+        self._thread = threading.Thread(target=self._capture_loop, name="FrameGrabber", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+        logging.info(f"Frame grabber stopped: {self.captured} frames captured, {self.dropped} dropped")
+
+    def _next_slot(self):
+        for slot in range(len(self.ring)):
+            if slot != self._latest and slot != self._held:
+                return slot
+
+    def _capture_loop(self):
+        try:
+            for array in self.source.frames():
+                timestamp = time.perf_counter()
+                if not self._running:
+                    break
+                with self._cond:
+                    slot = self._next_slot()
+                # The slot is neither the latest nor the one being read, nobody else touches it
+                np.copyto(self.ring[slot], array)
+                self.timestamps[slot] = timestamp
+                with self._cond:
+                    if self.captured > self._read_seq:
+                        self.dropped += 1  # the previous latest frame was never read
+                    self.captured += 1
+                    self._latest = slot
+                    self._cond.notify_all()
+        except Exception as e:
+            logging.error(f"Frame capture failed: {e}")
+            self._error = e
+        finally:
+            self._running = False
+            self.source.close()
+            with self._cond:
+                self._cond.notify_all()
+
+    def read(self, timeout=1.0):
+        """
+        Wait for a frame newer than the last one read.
+        Returns (seq, timestamp, frame) or None on timeout; the frame stays valid until the next read().
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.captured > self._read_seq or not self._running, timeout):
+                return None
+            if self.captured <= self._read_seq:
+                if self._error is not None:
+                    raise self._error
+                return None
+            self._held = self._latest
+            self._read_seq = self.captured
+            return self._read_seq, self.timestamps[self._held], self.ring[self._held]
@@ -3,8 +3,12 @@ import time
 import struct
 import logging
 import os
+import re
 
 from dotenv import load_dotenv
+from serial_link import AsyncSerialLink, FrameReader, encode_frame, MOTORS_KEY, PROTOCOL_VERSION, \
+    STATUS_OK, STATUS_OBSTACLE
+from instrumentation import NULL_TIMER
 
 try:
     env_file_path = "./turning_const.env"
@@ -13,10 +17,72 @@ try:
     # Access the variable
     TURNING_CONST = float(os.getenv("TIME_TO_TURN"))
     logging.debug(f"The value of TIME_TO_TURN is: {TURNING_CONST}")
-except ValueError:
+except (TypeError, ValueError):  # no turning_const.env yet, e.g. when replaying off the car
     TURNING_CONST = 2.8
     logging.debug(f"Value Error; using TURNING_CONST: {TURNING_CONST}")
 
+try:
+    # Mean encoder ticks of the two wheels for a full turn on the spot, written by calibrate_system.py
+    TICKS_PER_TURN = float(os.getenv("TICKS_PER_TURN"))
+    logging.debug(f"The value of TICKS_PER_TURN is: {TICKS_PER_TURN}")
+except (TypeError, ValueError):
+    TICKS_PER_TURN = None
+    logging.debug("No TICKS_PER_TURN; turns are timed with TURNING_CONST")
+
+
+class Turn:
+    """
+    Turn on the spot in progress, advanced by poll() from the control loop instead of sleeping.
+    The turn ends when the wheels moved TICKS_PER_TURN * angle/360 encoder ticks, or after the time given by
+    TURNING_CONST when the encoders are not calibrated. With stop_on_line, it also ends once the line is seen
+    again after min_fraction of the angle. A turn lasting twice its expected time is ended anyway.
+    """
+    def __init__(self, urkab, command, angle, stop_on_line=False, min_fraction=0.6):
+        self.urkab = urkab
+        self.command = command
+        self.angle = angle
+        self.stop_on_line = stop_on_line
+        self.min_fraction = min_fraction
+        self.done = False
+        self.ticks = 0
+        self.target_ticks = TICKS_PER_TURN * angle / 360 if TICKS_PER_TURN else None
+        self.expected_time = TURNING_CONST * angle / 360
+
+        if self.target_ticks is not None:
+            urkab.resetENC()
+        if command == "left":
+            urkab.carTurnLeft(250, 250)
+        else:
+            urkab.carTurnRight(250, 250)
+        self.start_time = time.perf_counter()
+
+    def progress(self):
+        """Fraction of the angle already turned."""
+        if self.target_ticks is not None:
+            return self.ticks / self.target_ticks
+        return (time.perf_counter() - self.start_time) / self.expected_time
+
+    def poll(self, line_visible=False):
+        """Update the turn, returns True once it is over."""
+        if self.done:
+            return True
+        if self.target_ticks is not None:
+            enc1, enc2 = self.urkab.recupCmdl(b'N')
+            self.ticks = (abs(enc1) + abs(enc2)) / 2
+
+        progress = self.progress()
+        elapsed = time.perf_counter() - self.start_time
+        if progress >= 1:
+            logging.debug(f"Turn {self.command} done in {elapsed:.2f}s, {self.ticks} ticks")
+            self.done = True
+        elif self.stop_on_line and line_visible and progress >= self.min_fraction:
+            logging.debug(f"Line found again after {progress:.0%} of the turn {self.command}")
+            self.done = True
+        elif elapsed > 2 * self.expected_time:
+            logging.warning(f"Turn {self.command} timed out after {elapsed:.2f}s, {self.ticks} ticks")
+            self.done = True
+        return self.done
+
 class Urkab():
 
     class ObstacleException(Exception):
@@ -25,8 +91,21 @@ class Urkab():
     class ObstacleOnWayException(Exception):
         logging.warning("Obstacle detected on the way I'm going!")
 
-    def __init__(self):
-        self.arduino = serial.Serial(port='/dev/ttyACM0', baudrate=115200, timeout=0.1)
+    def __init__(self, port='/dev/ttyACM0', async_link=False, protocol=PROTOCOL_VERSION):
+        """
+        async_link: send the commands through an AsyncSerialLink, they then return without waiting for the
+        acknowledgement and obstacles are reported through pollObstacle() instead of exceptions.
+        protocol: 2 asks the Arduino for the framed binary protocol, falling back to the text acknowledgements
+        of version 1 if its firmware does not support it.
+        """
+        self.link = None
+        self.framed = False
+        self.seq = 0
+        self.frame_reader = FrameReader()
+        self.timer = NULL_TIMER
+        self.origin = None  # perf_counter time of the camera frame the commands sent now answer
+        self.last_rtt = 0.0
+        self.arduino = serial.Serial(port=port, baudrate=115200, timeout=0.1)
 
         rep = ' '  # serial connection validation
         while rep != b'':
@@ -35,12 +114,26 @@ class Urkab():
 
         time.sleep(2)
 
-        self.arduino.write(b'A22')
-        rep = self.arduino.readline()
-        if rep.split()[0] == b'OK':
-            logging.info("Arduino connected")
+        if protocol >= 2:
+            # Answer is "OK Arduino connecte version <firmware version>.0 en mode <mode>"
+            self.arduino.write(b'A23')
+            match = re.search(rb'version (\d+)\.\d+ en mode (\d+)', self.arduino.readline())
+            self.framed = match is not None and int(match.group(1)) >= 2 and match.group(2) == b'3'
+            if not self.framed:
+                logging.info("Arduino firmware does not support protocol v2, using text acknowledgements")
+
+        if self.framed:
+            logging.info("Arduino connected, using protocol v2")
         else:
-            logging.critical("Arduino connection not returning ok")
+            self.arduino.write(b'A22')
+            rep = self.arduino.readline()
+            if rep.split()[0] == b'OK':
+                logging.info("Arduino connected")
+            else:
+                logging.critical("Arduino connection not returning ok")
+
+        if async_link:
+            self.link = AsyncSerialLink(self.arduino, framed=self.framed).start()
 
     def read_i16(self, f):
         return struct.unpack('<h', bytearray(f.read(2)))[0]
@@ -58,38 +151,85 @@ class Urkab():
         f.write(struct.pack('<l', value))
 
 
+    def setTimer(self, timer):
+        """Time the serial round trips ("serial_ack") and the camera frame to acknowledgement latency."""
+        self.timer = timer
+        if self.link is not None:
+            self.link.timer = timer
+
+    def serialRtt(self):
+        """Round trip of the last command acknowledged by the Arduino, in seconds."""
+        return self.link.last_rtt if self.link is not None else self.last_rtt
+
+    def sendCmd(self, payload, key=None):
+        """Send a whole command in one write and wait for its acknowledgement, or queue it on the async link."""
+        if self.link is not None:
+            return self.link.send(payload, key, origin=self.origin)
+        sent_at = time.perf_counter()
+        if self.framed:
+            reply = self.framedRequest(payload)
+        else:
+            self.arduino.write(payload)
+            reply = self.AttAcquit()
+        acked_at = time.perf_counter()
+        self.last_rtt = acked_at - sent_at
+        self.timer.record("serial_ack", self.last_rtt)
+        if self.origin is not None:
+            self.timer.record("camera_to_ack", acked_at - self.origin)
+        return reply
+
+
+    def framedRequest(self, payload, timeout=0.5):
+        """Send a command in a v2 frame and wait for its reply, returns the data of the reply."""
+        seq = self.seq
+        self.seq = (self.seq + 1) & 0xFF
+        self.arduino.write(encode_frame(seq, payload))
+
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            for reply_seq, status, data in self.frame_reader.feed(self.arduino.read(max(1, self.arduino.in_waiting))):
+                if reply_seq != seq:
+                    logging.debug(f"Skipping reply to command seq {reply_seq}")
+                    continue
+                if status == STATUS_OBSTACLE:
+                    raise self.ObstacleException(f"Obstacle detected while executing {payload[:1]}")
+                if status != STATUS_OK:
+                    raise IOError(f"Arduino rejected {payload[:1]}: status {status}")
+                return data
+        raise TimeoutError(f"No reply from the Arduino to {payload[:1]}")
+
+
     def envoiCmdi(self, cmd, arg1, arg2, arg3, arg4):
-        self.arduino.write(cmd)
-        self.write_i16(self.arduino, arg1)
-        self.write_i16(self.arduino, arg2)
-        self.write_i16(self.arduino, arg3)
-        self.write_i16(self.arduino, arg4)
-        self.AttAcquit()
+        key = MOTORS_KEY if cmd in (b'C', b'D') else None
+        self.sendCmd(cmd + struct.pack('<4h', arg1, arg2, arg3, arg4), key)
 
 
     def envoiCmdl(self, cmd, arg1, arg2):
-        self.arduino.write(cmd)
-        self.write_i32(self.arduino, arg1)
-        self.write_i32(self.arduino, arg2)
-        self.AttAcquit()
+        self.sendCmd(cmd + struct.pack('<2l', arg1, arg2))
 
 
     def recupCmdi(self, cmd):
+        if self.link is not None:
+            return struct.unpack('<4h', self.link.query(cmd, 8))
+        if self.framed:
+            return struct.unpack('<4h', self.framedRequest(cmd))
         self.arduino.write(cmd)
         val1 = self.read_i16(self.arduino)
         val2 = self.read_i16(self.arduino)
         val3 = self.read_i16(self.arduino)
         val4 = self.read_i16(self.arduino)
         return val1, val2, val3, val4
-        AttAcquit()
 
 
     def recupCmdl(self, cmd):
+        if self.link is not None:
+            return struct.unpack('<2l', self.link.query(cmd, 8))
+        if self.framed:
+            return struct.unpack('<2l', self.framedRequest(cmd))
         self.arduino.write(cmd)
         val1 = self.read_i32(self.arduino)
         val2 = self.read_i32(self.arduino)
         return val1, val2
-        AttAcquit()
 
 
     def AttAcquit(self, intresp=False):
@@ -100,7 +240,7 @@ class Urkab():
 
         if rep.startswith(b"OB"):  # Check for obstacle-related messages
             error_message = rep.decode().strip()  # Decode the response and strip whitespace
-            raise ObstacleException(f"Obstacle detected: {error_message}")
+            raise self.ObstacleException(f"Obstacle detected: {error_message}")
 
         if not intresp:
             decoded = rep.decode()
@@ -146,16 +286,28 @@ class Urkab():
         self.envoiCmdi(b'C', -v1, v2, 0, 0)
 
     def carDeactivateEmergencyStop(self):
-        self.arduino.write(b'I0')
-        self.AttAcquit()
+        if self.link is not None:
+            self.link.forget(MOTORS_KEY)  # the motors may have been cut by the obstacle detection
+        self.sendCmd(b'I0')
 
     def carResetEmergencyStop(self):
-        self.arduino.write(b'I1')
-        self.AttAcquit()
-
-
-    def executeDirection(self, command, angle=90):
-        """Map direction commands to motor actions, checking for obstacles on the opposite side before turning."""
+        if self.link is not None:
+            self.link.forget(MOTORS_KEY)  # the motors may have been cut by the obstacle detection
+        self.sendCmd(b'I1')
+
+    def pollObstacle(self):
+        """Message of the oldest obstacle reported by the async link and not polled yet, None if there is none."""
+        if self.link is None or self.link.obstacles.empty():
+            return None
+        return self.link.obstacles.get_nowait()[1]
+
+
+    def executeDirection(self, command, angle=90, blocking=True, stop_on_line=False):
+        """
+        Map direction commands to motor actions, checking for obstacles on the opposite side before turning.
+        With blocking=False, turns return immediately a Turn that the caller polls until it is done,
+        other commands return None.
+        """
         logging.info(f"Executing direction: {command}; angle: {angle}")
 
         # Check for obstacles on the opposite side before executing a turn
@@ -168,18 +320,14 @@ class Urkab():
             
         if command == "straight":
             self.carAdvance(250, 250)  # Move forward
-        elif command == "left":
-            self.carTurnLeft(250, 250)  # Turn left
-            waiting_time = TURNING_CONST * (angle/360)
-            time.sleep(waiting_time)
-        elif command == "right":
-            self.carTurnRight(250, 250)  # Turn right
-            waiting_time = TURNING_CONST * (angle/360)
-            time.sleep(waiting_time)
-        elif command == "do_a_flip":
-            self.carTurnRight(250, 250)
-            waiting_time = TURNING_CONST * (180/360)
-            time.sleep(waiting_time)
+        elif command in ("left", "right", "do_a_flip"):
+            if command == "do_a_flip":
+                angle = 180
+            turn = Turn(self, command, angle, stop_on_line)
+            if not blocking:
+                return turn
+            while not turn.poll():
+                time.sleep(0.005)
         else:
             self.carStop()  # Stop if no command
 
@@ -192,6 +340,10 @@ class Urkab():
         return False
 
     def getUltrasonicDist(self):
+        if self.link is not None:
+            return struct.unpack('<h', self.link.query(b's', 2))[0]
+        if self.framed:
+            return struct.unpack('<h', self.framedRequest(b's'))[0]
         self.arduino.write(b's')
         resp = self.AttAcquit(intresp=True)
         return int(resp)
@@ -200,7 +352,13 @@ class Urkab():
         self.envoiCmdi(b'G', angle, 0, 0, 0)
 
     def carDisconnect(self):
-        self.arduino.write(b'a')  # deconnection de la carte
+        if self.link is not None:
+            self.link.stop()
+            self.link = None
+        if self.framed:
+            self.arduino.write(encode_frame(self.seq, b'a'))  # deconnection de la carte
+        else:
+            self.arduino.write(b'a')  # deconnection de la carte
         self.arduino.close()  # fermeture de la liaison série
         logging.info("Arduino disconnected")
 
@@ -0,0 +1,156 @@
+import argparse
+import glob
+import logging
+import os
+
+import cv2
+import numpy as np
+
+LUT_BITS = 5  # bits kept per channel: 32x32x32 colour cells
+LINE_THRESHOLD = 168  # the fixed recipe of the line follower, used for the cells the samples do not cover
+
+
+class ColorLUT:
+    """
+    White line classifier as a table over quantized BGR colours: one lookup per pixel gives the mask (255 on the
+    line), whatever the recipe the table was built from. Built from labelled frames by calibrate(), saved and
+    loaded as .npz so a change of lighting only needs a new calibration.
+    """
+    def __init__(self, table, bits=LUT_BITS):
+        self.bits = bits
+        self.table = np.ascontiguousarray(table, np.uint8).reshape(-1)
+        if len(self.table) != 1 << (3 * bits):
+            raise ValueError(f"A {bits} bits table has {1 << (3 * bits)} cells, not {len(self.table)}")
+        # Code of each channel value in the table index, for cv2.LUT: b << 2 * bits | g << bits | r
+        values = np.arange(256, dtype=np.uint16) >> (8 - bits)
+        self._codes = np.stack([values << (2 * bits), values << bits, values], axis=1).reshape(1, 256, 3)
+        self._shape = None
+
+    @classmethod
+    def threshold(cls, line_threshold=LINE_THRESHOLD, bits=LUT_BITS):
+        """Table equivalent to the fixed recipe: all three channels at least line_threshold."""
+        centres = (np.arange(1 << bits) << (8 - bits)) + (1 << (8 - bits)) // 2
+        white = centres >= line_threshold
+        table = white[:, None, None] & white[None, :, None] & white[None, None, :]
+        return cls(table.astype(np.uint8) * 255, bits)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        logging.info(f"Color table loaded from {path}")
+        return cls(data["table"], int(data["bits"]))
+
+    def save(self, path):
+        np.savez_compressed(path, table=self.table, bits=self.bits)
+
+    def index(self, frame):
+        """Table index of every pixel of a BGR frame."""
+        if frame.shape != self._shape:
+            h, w = frame.shape[:2]
+            self._channel_codes = np.empty((h, w, 3), np.uint16)
+            self._index = np.empty((h, w), np.uint16)
+            self._mask = np.empty((h, w), np.uint8)
+            self._shape = frame.shape
+        cv2.LUT(frame, self._codes, dst=self._channel_codes)
+        np.bitwise_or(self._channel_codes[..., 0], self._channel_codes[..., 1], out=self._index)
+        np.bitwise_or(self._index, self._channel_codes[..., 2], out=self._index)
+        return self._index
+
+    def classify(self, frame):
+        """Line mask of a BGR frame, written into a buffer reused from frame to frame."""
+        return np.take(self.table, self.index(frame), out=self._mask)
+
+
+def calibrate(samples, bits=LUT_BITS, min_samples=4, line_threshold=LINE_THRESHOLD):
+    """
+    Build a ColorLUT from (frame, mask) pairs, the mask being non zero on the line.
+    Each cell takes the majority label of the pixels falling in it, the counts being first spread to the
+    neighbouring cells so that colours close to the samples are classified too; cells with fewer than
+    min_samples pixels after that keep the fixed threshold recipe.
+    """
+    cells = 1 << (3 * bits)
+    line = np.zeros(cells, np.float64)
+    background = np.zeros(cells, np.float64)
+    lut = ColorLUT.threshold(line_threshold, bits)
+    for frame, mask in samples:
+        index = lut.index(frame).reshape(-1)
+        on_line = mask.reshape(-1) > 0
+        line += np.bincount(index[on_line], minlength=cells)
+        background += np.bincount(index[~on_line], minlength=cells)
+
+    side = 1 << bits
+    line, background = _spread(line.reshape(side, side, side)), _spread(background.reshape(side, side, side))
+    line, background = line.reshape(-1), background.reshape(-1)
+    # Both classes weigh the same whatever their number of pixels: the line is a small part of a frame
+    line_weight = line / max(line.sum(), 1.0)
+    background_weight = background / max(background.sum(), 1.0)
+    known = line + background >= min_samples
+    table = lut.table.copy()
+    table[known] = np.where(line_weight[known] > background_weight[known], 255, 0)
+    logging.info(f"Color table: {known.mean() * 100:.1f}% of the cells calibrated, "
+                 f"{(table == 255).mean() * 100:.1f}% classified as line")
+    return ColorLUT(table, bits)
+
+
+def _spread(counts, passes=2):
+    """Add to each cell half the counts of its six neighbours, passes times."""
+    for _ in range(passes):
+        padded = np.pad(counts, 1)
+        neighbours = (padded[:-2, 1:-1, 1:-1] + padded[2:, 1:-1, 1:-1] + padded[1:-1, :-2, 1:-1]
+                      + padded[1:-1, 2:, 1:-1] + padded[1:-1, 1:-1, :-2] + padded[1:-1, 1:-1, 2:])
+        counts = counts + neighbours / 2
+    return counts
+
+
+def load_samples(paths, size=None, line_threshold=LINE_THRESHOLD):
+    """
+    (frame, mask) pairs of the images; the mask of image.jpg is read from image.mask.png (white on the line)
+    when there is one, otherwise it is labelled with the fixed threshold recipe.
+    """
+    recipe = ColorLUT.threshold(line_threshold)
+    for path in paths:
+        frame = cv2.imread(path, cv2.IMREAD_COLOR)
+        if frame is None:
+            logging.warning(f"Skipping {path}, not an image")
+            continue
+        mask_path = os.path.splitext(path)[0] + ".mask.png"
+        if os.path.exists(mask_path):
+            mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+        else:
+            logging.info(f"No {mask_path}, labelling {path} with the threshold at {line_threshold}")
+            mask = recipe.classify(cv2.blur(frame, (5, 5))).copy()
+        if size is not None:
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+            mask = cv2.resize(mask, size, interpolation=cv2.INTER_NEAREST)
+        yield frame, mask
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the color table of the line mask from labelled frames")
+    parser.add_argument("images", nargs="+", help="Sample frames or folders of frames; the mask of image.jpg "
+                                                  "is image.mask.png")
+    parser.add_argument("--output", default="line_lut.npz", help="Table file to write")
+    parser.add_argument("--bits", type=int, default=LUT_BITS, help="Bits per channel of the table")
+    parser.add_argument("--threshold", type=int, default=LINE_THRESHOLD,
+                        help="Threshold labelling the frames without a mask and the cells without samples")
+    parser.add_argument("--size", type=int, nargs=2, metavar=("W", "H"), default=None,
+                        help="Resize the frames first, e.g. 160 128 as on the car")
+    parser.add_argument("--preview", action="store_true", help="Show the mask of each frame with the new table")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+
+    paths = []
+    for entry in args.images:
+        files = sorted(glob.glob(os.path.join(entry, "*"))) if os.path.isdir(entry) else [entry]
+        paths += [f for f in files if not f.endswith(".mask.png")]
+    samples = list(load_samples(paths, tuple(args.size) if args.size else None, args.threshold))
+    lut = calibrate(samples, args.bits, line_threshold=args.threshold)
+    lut.save(args.output)
+    print(f"Color table of {len(samples)} frames written to {args.output}")
+
+    if args.preview:
+        for frame, _ in samples:
+            cv2.imshow("Line mask", np.hstack([frame, cv2.cvtColor(lut.classify(frame), cv2.COLOR_GRAY2BGR)]))
+            if cv2.waitKey(0) & 0xFF == ord('q'):
+                break
+        cv2.destroyAllWindows()
@@ -1,29 +1,261 @@
-import zmq
+import json
+import logging
+import os
+import queue
+import threading
 import time
+from collections import deque
+
+import zmq
 
 # Server IP configuration
 server_ip = "192.168.137.1"
-command_port = 5005  # Port used to communicate with the server
+command_port = 5005  # Port of the server's ROUTER socket: hello, heartbeats and acknowledgements from the robots
+event_port = 5006  # Port of the server's PUB socket: commands and heartbeats to the robots
+
+HEARTBEAT_INTERVAL = 1.0  # seconds between two heartbeats, each way
+LINK_TIMEOUT = 3.0  # the link is considered down after this long without any message from the other side
+RESEND_INTERVAL = 0.5  # the server publishes an unacknowledged command again after this long
+
+# Wire format: multipart [topic, JSON object], the topic being the robot name (or b"*" for every robot) on the
+# PUB socket. Messages have a "type":
+#   command   server -> robot  {"type": "command", "session": s, "id": n, "cmd": "e 3 4"}, ids count from 1
+#             in each session (run of the server)
+#   ack       robot -> server  {"type": "ack", "id": n}
+#   heartbeat both ways        {"type": "heartbeat", "time": t}
+#   hello     robot -> server  {"type": "hello"}, sent on every (re)connection
+#   status    robot -> server  {"type": "status", ...}
+ALL_ROBOTS = "*"
+
+
+def encode(message):
+    return json.dumps(message, separators=(",", ":")).encode()
+
+
+def decode(data):
+    return json.loads(data)
+
+
+class CommandClient:
+    """
+    Event-driven connection of the robot to the command server: commands published by the server arrive on a SUB
+    socket and are acknowledged on a DEALER socket, both served by a background thread.
+    Received commands are put on a queue read with get() or poll(); "stop" also sets stop_requested right away
+    so that a running itinerary can be interrupted. Commands published again by the server are only delivered
+    once.
+    Heartbeats flow both ways: after LINK_TIMEOUT without news from the server the sockets are closed and
+    opened again. Messages sent to the server while the link is down are queued and sent on reconnection.
+    """
+    def __init__(self, ip=server_ip, robot="robot", port=command_port, events=event_port,
+                 heartbeat=HEARTBEAT_INTERVAL, timeout=LINK_TIMEOUT):
+        self.robot = robot
+        self.command_address = f"tcp://{ip}:{port}"
+        self.event_address = f"tcp://{ip}:{events}"
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+
+        self.commands = queue.Queue()
+        self.stop_requested = threading.Event()
+        self.connected = False
+        self.reconnections = 0
+
+        self._outgoing = deque()        # messages for the server, kept while the link is down
+        self._lock = threading.Lock()
+        self._seen = deque(maxlen=256)  # (session, id) of the commands already delivered
+        self._context = zmq.Context.instance()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="CommandClient", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+
+    def get(self, timeout=None):
+        """Next command, waiting for it (None on timeout)."""
+        try:
+            return self.commands.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def poll(self):
+        """Next command if one arrived, without waiting."""
+        return self.get(timeout=0) if not self.commands.empty() else None
 
+    def send(self, message):
+        """Queue a message for the server, sent as soon as the link is up."""
+        with self._lock:
+            self._outgoing.append(message)
 
-# Initialize a connection to the server
-def connect_to_server(ip, port):
-    context = zmq.Context()
-    socket = context.socket(zmq.REQ)
-    address = f"tcp://{ip}:{port}"
-    socket.connect(address)
-    return socket
+    def _open(self):
+        dealer = self._context.socket(zmq.DEALER)
+        dealer.setsockopt(zmq.IDENTITY, self.robot.encode())
+        dealer.setsockopt(zmq.LINGER, 0)
+        dealer.connect(self.command_address)
+        sub = self._context.socket(zmq.SUB)
+        sub.setsockopt(zmq.LINGER, 0)
+        for topic in (self.robot, ALL_ROBOTS):
+            sub.setsockopt(zmq.SUBSCRIBE, topic.encode())
+        sub.connect(self.event_address)
+        dealer.send(encode({"type": "hello", "time": time.time()}))
+        return dealer, sub
 
+    def _run(self):
+        dealer, sub = self._open()
+        poller = zmq.Poller()
+        poller.register(sub, zmq.POLLIN)
+        poller.register(dealer, zmq.POLLIN)
+        last_heard = time.perf_counter()
+        last_beat = 0.0
+        try:
+            while self._running:
+                events = dict(poller.poll(timeout=self.heartbeat * 1000 / 4))
+                now = time.perf_counter()
+                if sub in events:
+                    topic, data = sub.recv_multipart()
+                    if topic.decode() in (self.robot, ALL_ROBOTS):  # subscriptions match prefixes only
+                        self._handle(decode(data), dealer)
+                    last_heard = now
+                if dealer in events:
+                    dealer.recv()  # the server does not answer on this socket, it only shows it is alive
+                    last_heard = now
 
-# Request the latest command from the server
-def request_command(socket):
-    # Ask the server for the latest command
-    request_msg = {"from": "robot", "cmd": "key"}
-    socket.send_pyobj(request_msg)
+                if now - last_heard > self.timeout:
+                    if self.connected:
+                        logging.warning("Command server lost, reconnecting")
+                    self.connected = False
+                    poller.unregister(sub)
+                    poller.unregister(dealer)
+                    dealer.close()
+                    sub.close()
+                    dealer, sub = self._open()
+                    poller.register(sub, zmq.POLLIN)
+                    poller.register(dealer, zmq.POLLIN)
+                    self.reconnections += 1
+                    last_heard = now
+                    continue
 
-    # Receive the response from the server
-    response = socket.recv_pyobj()
-    return response.get("key", None)
+                if now - last_beat >= self.heartbeat:
+                    dealer.send(encode({"type": "heartbeat", "time": time.time()}))
+                    last_beat = now
+                if self.connected:
+                    self._flush(dealer)
+        finally:
+            dealer.close()
+            sub.close()
+
+    def _flush(self, dealer):
+        with self._lock:
+            while self._outgoing:
+                dealer.send(encode(self._outgoing.popleft()))
+
+    def _handle(self, message, dealer):
+        if not self.connected:
+            logging.info(f"Connected to the command server {self.event_address}")
+            self.connected = True
+        if message.get("type") != "command":
+            return
+        dealer.send(encode({"type": "ack", "id": message["id"]}))
+        key = (message.get("session"), message["id"])
+        if key in self._seen:
+            return
+        self._seen.append(key)
+        command = message["cmd"]
+        logging.info(f"Received command: {command}")
+        if command == "stop":
+            self.stop_requested.set()
+        self.commands.put(command)
+
+
+class CommandServer:
+    """
+    Server side of CommandClient: publishes the commands to the robots and publishes them again until they are
+    acknowledged, so a command sent while a robot is disconnected is delivered when it comes back.
+    """
+    def __init__(self, port=command_port, events=event_port, heartbeat=HEARTBEAT_INTERVAL,
+                 timeout=LINK_TIMEOUT, resend=RESEND_INTERVAL):
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+        self.resend = resend
+        self.session = os.urandom(4).hex()
+        self.robots = {}         # robot name -> perf_counter time it was last heard of
+        self._pending = {}       # command id -> [robot, command, time last published]
+        self._next_id = 1
+        self._lock = threading.Lock()   # the PUB socket is used from dispatch() and from the server thread
+        context = zmq.Context.instance()
+        self._router = context.socket(zmq.ROUTER)
+        self._router.bind(f"tcp://*:{port}")
+        self._pub = context.socket(zmq.PUB)
+        self._pub.bind(f"tcp://*:{events}")
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="CommandServer", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+        self._router.close(linger=0)
+        self._pub.close(linger=0)
+
+    def dispatch(self, robot, command):
+        """Publish a command to a robot (ALL_ROBOTS for all of them), returns its id."""
+        with self._lock:
+            command_id = self._next_id
+            self._next_id += 1
+            self._pending[command_id] = [robot, command, time.perf_counter()]
+            self._publish(robot, self._command(command_id, command))
+        return command_id
+
+    def _command(self, command_id, command):
+        return {"type": "command", "session": self.session, "id": command_id, "cmd": command}
+
+    def _publish(self, topic, message):
+        self._pub.send_multipart([topic.encode(), encode(message)])
+
+    def _run(self):
+        poller = zmq.Poller()
+        poller.register(self._router, zmq.POLLIN)
+        last_beat = 0.0
+        while self._running:
+            if dict(poller.poll(timeout=self.resend * 1000 / 2)):
+                identity, data = self._router.recv_multipart()
+                robot, message = identity.decode(), decode(data)
+                if robot not in self.robots or message.get("type") == "hello":
+                    logging.info(f"Robot {robot} connected")
+                self.robots[robot] = time.perf_counter()
+                if message.get("type") == "ack":
+                    with self._lock:
+                        self._pending.pop(message["id"], None)
+                elif message.get("type") == "status":
+                    logging.info(f"Status of {robot}: {message}")
+
+            now = time.perf_counter()
+            with self._lock:
+                if now - last_beat >= self.heartbeat:
+                    self._publish(ALL_ROBOTS, {"type": "heartbeat", "time": time.time()})
+                    last_beat = now
+                for command_id, entry in self._pending.items():
+                    robot, command, published = entry
+                    # Commands to every robot are not tracked per robot, they are published once
+                    if robot != ALL_ROBOTS and now - published >= self.resend:
+                        self._publish(robot, self._command(command_id, command))
+                        entry[2] = now
+                self._pending = {command_id: entry for command_id, entry in self._pending.items()
+                                 if entry[0] != ALL_ROBOTS}
 
 
 # Function to execute received commands
@@ -32,6 +264,9 @@ start_position = None  # Starting position
 end_position = None  # Ending position
 direction = None  # Direction the vehicle is facing
 
+# Facing directions as the absolute headings of graphe_go_brrrrr ((0, 1) is abs_right...)
+DIRECTIONS = {'forward': (1, 0), 'backward': (-1, 0), 'left': (0, -1), 'right': (0, 1)}
+
 
 def execute_command(command):
     global start_position, end_position, direction
@@ -71,30 +306,47 @@ def execute_command(command):
     elif command == 'status':
         # Report the current status
         print(f"Start Position: {start_position}, End Position: {end_position}, Facing: {direction}")
+    elif command == 'stop':
+        print("Stopping")
     else:
         print("No action or unknown command")
 
 
+def serve():
+    """Command server for the terminal: each line "<robot> <command>" is dispatched, "* <command>" to every robot."""
+    server = CommandServer().start()
+    print(f"Serving commands on ports {command_port} and {event_port}, enter <robot> <command>")
+    try:
+        for line in iter(input, ""):
+            robot, _, command = line.strip().partition(" ")
+            if command:
+                server.dispatch(robot, command)
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        server.stop()
+
+
 # Main function to connect and run the robot
 def main():
-    # Connect to the server
-    server_socket = connect_to_server(server_ip, command_port)
-    print("Connected to server")
-
-    while True:
-        # Request the latest command from the server
-        command = request_command(server_socket)
+    # Connect to the server, the commands then arrive as soon as they are published
+    client = CommandClient(server_ip).start()
+    print("Waiting for commands from the server")
 
-        if command:
+    try:
+        while True:
+            command = client.get()
             print(f"Received command: {command}")
             # Execute the command if valid
             execute_command(command)
-        else:
-            print("No new command received")
-
-        # Wait a short time before requesting again
-        time.sleep(0.1)  # Adjust based on your system needs
+    finally:
+        client.stop()
 
 
 if __name__ == "__main__":
-    main()
+    import sys
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    if "--server" in sys.argv:
+        serve()
+    else:
+        main()
@@ -0,0 +1,132 @@
+import logging
+import threading
+import time
+
+from instrumentation import NULL_TIMER
+
+
+class ControlScheduler:
+    """
+    Runs the PID at a fixed rate on its own thread, decoupled from the loop processing the frames, on the latest
+    line measurement given to update_measurement() (with the heading of the line if known).
+    The integral and the derivative only update on a new measurement, with dt the time between the frames of the
+    last two. Every tick steers on the value predicted for now from the filtered derivative (PIDController.predict),
+    which also makes up for the age of the frame; the prediction reaches at most one frame interval ahead.
+    A measurement older than max_age (the camera stalled) stops the motors instead.
+    apply(motor_left, motor_right, value) sends the PID outputs to the motors, value being the predicted
+    measurement they were computed from; stop() stops them.
+    The scheduler starts paused: resume() hands it the motors, pause() takes them back (e.g. for a turn) and
+    returns once the tick in progress, if any, is over.
+    Overruns (ticks starting more than a period late) and the jitter of the ticks are counted, and the jitter,
+    dt and age of the measurements used go to timer as "control_jitter", "control_dt" and "control_age".
+    """
+    def __init__(self, pid, apply, stop, rate=50.0, max_age=0.3, timer=NULL_TIMER):
+        self.pid = pid
+        self.apply = apply
+        self.stop_motors = stop
+        self.period = 1.0 / rate
+        self.max_age = max_age
+        self.timer = timer
+
+        self.ticks = 0
+        self.updates = 0        # ticks with a new measurement
+        self.overruns = 0
+        self.stale = 0          # ticks skipped because the measurement was too old
+        self.max_jitter = 0.0
+        self.output = (0, 0)    # last motor values applied
+
+        self._measurement = None    # (value, perf_counter time of the frame it was measured on, heading)
+        self._previous_timestamp = None  # frame time of the measurement the PID last updated on
+        self._frame_dt = 0.0    # time between the last two measurements, how far the prediction may reach
+        self._lock = threading.Lock()   # held while a tick drives the motors
+        self._active = False
+        self._stopped_on_stale = False
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, name="ControlScheduler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.pause()
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+        logging.info(f"Control scheduler stopped: {self.ticks} ticks at {1 / self.period:.0f} Hz, "
+                     f"{self.updates} measurements, {self.overruns} overruns, {self.stale} stale, max jitter {self.max_jitter * 1e3:.1f}ms")
+
+    def update_measurement(self, value, timestamp, heading=0.0):
+        self._measurement = (value, timestamp, heading)
+
+    def pause(self):
+        with self._lock:
+            self._active = False
+
+    def resume(self):
+        if self._active:
+            return
+        with self._lock:
+            self.pid.reset()
+            self._previous_timestamp = None
+            self._frame_dt = 0.0
+            self._stopped_on_stale = False
+            self._active = True
+
+    @property
+    def active(self):
+        return self._active
+
+    def _loop(self):
+        deadline = time.perf_counter()
+        while self._running:
+            deadline += self.period
+            delay = deadline - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            now = time.perf_counter()
+            jitter = now - deadline
+            if jitter > self.period:
+                # Too late for this tick, start again from now rather than catching up with a burst
+                self.overruns += 1
+                deadline = now
+            self.max_jitter = max(self.max_jitter, jitter)
+            self.timer.record("control_jitter", max(jitter, 0.0))
+            try:
+                self._tick(now)
+            except Exception as e:
+                logging.error(f"Control tick failed: {e}")
+
+    def _tick(self, now):
+        with self._lock:
+            if not self._active:
+                return
+            measurement = self._measurement
+            if measurement is None or now - measurement[1] > self.max_age:
+                self.stale += 1
+                if not self._stopped_on_stale:
+                    logging.warning("No recent line measurement, stopping the motors")
+                    self.output = (0, 0)
+                    self.stop_motors()
+                    self._stopped_on_stale = True
+                self._previous_timestamp = None
+                self._frame_dt = 0.0
+                return
+            self._stopped_on_stale = False
+            value, timestamp, heading = measurement
+            if timestamp != self._previous_timestamp:
+                if self._previous_timestamp is not None:
+                    self._frame_dt = timestamp - self._previous_timestamp
+                dt = self._frame_dt or self.period
+                self._previous_timestamp = timestamp
+                self.timer.record("control_dt", dt)
+                self.timer.record("control_age", now - timestamp)
+                self.pid.update(dt, value, heading)
+                self.updates += 1
+            predicted = self.pid.predict(min(now - timestamp, self._frame_dt))
+            self.output = self.pid.steer(predicted, heading)
+            self.apply(*self.output, predicted)
+            self.ticks += 1
@@ -1,118 +1,272 @@
-from picamera.array import PiRGBArray
-from picamera import PiCamera
 import logging
-import time
+import os
 import numpy as np
-import math
 import cv2
 
-def detect_intersections(frame, angle_threshold=20, distance_threshold=5):
+def pairwise_intersections(segments, angle_threshold=20, distance_threshold=5):
+    """
+    Intersections of every pair of segments, computed for all pairs at once.
+    segments: array of shape (n, 4) or (n, 1, 4) as returned by HoughLinesP, each row being x1, y1, x2, y2.
+    Pairs are kept in the same (i, j) order as a double loop over i < j.
+    Returns an int array of shape (m, 2) holding the intersection points.
+    """
+    seg = np.asarray(segments, dtype=np.int64).reshape(-1, 4)
+    if len(seg) < 2:
+        return np.empty((0, 2), dtype=np.int64)
+    x1, y1, x2, y2 = seg.T
+
+    # Indices of every pair i < j
+    i, j = np.triu_indices(len(seg), k=1)
+
+    # Angle between the two lines of each pair, skip the nearly parallel ones
+    theta = np.arctan2(y2 - y1, x2 - x1)
+    angle = np.abs(np.degrees(theta[i] - theta[j]))
+    angle = np.minimum(angle, 180 - angle)
+    keep = angle >= angle_threshold
+    i, j = i[keep], j[keep]
+
+    # Line k: A[k]x + B[k]y + C[k] = 0
+    A = y2 - y1
+    B = x1 - x2
+    C = x2 * y1 - x1 * y2
+
+    # Solving the system of equations of every pair to find the intersection
+    denom = A[i] * B[j] - A[j] * B[i]
+    keep = denom != 0  # Lines are not parallel
+    i, j, denom = i[keep], j[keep], denom[keep]
+    points = np.empty((len(i), 2), dtype=np.int64)
+    points[:, 0] = (B[i] * C[j] - B[j] * C[i]) / denom  # float to int truncates like int()
+    points[:, 1] = (A[j] * C[i] - A[i] * C[j]) / denom
+
+    # Ignore the points too close to any endpoint of either line (noise filtering)
+    endpoints = np.concatenate((seg[i].reshape(-1, 2, 2), seg[j].reshape(-1, 2, 2)), axis=1)
+    offsets = endpoints - points[:, None, :]
+    near = np.sqrt((offsets ** 2).sum(axis=2)) < distance_threshold
+    return points[~near.any(axis=1)]
+
+
+def cluster_intersections(points, radius):
+    """
+    Merge the intersections closer than radius into the mean point of their cluster.
+    A point joins the first cluster whose current mean is within radius, otherwise starts a new one.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    sums = np.empty_like(points)
+    counts = np.zeros(len(points), dtype=np.int64)
+    n_clusters = 0
+    for point in points:
+        if n_clusters:
+            means = sums[:n_clusters] / counts[:n_clusters, None]
+            dist = np.hypot(*(means - point).T)
+            k = int(np.argmin(dist))
+            if dist[k] < radius:
+                sums[k] += point
+                counts[k] += 1
+                continue
+        sums[n_clusters] = point
+        counts[n_clusters] = 1
+        n_clusters += 1
+    return (sums[:n_clusters] / counts[:n_clusters, None]).astype(np.int64)
+
+
+def detect_intersections(frame, angle_threshold=20, distance_threshold=5, edges=None, cluster_radius=None, lut=None):
+    """
+    Detect line intersections in a frame and mark them in red.
+    edges: Canny edges already computed by the VisionPipeline, computed here if not given.
+    lut: color_lut.ColorLUT giving the white mask when the edges are computed here, instead of the threshold.
+    cluster_radius: if set, near-duplicate intersections are merged into one point.
+    """
     logging.debug("Detecting intersections...")
-    # Convert the frame to grayscale
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    if edges is None and lut is not None:
+        edges = cv2.Canny(lut.classify(frame), 30, 100, apertureSize=3)
+    elif edges is None:
+        # Convert the frame to grayscale
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+        # Threshold the image to isolate white lines
+        _, thresh = cv2.threshold(gray, 180, 255, cv2.THRESH_BINARY)
+
+        # Edge detection using Canny with lower thresholds
+        edges = cv2.Canny(thresh, 30, 100, apertureSize=3)
 
-    # Threshold the image to isolate white lines
-    _, thresh = cv2.threshold(gray, 180, 255, cv2.THRESH_BINARY)
+    intersections = [tuple(point) for point in
+                     find_intersections(edges, angle_threshold, distance_threshold, cluster_radius).tolist()]
+
+    # Mark intersections if found
+    if intersections:
+        for intersection in intersections:
+            cv2.circle(frame, intersection, 5, (0, 0, 255), -1)  # Draw red circle at intersections
+        logging.info(f'Found intersection')
+    else:
+        logging.debug("No intersections detected.")
+
+    return intersections
 
-    # Edge detection using Canny with lower thresholds
-    edges = cv2.Canny(thresh, 30, 100, apertureSize=3)
 
+def find_intersections(edges, angle_threshold=20, distance_threshold=5, cluster_radius=None, votes=50,
+                       min_length=20):
+    """Intersections of the Hough segments of an edge image (or of a region of it), as an (m, 2) int array."""
     # Use Hough Line Transform with adjusted parameters for low resolution
-    lines = cv2.HoughLinesP(edges, 1, np.pi / 180, threshold=50, minLineLength=20, maxLineGap=5)
-
-    intersections = []  # List to store intersections
-
-    def calculate_angle(line1, line2):
-        """Calculate the angle between two lines in degrees."""
-        x1, y1, x2, y2 = line1
-        x3, y3, x4, y4 = line2
-        angle1 = math.atan2(y2 - y1, x2 - x1)
-        angle2 = math.atan2(y4 - y3, x4 - x3)
-        angle = abs(math.degrees(angle1 - angle2))
-        return min(angle, 180 - angle)
-
-    def is_near_point(p1, p2, threshold):
-        """Check if two points are within a certain distance."""
-        return np.linalg.norm(np.array(p1) - np.array(p2)) < threshold
-
-    if lines is not None:
-        # Detect intersections
-        for i in range(len(lines)):
-            for j in range(i + 1, len(lines)):
-                line1 = lines[i][0]
-                line2 = lines[j][0]
-                x1, y1, x2, y2 = line1
-                x3, y3, x4, y4 = line2
-
-                # Calculate the angle between the two lines
-                angle = calculate_angle(line1, line2)
-                if angle < angle_threshold:  # Skip if angle is too small (lines are nearly parallel)
-                    continue
-
-                # Line 1: A1x + B1y + C1 = 0
-                A1 = y2 - y1
-                B1 = x1 - x2
-                C1 = x2 * y1 - x1 * y2
-
-                # Line 2: A2x + B2y + C2 = 0
-                A2 = y4 - y3
-                B2 = x3 - x4
-                C2 = x4 * y3 - x3 * y4
-
-                # Solving the system of equations to find intersection
-                denom = A1 * B2 - A2 * B1
-                if denom != 0:  # Lines are not parallel
-                    intersect_x = (B1 * C2 - B2 * C1) / denom
-                    intersect_y = (A2 * C1 - A1 * C2) / denom
-                    intersection_point = (int(intersect_x), int(intersect_y))
-
-                    # Check if the intersection point is close to either line's endpoints (noise filtering)
-                    if (is_near_point(intersection_point, (x1, y1), distance_threshold) or
-                        is_near_point(intersection_point, (x2, y2), distance_threshold) or
-                        is_near_point(intersection_point, (x3, y3), distance_threshold) or
-                        is_near_point(intersection_point, (x4, y4), distance_threshold)):
-                        continue  # Ignore if too close to any endpoint
-
-                    intersections.append(intersection_point)
-
-        # Mark intersections if found
-        if intersections:
-            for intersection in intersections:
-                cv2.circle(frame, intersection, 5, (0, 0, 255), -1)  # Draw red circle at intersections
-            logging.info(f'Found intersection')
+    lines = cv2.HoughLinesP(edges, 1, np.pi / 180, threshold=votes, minLineLength=min_length, maxLineGap=5)
+    if lines is None:
+        return np.empty((0, 2), dtype=np.int64)
+    points = pairwise_intersections(lines, angle_threshold, distance_threshold)
+    if cluster_radius is not None and len(points):
+        points = cluster_intersections(points, cluster_radius)
+    return points
+
+
+class IntersectionTracker:
+    """
+    Follows the next intersection down the image with a constant velocity Kalman filter on its position, so the
+    Hough transform mostly runs on a small region of interest around the predicted position.
+    The whole frame is only searched every search_interval frames while nothing is tracked, and on the frame
+    after a track is lost; a tracked intersection survives max_misses frames without detection.
+    update() returns the tracked point as a list of one (x, y) tuple, empty when nothing is tracked, like
+    detect_intersections. After it, confidence (0 to 1) tells how regularly the track was detected lately,
+    distance is the number of rows left before the intersection reaches trigger_row (the bottom of the image by
+    default), eta the seconds this should take at the current speed, and passed is set on the frame the
+    intersection goes past trigger_row: the car is on the crossing.
+    """
+    def __init__(self, search_interval=3, roi_radius=24, gate=16, max_misses=4, trigger_row=None,
+                 angle_threshold=20, distance_threshold=5):
+        self.search_interval = search_interval
+        self.roi_radius = roi_radius
+        self.gate = gate
+        self.max_misses = max_misses
+        self.trigger_row = trigger_row
+        self.angle_threshold = angle_threshold
+        self.distance_threshold = distance_threshold
+        self.full_searches = 0
+        self.roi_searches = 0
+
+        self.kalman = cv2.KalmanFilter(4, 2)  # state x, y, vx, vy in pixels and pixels per second
+        self.kalman.measurementMatrix = np.array([[1, 0, 0, 0], [0, 1, 0, 0]], np.float32)
+        self.kalman.measurementNoiseCov = np.eye(2, dtype=np.float32) * 4.0  # 2 px of detection noise
+        self.reset()
+
+    def reset(self):
+        """Forget the track, e.g. while turning on the intersection."""
+        self.tracking = False
+        self.confidence = 0.0
+        self.distance = None
+        self.eta = None
+        self.passed = False
+        self.misses = 0
+        self._frames_since_search = self.search_interval  # search the next frame
+
+    def _predict(self, dt):
+        self.kalman.transitionMatrix = np.array([[1, 0, dt, 0], [0, 1, 0, dt], [0, 0, 1, 0], [0, 0, 0, 1]],
+                                                np.float32)
+        # Piecewise constant acceleration of about 200 px/s^2 between two frames
+        q = np.array([[dt ** 4 / 4, dt ** 3 / 2], [dt ** 3 / 2, dt ** 2]], np.float32) * 200.0 ** 2
+        noise = np.zeros((4, 4), np.float32)
+        noise[np.ix_([0, 2], [0, 2])] = q
+        noise[np.ix_([1, 3], [1, 3])] = q
+        self.kalman.processNoiseCov = noise
+        return self.kalman.predict()[:2, 0]
+
+    def _start(self, point):
+        self.kalman.statePost = np.array([[point[0]], [point[1]], [0], [0]], np.float32)
+        # Unknown speed at first: a wide prior lets the second detection set it
+        self.kalman.errorCovPost = np.diag([4.0, 4.0, 400.0 ** 2, 400.0 ** 2]).astype(np.float32)
+        self.tracking = True
+        self.misses = 0
+        self.confidence = 0.5
+
+    def update(self, frame, edges, dt):
+        """Track the intersection in a new frame; dt is the time since the previous frame in seconds."""
+        self.passed = False
+        height, width = edges.shape[:2]
+        trigger_row = self.trigger_row if self.trigger_row is not None else height
+
+        if not self.tracking:
+            self._frames_since_search += 1
+            if self._frames_since_search < self.search_interval:
+                return []
+            self._frames_since_search = 0
+            self.full_searches += 1
+            points = find_intersections(edges, self.angle_threshold, self.distance_threshold)
+            if not len(points):
+                return []
+            # The lowest intersection is the next one the car reaches
+            self._start(points[np.argmax(points[:, 1])])
         else:
-            logging.debug("No intersections detected.")
+            x, y = self._predict(dt)
+            if y >= trigger_row:
+                # Driven onto the crossing: the intersection left the part of the image that is searched
+                self.reset()
+                self.passed = True
+                self._frames_since_search = 0
+                return []
+            x0, y0 = max(int(x) - self.roi_radius, 0), max(int(y) - self.roi_radius, 0)
+            x1, y1 = min(int(x) + self.roi_radius, width), min(int(y) + self.roi_radius, height)
+            self.roi_searches += 1
+            points = np.empty((0, 2), np.int64)
+            if x1 - x0 > 4 and y1 - y0 > 4:
+                # Fewer votes and shorter segments: only part of the lines is in the region
+                points = find_intersections(edges[y0:y1, x0:x1], self.angle_threshold, self.distance_threshold,
+                                            votes=15, min_length=8) + (x0, y0)
+            offsets = np.hypot(points[:, 0] - x, points[:, 1] - y) if len(points) else np.empty(0)
+            if len(offsets) and offsets.min() < self.gate:
+                point = points[np.argmin(offsets)]
+                self.kalman.correct(np.array([[point[0]], [point[1]]], np.float32))
+                self.misses = 0
+                self.confidence = 0.7 * self.confidence + 0.3
+            else:
+                self.misses += 1
+                self.confidence *= 0.7
+                if self.misses > self.max_misses:
+                    logging.debug("Intersection track lost")
+                    self.reset()
+                    return []
+                # Coast on the prediction
+                self.kalman.statePost = self.kalman.statePre.copy()
+                self.kalman.errorCovPost = self.kalman.errorCovPre.copy()
 
-    return intersections
+        x, y, _, vy = self.kalman.statePost[:, 0]
+        self.distance = max(trigger_row - y, 0.0)
+        self.eta = self.distance / vy if vy > 1.0 else None
+        point = (int(x), int(y))
+        cv2.rectangle(frame, (point[0] - self.roi_radius, point[1] - self.roi_radius),
+                      (point[0] + self.roi_radius, point[1] + self.roi_radius), (0, 255, 255), 1)
+        cv2.circle(frame, point, 5, (0, 0, 255), -1)
+        return [point]
 
 
 if __name__ == "__main__":
-    # Initialize the Raspberry Pi camera
-    camera = PiCamera()
-    camera.resolution = (160, 128)
-    camera.framerate = 32
-    raw_capture = PiRGBArray(camera, size=(160, 128))
+    from camera_stream import PiCameraSource
+    from debug_stream import FrameStreamer
 
-    # Allow the camera to warm up
-    time.sleep(0.1)
+    # Without a display session the frames are published for debug_stream.py instead of shown
+    headless = not os.environ.get("DISPLAY")
+    streamer = FrameStreamer().start() if headless else None
 
-    # Capture frames from the Pi camera
-    for frame in camera.capture_continuous(raw_capture, format="bgr", use_video_port=True):
-        # Grab the image array from the frame
-        image = frame.array
+    # Initialize the Raspberry Pi camera
+    camera = PiCameraSource(resolution=(160, 128), framerate=32)
+    camera.open()
 
-        # Detect intersections directly on the frame
-        intersections = detect_intersections(image)
+    # Capture frames from the Pi camera
+    try:
+        for image in camera.frames():
+            # Detect intersections directly on the frame
+            intersections = detect_intersections(image)
 
-        # Display the frame with intersections
-        cv2.imshow('Intersections', image)
+            if headless:
+                streamer.offer(image)
+                continue
 
-        # Break the loop when 'q' key is pressed
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
+            # Display the frame with intersections
+            cv2.imshow('Intersections', image)
 
-        # Clear the stream for the next frame
-        raw_capture.truncate(0)
+            # Break the loop when 'q' key is pressed
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+    finally:
+        camera.close()
+        if streamer is not None:
+            streamer.stop()
 
     # Close the display window
-    cv2.destroyAllWindows()
+    if not headless:
+        cv2.destroyAllWindows()
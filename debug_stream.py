@@ -0,0 +1,124 @@
+import argparse
+import json
+import logging
+import threading
+import time
+
+import cv2
+import numpy as np
+import zmq
+
+STREAM_PORT = 5556  # next to the command port of communication.py
+TOPIC = b"frame"
+
+
+class FrameStreamer:
+    """
+    Publishes annotated frames as JPEG over a ZMQ PUB socket for a remote viewer, at most rate frames per second.
+    offer() only copies the frame into a buffer of the streamer when it is time for a new one and the previous one
+    has been sent, the encoding and the sending run on the streamer's thread: the control loop never waits on them.
+    Frames a slow viewer cannot take are dropped by ZMQ (high water mark of 2) instead of queueing up.
+    """
+    def __init__(self, port=STREAM_PORT, rate=5.0, quality=70):
+        self.address = f"tcp://*:{port}"
+        self.period = 1.0 / rate
+        self.quality = quality
+        self.offered = 0
+        self.sent = 0
+
+        self._buffer = None
+        self._timestamp = 0.0
+        self._pending = False       # the buffer holds a frame not encoded yet
+        self._next_time = 0.0
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._publish_loop, name="FrameStreamer", daemon=True)
+        self._thread.start()
+        logging.info(f"Streaming debug frames on {self.address}")
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+        logging.info(f"Frame streamer stopped: {self.sent} frames sent")
+
+    def offer(self, frame, timestamp=None):
+        """Hand a frame over if one is due, returns immediately whatever happens."""
+        now = time.perf_counter()
+        if now < self._next_time or self._pending:
+            return False
+        if self._buffer is None or self._buffer.shape != frame.shape:
+            self._buffer = np.empty_like(frame)
+        np.copyto(self._buffer, frame)
+        with self._cond:
+            self._timestamp = now if timestamp is None else timestamp
+            self._pending = True
+            self._next_time = now + self.period
+            self.offered += 1
+            self._cond.notify()
+        return True
+
+    def _publish_loop(self):
+        # The socket belongs to this thread, ZMQ sockets must not be shared between threads
+        context = zmq.Context.instance()
+        socket = context.socket(zmq.PUB)
+        socket.setsockopt(zmq.SNDHWM, 2)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.bind(self.address)
+        params = [int(cv2.IMWRITE_JPEG_QUALITY), self.quality]
+        try:
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._pending or not self._running)
+                    if not self._running:
+                        return
+                    timestamp = self._timestamp
+                ok, jpeg = cv2.imencode(".jpg", self._buffer, params)
+                with self._cond:
+                    self._pending = False
+                if not ok:
+                    continue
+                header = json.dumps({"seq": self.offered, "timestamp": timestamp}).encode()
+                try:
+                    socket.send_multipart([TOPIC, header, jpeg.tobytes()], flags=zmq.NOBLOCK)
+                    self.sent += 1
+                except zmq.Again:
+                    pass  # nobody keeps up, drop it
+        finally:
+            socket.close()
+
+
+def view(address):
+    """Remote viewer: show the frames published by a FrameStreamer."""
+    context = zmq.Context.instance()
+    socket = context.socket(zmq.SUB)
+    socket.setsockopt(zmq.RCVHWM, 2)
+    socket.setsockopt(zmq.SUBSCRIBE, TOPIC)
+    socket.connect(address)
+    try:
+        while True:
+            _, header, jpeg = socket.recv_multipart()
+            frame = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+            logging.debug(f"Frame {json.loads(header)}")
+            cv2.imshow(f"HighFive {address}", frame)
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+    finally:
+        socket.close()
+        cv2.destroyAllWindows()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the debug frames streamed by the car")
+    parser.add_argument("address", help="Address of the car, e.g. tcp://192.168.137.2:5556")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    view(args.address)
@@ -0,0 +1,273 @@
+import argparse
+import heapq
+import logging
+import math
+
+import main
+from graphe_go_brrrrr import HEADINGS, GridGraph, MoveCosts, dir_list
+from nav_daemon import request
+
+
+def _edge_key(node1, node2):
+    """Undirected edge as an order-independent key."""
+    return (node1, node2) if node1 <= node2 else (node2, node1)
+
+
+class ReservationTable:
+    """
+    Space-time occupancy of the grid by the robots already planned, in timesteps.
+    A node is reserved while a robot stands or turns on it, an edge (both ways) while a robot drives it,
+    and a parked robot keeps its node from its arrival on. The start of a robot not planned yet is held until
+    the time it needs to leave it.
+    """
+    def __init__(self):
+        self.nodes = {}     # node -> set of reserved timesteps
+        self.edges = {}     # edge key -> set of reserved timesteps
+        self.parked = {}    # node -> timestep from which a robot stays there for good
+        self.held = {}      # node -> last timestep of the hold on the start of a robot not planned yet
+
+    def node_free(self, node, t):
+        parked = self.parked.get(node)
+        if parked is not None and t >= parked:
+            return False
+        if t <= self.held.get(node, -1):
+            return False
+        return t not in self.nodes.get(node, ())
+
+    def node_free_during(self, node, t0, t1):
+        return all(self.node_free(node, t) for t in range(t0, t1 + 1))
+
+    def edge_free_during(self, node1, node2, t0, t1):
+        reserved = self.edges.get(_edge_key(node1, node2), ())
+        return not any(t in reserved for t in range(t0, t1 + 1))
+
+    def can_park(self, node, t):
+        """Whether a robot arriving at node at t can stay there: nobody is planned through it afterwards."""
+        if node in self.parked or self.held.get(node, -1) >= t:
+            return False
+        return not any(reserved >= t for reserved in self.nodes.get(node, ()))
+
+    def reserve_node(self, node, t0, t1):
+        self.nodes.setdefault(node, set()).update(range(t0, t1 + 1))
+
+    def reserve_edge(self, node1, node2, t0, t1):
+        self.edges.setdefault(_edge_key(node1, node2), set()).update(range(t0, t1 + 1))
+
+    def park(self, node, t):
+        self.parked[node] = t
+
+    def hold(self, node, t1):
+        self.held[node] = t1
+
+    def release(self, node):
+        self.held.pop(node, None)
+
+
+class AgentPlan:
+    """
+    Collision-free itinerary of one robot.
+    directions is in the dir_list format executed by go_somewhere, directions[i] being started at departures[i]
+    (in timesteps from the common start): a robot early at a node waits there until its departure.
+    """
+    def __init__(self, name, nodes, headings, departures, arrival, dir_init, step, driving=0):
+        self.name = name
+        self.nodes = nodes
+        self.headings = headings
+        self.departures = departures
+        self.arrival = arrival
+        self.step = step
+        self.waits = arrival - driving  # timesteps spent waiting for the other robots
+        self.directions = dir_list(headings, dir_init) if headings else []
+
+    def edges(self):
+        return list(zip(self.nodes[:-1], self.nodes[1:]))
+
+    def schedule(self):
+        """Departure time of each direction, in seconds from the common start."""
+        return [t * self.step for t in self.departures]
+
+    def __repr__(self):
+        return f"AgentPlan({self.name}: {self.directions}, departures {self.departures}, arrival {self.arrival})"
+
+
+class FleetPlanner:
+    """
+    Prioritized planning of several robots on the same grid.
+    Each robot is planned in turn with a space-time A* over (node, heading, timestep) that avoids the
+    reservations of the robots planned before it, waiting at nodes when needed. The durations of the moves come
+    from costs (turns and edges, in seconds) rounded up to timesteps of step seconds, and every reservation is
+    widened by margin timesteps to absorb the timing errors of the cars.
+    If a robot cannot be planned, it is moved to the front of the priority order and everything is planned again.
+    """
+    def __init__(self, graph, costs=None, step=0.25, margin=1, horizon=None):
+        self.graph = graph if isinstance(graph, GridGraph) else GridGraph(graph)
+        self.N = self.graph.N
+        self.costs = costs or MoveCosts()
+        self.step = step
+        self.margin = margin
+        self.horizon = horizon  # last timestep searched, defaults to a bound on the length of any plan
+        self.expanded = 0
+
+    def _steps(self, seconds):
+        return max(0, math.ceil(seconds / self.step - 1e-9))
+
+    def _turn_steps(self, heading, new_heading):
+        return self._steps(self.costs.heading_change(heading, new_heading))
+
+    def _plan_one(self, table, name, start, end, dir_init, horizon):
+        edge_steps = max(1, self._steps(self.costs.edge))
+        margin = self.margin
+
+        def heuristic(node):
+            return (abs(node[0] - end[0]) + abs(node[1] - end[1])) * edge_steps
+
+        start_state = (start, dir_init, 0)
+        if not table.node_free_during(start, 0, margin):
+            return None
+        parent = {start_state: None}
+        counter = 0
+        heap = [(heuristic(start), counter, start_state)]
+        closed = set()
+        while heap:
+            _, _, state = heapq.heappop(heap)
+            if state in closed:
+                continue
+            closed.add(state)
+            self.expanded += 1
+            node, heading, t = state
+            if node == end and table.can_park(node, t - margin):
+                return self._reserve(table, name, parent, state, dir_init)
+
+            # Wait one timestep where we are
+            if t < horizon and table.node_free(node, t + 1 + margin):
+                nxt = (node, heading, t + 1)
+                if nxt not in closed and nxt not in parent:
+                    parent[nxt] = state
+                    counter += 1
+                    heapq.heappush(heap, (t + 1 + heuristic(node), counter, nxt))
+
+            for new_heading in HEADINGS:
+                nxt_node = (node[0] + new_heading[0], node[1] + new_heading[1])
+                if not (0 <= nxt_node[0] < self.N and 0 <= nxt_node[1] < self.N):
+                    continue
+                if not self.graph.has_edge(node, nxt_node):
+                    continue
+                leave = t + self._turn_steps(heading, new_heading)
+                arrive = leave + edge_steps
+                if arrive > horizon:
+                    continue
+                if not (table.node_free_during(node, t, leave + margin) and
+                        table.edge_free_during(node, nxt_node, leave - margin, arrive + margin) and
+                        table.node_free_during(nxt_node, arrive - margin, arrive + margin)):
+                    continue
+                nxt = (nxt_node, new_heading, arrive)
+                if nxt in closed or nxt in parent:
+                    continue
+                parent[nxt] = state
+                counter += 1
+                heapq.heappush(heap, (arrive + heuristic(nxt_node), counter, nxt))
+        return None
+
+    def _reserve(self, table, name, parent, state, dir_init):
+        states = []
+        while state is not None:
+            states.append(state)
+            state = parent[state]
+        states.reverse()
+
+        margin = self.margin
+        nodes, headings, departures = [states[0][0]], [], []
+        table.reserve_node(states[0][0], 0, margin)
+        driving = 0
+        for (node, heading, t), (nxt_node, new_heading, arrive) in zip(states, states[1:]):
+            if nxt_node == node:  # waiting
+                table.reserve_node(node, t, arrive + margin)
+                continue
+            leave = t + self._turn_steps(heading, new_heading)
+            table.reserve_node(node, max(0, t - margin), leave + margin)
+            table.reserve_edge(node, nxt_node, max(0, leave - margin), arrive + margin)
+            table.reserve_node(nxt_node, max(0, arrive - margin), arrive + margin)
+            nodes.append(nxt_node)
+            headings.append(new_heading)
+            departures.append(t)
+            driving += arrive - t
+        arrival = states[-1][2]
+        table.park(nodes[-1], max(0, arrival - margin))
+        return AgentPlan(name, nodes, headings, departures, arrival, dir_init, self.step, driving)
+
+    def plan(self, agents):
+        """
+        agents: list of (name, start, end, dir_init), in priority order.
+        Returns {name: AgentPlan}, or None if no priority order tried gives every robot a plan.
+        """
+        agents = [(name, tuple(start), tuple(end), tuple(dir_init)) for name, start, end, dir_init in agents]
+        for index in (1, 2):
+            nodes = [agent[index] for agent in agents]
+            if len(set(nodes)) != len(nodes):
+                raise ValueError("Two robots cannot start or park on the same node")
+        horizon = self.horizon
+        if horizon is None:
+            # Driving the whole grid once per robot is always enough to let the others through
+            longest = self._steps(self.costs.edge + max(self.costs.turn, self.costs.uturn)) + 2 * self.margin
+            horizon = self.N * self.N * longest * len(agents)
+
+        # A robot not planned yet keeps its start while it could still be turning to leave it; the robots planned
+        # before it may go through or park there afterwards, its own plan then has to leave in time
+        leave = self._steps(max(self.costs.turn, self.costs.uturn)) + self.margin
+        order = list(agents)
+        for attempt in range(len(agents)):
+            table = ReservationTable()
+            for _, start, _, _ in order:
+                table.hold(start, leave)
+            plans = {}
+            failed = None
+            for name, start, end, dir_init in order:
+                # Its plan then reserves the time it actually spends at its start
+                table.release(start)
+                plan = self._plan_one(table, name, start, end, dir_init, horizon)
+                if plan is None:
+                    failed = (name, start, end, dir_init)
+                    break
+                plans[name] = plan
+            if failed is None:
+                logging.info(f"Planned {len(plans)} robots, makespan {max(p.arrival for p in plans.values())} "
+                             f"steps, {self.expanded} states expanded")
+                return plans
+            logging.debug(f"No plan for {failed[0]} at priority {order.index(failed)}, raising its priority")
+            order.remove(failed)
+            order.insert(0, failed)
+        logging.warning("No collision-free plan found for the fleet")
+        return None
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Collision-free itineraries for several cars on the same grid")
+    parser.add_argument("--size", type=int, required=True, help="Size of the grid (N)")
+    parser.add_argument("--robot", type=int, nargs=6, action="append", required=True,
+                        metavar=("START_X", "START_Y", "END_X", "END_Y", "DIR_X", "DIR_Y"),
+                        help="One car, in priority order")
+    parser.add_argument("--step", type=float, default=0.25, help="Timestep of the reservations, in seconds")
+    parser.add_argument("--address", action="append", default=[],
+                        help="Navigation daemon of each car, in the order of --robot (e.g. tcp://192.168.137.2:5008): "
+                             "the plans are sent to them and the cars start together")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+    args = parse_arguments()
+    if args.address and len(args.address) != len(args.robot):
+        raise SystemExit("One --address per --robot")
+    agents = [(f"car{i}", r[0:2], r[2:4], r[4:6]) for i, r in enumerate(args.robot)]
+    # The durations of the moves are the ones the cars drive with
+    plans = FleetPlanner(args.size, main.MOVE_COSTS, step=args.step).plan(agents)
+    for plan in (plans or {}).values():
+        print(f"{plan.name}: {list(zip([round(t, 2) for t in plan.schedule()], plan.directions))}")
+    if plans and args.address:
+        for (name, _, _, _), address in zip(agents, args.address):
+            plan = plans[name]
+            if not plan.edges():
+                continue  # already parked at its end
+            reply = request({"cmd": "plan", "nodes": [list(node) for node in plan.nodes],
+                             "departures": plan.schedule()}, address)
+            print(f"{name} at {address}: {reply if reply is not None else 'no answer'}")
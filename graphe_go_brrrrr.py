@@ -1,5 +1,5 @@
+import heapq
 import numpy as np
-from collections import deque
 import logging
 
 def grid_to_adjacency_matrix(N):
@@ -27,12 +27,168 @@ def grid_to_adjacency_matrix(N):
                 
     return adj_matrix
 
+class GridGraph:
+    """
+    Implicit N x N grid where every node (r, c) is linked to its 4 neighbours.
+    Only the removed edges are stored, in two boolean masks, so a 100x100 grid takes about 20 kB
+    instead of the 800 MB of its adjacency matrix.
+    """
+    def __init__(self, N):
+        self.N = N
+        self.n_nodes = N * N
+        self.blocked_right = np.zeros((N, max(N - 1, 0)), dtype=bool)  # edge (r, c) - (r, c + 1)
+        self.blocked_down = np.zeros((max(N - 1, 0), N), dtype=bool)   # edge (r, c) - (r + 1, c)
+
+    def node_to_index(self, r, c):
+        return r * self.N + c
+
+    def _edge_slot(self, node1, node2):
+        """Mask and position of the edge between two neighbouring nodes."""
+        (r1, c1), (r2, c2) = sorted((tuple(node1), tuple(node2)))
+        if r1 == r2 and c2 == c1 + 1:
+            return self.blocked_right, (r1, c1)
+        if c1 == c2 and r2 == r1 + 1:
+            return self.blocked_down, (r1, c1)
+        raise ValueError(f"{node1} and {node2} are not neighbours in the grid")
+
+    def remove_edge(self, node1, node2):
+        mask, slot = self._edge_slot(node1, node2)
+        mask[slot] = True
+
+    def has_edge(self, node1, node2):
+        mask, slot = self._edge_slot(node1, node2)
+        return not mask[slot]
+
+    def neighbor_pairs(self, frontier):
+        """
+        Neighbours of an array of node indices.
+        Returns (pos, nbr): nbr is a neighbour of frontier[pos], ordered by pos then by increasing index.
+        """
+        N = self.N
+        r, c = np.divmod(frontier, N)
+        pos = np.arange(len(frontier))
+        # Up, left, right, down: increasing index order, as when scanning a row of the adjacency matrix
+        up = r > 0
+        up[up] = ~self.blocked_down[r[up] - 1, c[up]]
+        left = c > 0
+        left[left] = ~self.blocked_right[r[left], c[left] - 1]
+        right = c < N - 1
+        right[right] = ~self.blocked_right[r[right], c[right]]
+        down = r < N - 1
+        down[down] = ~self.blocked_down[r[down], c[down]]
+
+        all_pos = np.concatenate((pos[up], pos[left], pos[right], pos[down]))
+        all_nbr = np.concatenate((frontier[up] - N, frontier[left] - 1, frontier[right] + 1, frontier[down] + N))
+        order = np.argsort(all_pos, kind="stable")
+        return all_pos[order], all_nbr[order]
+
+
+class CSRGraph:
+    """General undirected graph stored as compressed sparse rows: the neighbours of i are indices[indptr[i]:indptr[i+1]]."""
+    def __init__(self, n_nodes, edges):
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        src = np.concatenate((edges[:, 0], edges[:, 1]))
+        dst = np.concatenate((edges[:, 1], edges[:, 0]))
+        order = np.lexsort((dst, src))  # neighbours sorted by increasing index
+        self.n_nodes = n_nodes
+        self.indices = dst[order]
+        self.indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=n_nodes), out=self.indptr[1:])
+        self.active = np.ones(len(self.indices), dtype=bool)  # False once the edge is removed
+
+    @classmethod
+    def from_adjacency_matrix(cls, adj_matrix):
+        src, dst = np.nonzero(np.triu(adj_matrix))
+        return cls(adj_matrix.shape[0], np.stack((src, dst), axis=1))
+
+    def _slots(self, i, j):
+        row = slice(self.indptr[i], self.indptr[i + 1])
+        return self.indptr[i] + np.flatnonzero(self.indices[row] == j)
+
+    def remove_edge(self, i, j):
+        self.active[self._slots(i, j)] = False
+        self.active[self._slots(j, i)] = False
+
+    def has_edge(self, i, j):
+        return bool(self.active[self._slots(i, j)].any())
+
+    def neighbor_pairs(self, frontier):
+        """Same as GridGraph.neighbor_pairs."""
+        starts = self.indptr[frontier]
+        counts = self.indptr[frontier + 1] - starts
+        pos = np.repeat(np.arange(len(frontier)), counts)
+        # Slot of every neighbour: start of its row plus its rank in the row
+        ranks = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        slots = np.repeat(starts, counts) + ranks
+        keep = self.active[slots]
+        return pos[keep], self.indices[slots[keep]]
+
+
+def as_graph(graph):
+    """Accept a GridGraph, a CSRGraph or a legacy dense adjacency matrix."""
+    if isinstance(graph, np.ndarray):
+        return CSRGraph.from_adjacency_matrix(graph)
+    return graph
+
+
+def bfs_distance_field(graph, start_index, end_index=None):
+    """
+    Breadth-first search expanding a whole frontier at a time with NumPy.
+    Returns (dist, parent) arrays over the node indices: dist is -1 for unreachable nodes,
+    parent is -1 for the start and unreachable nodes. Stops early once end_index is reached, if given.
+    Ties are broken like a FIFO queue scanning neighbours in increasing index order.
+    """
+    dist = np.full(graph.n_nodes, -1, dtype=np.int64)
+    parent = np.full(graph.n_nodes, -1, dtype=np.int64)
+    dist[start_index] = 0
+    frontier = np.array([start_index], dtype=np.int64)
+    level = 0
+
+    while len(frontier) and (end_index is None or dist[end_index] < 0):
+        level += 1
+        pos, nbr = graph.neighbor_pairs(frontier)
+        new = dist[nbr] < 0
+        pos, nbr = pos[new], nbr[new]
+        # First discovery wins: candidates are already in queue order
+        _, first = np.unique(nbr, return_index=True)
+        first.sort()
+        nbr = nbr[first]
+        dist[nbr] = level
+        parent[nbr] = frontier[pos[first]]
+        frontier = nbr
+
+    return dist, parent
+
+
+def path_from_parents(parent, end_index, N):
+    """Edges from the BFS start to end_index as tuples of grid coordinates."""
+    path_edges = []
+    path_node = end_index
+    while parent[path_node] >= 0:
+        prev_node = parent[path_node]
+        prev_r, prev_c = divmod(int(prev_node), N)
+        curr_r, curr_c = divmod(int(path_node), N)
+        path_edges.append(((prev_r, prev_c), (curr_r, curr_c)))
+        path_node = prev_node
+    path_edges.reverse()  # Reverse the list to get the correct order
+    return path_edges
+
+
 def remove_edge(adj_matrix, node1, node2):
+    if isinstance(adj_matrix, GridGraph):
+        adj_matrix.remove_edge(node1, node2)
+        return
+
     def node_to_index(r, c, N):
         return r * N + c
-    
+
+    if isinstance(adj_matrix, CSRGraph):
+        N = int(np.sqrt(adj_matrix.n_nodes))
+        adj_matrix.remove_edge(node_to_index(*node1, N), node_to_index(*node2, N))
+        return
+
     N = int(np.sqrt(adj_matrix.shape[0]))  # Assuming adj_matrix is square of N*N x N*N
-    
+
     index1 = node_to_index(*node1, N)
     index2 = node_to_index(*node2, N)
     adj_matrix[index1][index2] = 0
@@ -40,50 +196,22 @@ def remove_edge(adj_matrix, node1, node2):
 
 
 def bfs_with_edges_from_matrix(adj_matrix, start, end, N=5):
-    # Map grid coordinates to matrix indices
-    def node_to_index(r, c):
-        return r * N + c
+    """
+    Shortest path in edges from start to end, as a list of edges between grid coordinates.
+    adj_matrix can be a GridGraph, a CSRGraph or a dense adjacency matrix.
+    """
+    graph = as_graph(adj_matrix)
+    if isinstance(graph, GridGraph):
+        N = graph.N
 
-    # Convert start and end coordinates to matrix indices
-    start_index = node_to_index(*start)
-    end_index = node_to_index(*end)
-    
-    # Queue for BFS and visited set to track visited nodes
-    queue = deque([start_index])
-    visited = set([start_index])
-    
-    # Dictionary to store the parent of each node (used for backtracking the path)
-    parent = {start_index: None}
-    
-    # List to store the edges used
-    path_edges = []
-    
-    while queue:
-        current_node = queue.popleft()
-        
-        # If we reach the target node, backtrack the path
-        if current_node == end_index:
-            # Backtrack the path using the parent dictionary
-            path_node = end_index
-            while parent[path_node] is not None:
-                prev_node = parent[path_node]
-                prev_r, prev_c = divmod(prev_node, N)
-                curr_r, curr_c = divmod(path_node, N)
-                # Append edges as tuples of grid coordinates (not np.int64)
-                path_edges.append(((int(prev_r), int(prev_c)), (int(curr_r), int(curr_c))))  
-                path_node = prev_node
-            path_edges.reverse()  # Reverse the list to get the correct order
-            return path_edges
-        
-        # Explore neighbors by checking the adjacency matrix (using NumPy slicing)
-        neighbors = np.where(adj_matrix[current_node] == 1)[0]
-        for neighbor in neighbors:
-            if neighbor not in visited:
-                visited.add(neighbor)
-                parent[neighbor] = current_node  # Set the parent of the neighbor
-                queue.append(neighbor)
-    
-    return []  # Return an empty list if no path found
+    # Map grid coordinates to node indices
+    start_index = start[0] * N + start[1]
+    end_index = end[0] * N + end[1]
+
+    dist, parent = bfs_distance_field(graph, start_index, end_index)
+    if dist[end_index] < 0:
+        return []  # Return an empty list if no path found
+    return path_from_parents(parent, end_index, N)
 
 """
 (1, 0) for right
@@ -118,7 +246,7 @@ def dir_list(dir_l, og_dir):
     turns = {
         "abs_up": {"abs_up": "straight", "abs_right": "right", "abs_left": "left", "abs_down": "do_a_flip"},
         "abs_down": {"abs_down": "straight", "abs_right": "left", "abs_left": "right", "abs_up": "do_a_flip"},
-        "abs_right": {"abs_right": "abs_straight", "abs_up": "left", "abs_down": "right", "abs_left": "do_a_flip"},
+        "abs_right": {"abs_right": "straight", "abs_up": "left", "abs_down": "right", "abs_left": "do_a_flip"},
         "abs_left": {"abs_left": "straight", "abs_up": "right", "abs_down": "left", "abs_right": "do_a_flip"},
     }
     
@@ -149,6 +277,164 @@ def dir_list(dir_l, og_dir):
     
     return relative_directions
 
+HEADINGS = ((0, 1), (0, -1), (1, 0), (-1, 0))  # absolute directions, same as in dir_list
+
+
+class MoveCosts:
+    """
+    Expected time of the elementary moves of the car, in seconds.
+    A move is a heading change at a node (straight, left/right or do_a_flip) followed by driving one edge.
+    """
+    def __init__(self, edge=1.0, straight=0.0, turn=0.7, uturn=1.4):
+        self.edge = edge
+        self.straight = straight
+        self.turn = turn
+        self.uturn = uturn
+
+    def heading_change(self, heading, new_heading):
+        if heading == new_heading:
+            return self.straight
+        if heading == (-new_heading[0], -new_heading[1]):
+            return self.uturn
+        return self.turn
+
+    def move(self, heading, new_heading):
+        return self.heading_change(heading, new_heading) + self.edge
+
+
+def edge_open(graph, node1, node2, N):
+    """Whether the grid nodes node1 and node2 are linked, for a GridGraph, a CSRGraph or a dense matrix."""
+    if isinstance(graph, GridGraph):
+        return graph.has_edge(node1, node2)
+    index1 = node1[0] * N + node1[1]
+    index2 = node2[0] * N + node2[1]
+    if isinstance(graph, CSRGraph):
+        return graph.has_edge(index1, index2)
+    return graph[index1][index2] == 1
+
+
+def route_cost(edge_list, dir_init, costs=None):
+    """Expected time of an itinerary given as a list of edges, starting with the heading dir_init."""
+    costs = costs or MoveCosts()
+    heading = tuple(dir_init)
+    total = 0.0
+    for move in dir_list_absolute(edge_list):
+        total += costs.move(heading, move)
+        heading = move
+    return total
+
+
+def astar_with_turns(graph, start, end, dir_init, costs=None, N=5):
+    """
+    A* over (node, heading) states minimising the expected travel time given by costs, turns included,
+    instead of the number of edges. The car starts at start facing dir_init.
+    Returns the list of edges used, in the format of bfs_with_edges_from_matrix ([] if end is unreachable).
+    """
+    costs = costs or MoveCosts()
+    if isinstance(graph, GridGraph):
+        N = graph.N
+    start, end, dir_init = tuple(start), tuple(end), tuple(dir_init)
+    if dir_init not in HEADINGS:
+        raise ValueError(f"Invalid initial direction: {dir_init}")
+    min_turn = min(costs.turn, costs.uturn)
+
+    def heuristic(node):
+        # Manhattan distance, plus one turn if the end is not on the same row or column
+        dr, dc = end[0] - node[0], end[1] - node[1]
+        return (abs(dr) + abs(dc)) * costs.edge + (min_turn if dr and dc else 0)
+
+    start_state = (start, dir_init)
+    best = {start_state: 0.0}
+    parent = {start_state: None}
+    counter = 0  # tie-breaker, keeps the order of the pushes among equal costs
+    heap = [(heuristic(start), counter, 0.0, start_state)]
+
+    while heap:
+        _, _, g, state = heapq.heappop(heap)
+        if g > best[state]:
+            continue  # outdated entry
+        node, heading = state
+        if node == end:
+            # Backtrack the path using the parent dictionary
+            path_edges = []
+            while parent[state] is not None:
+                previous = parent[state]
+                path_edges.append((previous[0], state[0]))
+                state = previous
+            path_edges.reverse()
+            logging.debug(f"A* found an itinerary of {len(path_edges)} edges, expected time {g:.2f}")
+            return path_edges
+
+        for new_heading in HEADINGS:
+            nxt = (node[0] + new_heading[0], node[1] + new_heading[1])
+            if not (0 <= nxt[0] < N and 0 <= nxt[1] < N) or not edge_open(graph, node, nxt, N):
+                continue
+            new_state = (nxt, new_heading)
+            new_g = g + costs.move(heading, new_heading)
+            if new_g < best.get(new_state, float("inf")):
+                best[new_state] = new_g
+                parent[new_state] = state
+                counter += 1
+                heapq.heappush(heap, (new_g + heuristic(nxt), counter, new_g, new_state))
+
+    return []  # Return an empty list if no path found
+
+def dijkstra_with_turns(graph, start, dir_init, costs=None, N=5):
+    """
+    Single-source version of astar_with_turns: expected travel time from start, facing dir_init,
+    to every reachable (node, heading) state.
+    Returns (best, parent): best maps each state to its cost, parent to the previous state (None for the start).
+    """
+    costs = costs or MoveCosts()
+    if isinstance(graph, GridGraph):
+        N = graph.N
+    start_state = (tuple(start), tuple(dir_init))
+    best = {start_state: 0.0}
+    parent = {start_state: None}
+    counter = 0
+    heap = [(0.0, counter, start_state)]
+
+    while heap:
+        g, _, state = heapq.heappop(heap)
+        if g > best[state]:
+            continue  # outdated entry
+        node, heading = state
+        for new_heading in HEADINGS:
+            nxt = (node[0] + new_heading[0], node[1] + new_heading[1])
+            if not (0 <= nxt[0] < N and 0 <= nxt[1] < N) or not edge_open(graph, node, nxt, N):
+                continue
+            new_state = (nxt, new_heading)
+            new_g = g + costs.move(heading, new_heading)
+            if new_g < best.get(new_state, float("inf")):
+                best[new_state] = new_g
+                parent[new_state] = state
+                counter += 1
+                heapq.heappush(heap, (new_g, counter, new_state))
+
+    return best, parent
+
+
+def path_from_tree(best, parent, start, end):
+    """
+    Edges of the cheapest path from start to end in a dijkstra_with_turns tree rooted at start, with its cost.
+    Returns (None, inf) if end is unreachable.
+    """
+    start, end = tuple(start), tuple(end)
+    if start == end:
+        return [], 0.0
+    arrivals = [(end, heading) for heading in HEADINGS if (end, heading) in best]
+    if not arrivals:
+        return None, float("inf")
+    state = min(arrivals, key=best.get)
+    cost = best[state]
+    path_edges = []
+    while parent[state] is not None:
+        previous = parent[state]
+        path_edges.append((previous[0], state[0]))
+        state = previous
+    path_edges.reverse()
+    return path_edges, cost
+
 """
 # Example Usage:
 N = 4  # Define grid size (e.g., 4x4 grid)
@@ -0,0 +1,153 @@
+import json
+import logging
+import threading
+import time
+
+import numpy as np
+
+
+class LatencyHistogram:
+    """
+    Fixed-size histogram of durations, HDR style: microsecond resolution below 64us, then 32 buckets per power of
+    two, so every value is kept within about 3% of its magnitude up to max_seconds whatever the number of samples.
+    """
+    SUB_BUCKETS = 32
+
+    def __init__(self, max_seconds=60.0):
+        self.max_us = int(max_seconds * 1e6)
+        self.counts = np.zeros(self._index(self.max_us) + 1, np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def _index(self, us):
+        sub = self.SUB_BUCKETS
+        if us < 2 * sub:
+            return us
+        shift = us.bit_length() - 6  # us >> shift is in [32, 64)
+        return 2 * sub + (shift - 1) * sub + (us >> shift) - sub
+
+    def _value(self, index):
+        """Middle of the bucket, in seconds."""
+        sub = self.SUB_BUCKETS
+        if index < 2 * sub:
+            return index * 1e-6
+        shift = (index - 2 * sub) // sub + 1
+        mantissa = (index - 2 * sub) % sub + sub
+        return ((mantissa << shift) + ((1 << shift) - 1) / 2) * 1e-6
+
+    def record(self, seconds):
+        us = min(max(int(seconds * 1e6), 0), self.max_us)
+        self.counts[self._index(us)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        rank = max(1, int(np.ceil(q / 100 * self.count)))
+        value = self._value(int(np.searchsorted(np.cumsum(self.counts), rank)))
+        return min(max(value, self.min), self.max)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class StageTimer:
+    """
+    Latency of the stages of the control loop, each one in a LatencyHistogram.
+    begin() starts a frame, each lap(stage) then records the time elapsed since the previous lap, so one line
+    after each stage is enough to time the whole loop; record() adds durations measured elsewhere (e.g. the
+    serial round trips, from the serial threads).
+    log_interval: seconds between two summary lines logged by tick(), None to never log.
+    """
+    def __init__(self, log_interval=None):
+        self.histograms = {}
+        self.log_interval = log_interval
+        self.frames = 0
+        self._last = None
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._last_log = self._start
+        self._frames_at_log = 0
+
+    def _histogram(self, stage):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(stage, LatencyHistogram())
+        return histogram
+
+    def begin(self):
+        self._last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        if self._last is not None:
+            self._histogram(stage).record(now - self._last)
+        self._last = now
+
+    def record(self, stage, seconds):
+        self._histogram(stage).record(seconds)
+
+    def tick(self):
+        """End of a loop iteration, logs the summary line every log_interval seconds."""
+        self.frames += 1
+        if self.log_interval is None:
+            return
+        now = time.perf_counter()
+        if now - self._last_log < self.log_interval:
+            return
+        rate = (self.frames - self._frames_at_log) / (now - self._last_log)
+        self._last_log, self._frames_at_log = now, self.frames
+        stages = " ".join(f"{stage} {h.percentile(50) * 1e3:.1f}/{h.percentile(99) * 1e3:.1f}"
+                          for stage, h in list(self.histograms.items()))
+        logging.info(f"Loop {rate:.1f} fps, p50/p99 ms: {stages}")
+
+    def summary(self):
+        """{stage: {count, mean, p50, p95, p99, max}}, times in milliseconds."""
+        return {stage: {"count": h.count, "mean": h.mean * 1e3, "p50": h.percentile(50) * 1e3,
+                        "p95": h.percentile(95) * 1e3, "p99": h.percentile(99) * 1e3, "max": h.max * 1e3}
+                for stage, h in list(self.histograms.items())}
+
+    def report(self):
+        lines = [f"{'stage':<16} {'count':>6} {'mean':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}  (ms)"]
+        for stage, s in self.summary().items():
+            lines.append(f"{stage:<16} {s['count']:>6} {s['mean']:>8.2f} {s['p50']:>8.2f} {s['p95']:>8.2f} "
+                         f"{s['p99']:>8.2f} {s['max']:>8.2f}")
+        return "\n".join(lines)
+
+    def dump(self, path):
+        """Write the summary and the raw histograms as JSON, e.g. registered with atexit."""
+        histograms = {}
+        for stage, h in list(self.histograms.items()):
+            # Only the buckets used, as bucket index -> count
+            histograms[stage] = {"sub_buckets": h.SUB_BUCKETS,
+                                 "counts": {int(i): int(h.counts[i]) for i in np.flatnonzero(h.counts)}}
+        data = {"frames": self.frames, "duration": time.perf_counter() - self._start, "summary": self.summary(),
+                "histograms": histograms}
+        with open(path, "w") as f:
+            json.dump(data, f)
+        logging.info(f"Timings written to {path}\n{self.report()}")
+
+
+class NullTimer:
+    """StageTimer doing nothing, used when the loop is not profiled."""
+    def begin(self):
+        pass
+
+    def lap(self, stage):
+        pass
+
+    def record(self, stage, seconds):
+        pass
+
+    def tick(self):
+        pass
+
+
+NULL_TIMER = NullTimer()
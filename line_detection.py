@@ -1,41 +1,79 @@
 import cv2
+import math
 import numpy as np
 import logging
 from PID import PIDController
 
+# Rows sampled by the scanline estimator, as fractions of the image height (top to bottom)
+SCAN_ROWS = (0.4, 0.55, 0.7, 0.85)
+
+
 class LineFollower:
-    def __init__(self, motor_control=None):
+    """
+    Measures the position of the line in the frames.
+    mode "contour": centroid of the largest white blob, distance only.
+    mode "scanline": centre of the widest white run on a few rows (scan_rows), with a line fitted through them,
+    giving the distance, the heading of the line and a confidence for a fraction of the cost.
+    """
+    def __init__(self, motor_control=None, mode="contour", scan_rows=SCAN_ROWS, min_run=3, max_run=0.5, lut=None):
         self.kernel_erode = np.ones((6, 6), np.uint8)
         self.kernel_dilate = np.ones((4, 4), np.uint8)
+        self.mode = mode
+        self.scan_rows = scan_rows
+        self.min_run = min_run  # narrower white runs are noise, in pixels
+        self.max_run = max_run  # wider runs (a crossing line) are ignored, as a fraction of the width
         self.cx = 0
         self.cy = 0
         self.distance = 0
+        self.heading = 0.0  # radians, positive when the line bends to the left ahead (scanline mode only)
+        self.confidence = 0.0  # 0 to 1, how well the line was seen in the last frame
+        self.line_found = False  # whether the last processed frame contained the line
         self.motor_control = motor_control  # Reference to motor control function
+        self.lut = lut  # color_lut.ColorLUT giving the mask when none is passed to process_frame
+        self._rows = None
+        self._white = None
         
 
     def get_attributes(self):
         """getter to have access to the values"""
         return self.distance
+
+    def measurement(self):
+        """Result of the last frame: (distance, heading, confidence, line_found)."""
+        return self.distance, self.heading, self.confidence, self.line_found
+
+    def set_measurement(self, distance, heading, confidence, line_found):
+        """Take the result of a frame processed elsewhere (vision_workers)."""
+        self.distance, self.heading, self.confidence, self.line_found = distance, heading, confidence, line_found
     
 
-    def process_frame(self, frame):
-        """Process a single frame (image) for line detection."""
+    def process_frame(self, frame, mask=None):
+        """
+        Process a single frame (image) for line detection.
+        mask: white mask already computed by the VisionPipeline, computed here if not given.
+        """
         h, w = frame.shape[:2]
         logging.debug(f"Width, Height: {w}, {h}")
 
-        # Apply Gaussian blur
-        blur = cv2.blur(frame, (5, 5))
+        if mask is None and self.lut is not None:
+            mask = self.lut.classify(frame)
+        elif mask is None:
+            # Apply Gaussian blur
+            blur = cv2.blur(frame, (5, 5))
 
-        # Convert to binary image
-        _, thresh1 = cv2.threshold(blur, 168, 255, cv2.THRESH_BINARY)
-        hsv = cv2.cvtColor(thresh1, cv2.COLOR_RGB2HSV)
+            # Convert to binary image
+            _, thresh1 = cv2.threshold(blur, 168, 255, cv2.THRESH_BINARY)
+            hsv = cv2.cvtColor(thresh1, cv2.COLOR_RGB2HSV)
 
-        # Define range of white color in HSV
-        lower_white = np.array([0, 0, 168])
-        upper_white = np.array([172, 111, 255])
+            # Define range of white color in HSV
+            lower_white = np.array([0, 0, 168])
+            upper_white = np.array([172, 111, 255])
 
-        # Threshold the HSV image
-        mask = cv2.inRange(hsv, lower_white, upper_white)
+            # Threshold the HSV image
+            mask = cv2.inRange(hsv, lower_white, upper_white)
+
+        if self.mode == "scanline":
+            return self.scan_lines(frame, mask)
 
         # Remove noise
         eroded_mask = cv2.erode(mask, self.kernel_erode, iterations=1)
@@ -59,6 +97,8 @@ class LineFollower:
                 centroid = (self.cx, self.cy)
 
         # Calculate distance if centroid found
+        self.line_found = centroid is not None
+        self.confidence = 1.0 if self.line_found else 0.0
         if centroid is not None:
             center_x = w // 2
             self.distance = center_x - centroid[0]
@@ -66,6 +106,49 @@ class LineFollower:
 
         return frame
 
+    def scan_lines(self, frame, mask):
+        """Scanline estimator: no filtering of the whole mask, only a few rows are looked at."""
+        h, w = mask.shape[:2]
+        if self._white is None or self._white.shape != (len(self.scan_rows), w + 2):
+            self._rows = (np.asarray(self.scan_rows) * (h - 1)).astype(np.intp)
+            self._white = np.zeros((len(self.scan_rows), w + 2), bool)  # keeps a black border around each row
+        rows, white = self._rows, self._white
+        # Transitions of every row at once; with the black border they alternate start, end
+        np.greater(mask[rows], 0, out=white[:, 1:-1])
+        transitions = np.flatnonzero(white[:, 1:] != white[:, :-1])
+        run_rows, starts = np.divmod(transitions[0::2], w + 1)
+        widths = transitions[1::2] - transitions[0::2]
+        keep = (widths >= self.min_run) & (widths <= self.max_run * w)
+
+        # Centre of the widest run of each row (a handful of runs at most)
+        centres = {}
+        for row, start, width in zip(run_rows[keep].tolist(), starts[keep].tolist(), widths[keep].tolist()):
+            if width > centres.get(row, (0, 0))[0]:
+                centres[row] = (width, start + (width - 1) / 2)
+        ys = [float(rows[row]) for row in centres]
+        xs = [centre for _, centre in centres.values()]
+
+        self.line_found = len(xs) > 0
+        if not self.line_found:
+            self.confidence = 0.0
+            return frame
+        # Least squares line x = slope * y + intercept, the distance is taken at the middle of the rows found
+        y_ref, x_ref = sum(ys) / len(ys), sum(xs) / len(xs)
+        spread = sum((y - y_ref) ** 2 for y in ys)
+        slope = sum((y - y_ref) * (x - x_ref) for x, y in zip(xs, ys)) / spread if spread else 0.0
+        residual = math.sqrt(sum((x_ref + slope * (y - y_ref) - x) ** 2 for x, y in zip(xs, ys)) / len(xs))
+        self.heading = math.atan(slope)
+        self.cx, self.cy = int(round(x_ref)), int(y_ref)
+        self.distance = w // 2 - self.cx
+        # Fewer rows or a bent line: less trust in the measurement
+        self.confidence = len(xs) / len(rows) * math.exp(-residual / 4.0)
+        logging.debug(f"Scanline: distance {self.distance}, heading {math.degrees(self.heading):.1f}deg, "
+                      f"confidence {self.confidence:.2f}")
+
+        for x, y in zip(xs, ys):
+            cv2.circle(frame, (int(x), int(y)), 2, (0, 255, 0), -1)
+        return frame
+
     def direct_to_line(self):
         """Direct the vehicle based on line position."""
         threshold = 10  # Small threshold to account for minor deviations
@@ -79,11 +162,15 @@ class LineFollower:
             logging.debug("Turn right")
             self.motor_control("right")
             
-    def apply_control(self, motor_left, motor_right, urkab):
-        """Direct the vehicle based on line position."""
-        
+    def apply_control(self, motor_left, motor_right, urkab, distance=None):
+        """
+        Direct the vehicle based on line position.
+        distance: line position the motor values were computed from, the one of the last frame if None.
+        """
+        if distance is None:
+            distance = self.distance
         threshold = 1.5  # Small threshold to account for minor deviations
-        if abs(self.distance) <= threshold:
+        if abs(distance) <= threshold:
             logging.debug("Go straight")
             urkab.executeDirection("straight")
         else :
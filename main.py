@@ -1,20 +1,57 @@
 import argparse
+import atexit
+import os
 import cv2
+import numpy as np
 import time
 import logging
 
 from graphe_go_brrrrr import *
-from croisement import detect_intersections  # Import intersection detection function
+from croisement import detect_intersections, IntersectionTracker  # Import intersection detection function
 from line_detection import LineFollower
-from car_lib import Urkab
-from picamera import PiCamera
-from picamera.array import PiRGBArray
+from vision import VisionPipeline
+from vision_workers import VisionWorkers
+from color_lut import ColorLUT
+from car_lib import Urkab, TURNING_CONST
+from camera_stream import FrameGrabber, PiCameraSource, YUVFrame
 from PID import PIDController
+from control import ControlScheduler
+from debug_stream import FrameStreamer
+import communication
+from communication import CommandClient, DIRECTIONS
+from replanner import IncrementalPlanner
+from route_service import RouteService
+from instrumentation import NULL_TIMER, StageTimer
+from recorder import FrameRecorder
+from telemetry import TelemetryPublisher, EVENT_INTERSECTION, EVENT_TURN, EVENT_OBSTACLE, EVENT_HOLD
+from tour import Tour, TourPlanner
 from time import sleep
 
 DEBUG = False
 USE_ARGS = False
 DEACT_EMERGENCY_STOP = False
+ASYNC_SERIAL = True  # motor commands are queued and coalesced instead of waiting for each acknowledgement
+TURN_STOP_ON_LINE = False  # end the turns as soon as the line is seen again instead of at the target angle
+CAPTURE_FORMAT = "bgr"  # "yuv": the vision works on the luma plane, colour is only decoded to display or record
+HEADLESS = not os.environ.get("DISPLAY")  # no display window (no X session on the car, replays on a server...)
+STREAM_PORT = None  # e.g. 5556: publish the annotated frames as JPEG for debug_stream.py on a remote machine
+STREAM_RATE = 5.0  # frames per second streamed
+TELEMETRY_PORT = None  # e.g. 5007: publish the state of the loop in binary batches for telemetry.py
+TELEMETRY_RATE = 5.0  # batches per second
+REMOTE_SERVER = None  # e.g. communication.server_ip: take the next destinations from the command server
+RECORD_PATH = None  # e.g. "drive.npy": record the frames and the control state of the drives (see recorder.py)
+TIMINGS_PATH = "timings.json"  # latency histograms of the loop stages, written at exit (None to not time the loop)
+TIMINGS_LOG_INTERVAL = 10.0  # seconds between two summary lines of the timings
+CONTROL_RATE = 50.0  # Hz of the PID thread, None to run the PID once per frame in the main loop
+LINE_ESTIMATOR = "contour"  # "scanline": line position and heading from a few rows, much cheaper than contours
+HEADING_GAIN = 0  # PID gain on the heading of the line (scanline estimator only), e.g. 60 to follow faster
+DERIVATIVE_TAU = 0.05  # seconds, low-pass filter of the PID derivative against the jumpy line position, 0 for none
+LINE_LUT_PATH = None  # e.g. "line_lut.npz" built by color_lut.py: calibrated line mask instead of thresholds
+VISION_WORKERS = False  # line and intersections processed in parallel by two worker processes (other cores)
+INTERSECTION_TRACKING = False  # follow the next intersection in a small region instead of searching each frame
+
+# Fewest expected seconds rather than fewest edges: turns cost their TURNING_CONST share of a full turn
+MOVE_COSTS = MoveCosts(turn=TURNING_CONST * 90 / 360, uturn=TURNING_CONST * 180 / 360)
 
 
 # Define the motor control function
@@ -36,9 +73,14 @@ def parse_arguments():
     parser.add_argument("--start", type=int, nargs=2, required=True, help="Starting coordinates as two integers")
     parser.add_argument("--end", type=int, nargs=2, required=True, help="Ending coordinates as two integers")
     parser.add_argument("--dir_init", type=int, nargs=2, required=True, help="Initial direction as a tuple of two integers")
+    parser.add_argument("--stops", type=int, nargs="+", default=[],
+                        help="Other stops to deliver along with the end, as X Y pairs, visited in the fastest order")
 
     args = parser.parse_args()
-    return args.size, tuple(args.start), tuple(args.end), tuple(args.dir_init)
+    if len(args.stops) % 2:
+        parser.error("--stops needs X Y pairs")
+    stops = [tuple(args.stops[i:i + 2]) for i in range(0, len(args.stops), 2)]
+    return args.size, tuple(args.start), tuple(args.end), tuple(args.dir_init), stops
 
 
 # getting th initial input
@@ -58,7 +100,7 @@ def get_user_input():
     dir_init_y = int(input("Enter the initial direction Y component: "))
     dir_init = (dir_init_x, dir_init_y)
 
-    return size, start, end, dir_init
+    return size, start, end, dir_init, []
 
 #getting the input if the user wants to ga again
 def prompt_user_again():
@@ -70,44 +112,119 @@ def prompt_user_again():
     else:
         return False, (0.0,0.0)
 
+# getting the next destination from the command server instead
+def wait_remote_command(commands, start, current_dir):
+    """
+    Execute the commands of the server until one sets a new end ('e x y').
+    Returns the start and direction to go from (changed by 's x y' and the facing commands) and the new end.
+    """
+    communication.start_position, communication.direction = None, None
+    commands.send({"type": "status", "position": list(start), "heading": list(current_dir)})
+    while True:
+        command = commands.get()
+        commands.stop_requested.clear()  # nothing to stop while waiting
+        communication.execute_command(command)
+        if command.startswith('e '):
+            start = communication.start_position or start
+            current_dir = DIRECTIONS.get(communication.direction, current_dir)
+            return start, current_dir, communication.end_position
+
 def initialize():
     if DEBUG:
-        logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.DEBUG)
+        logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.DEBUG, force=True)
     else:
-        logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+        logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO, force=True)
     if USE_ARGS:
         # Parse arguments from the terminal
-        size, start, end, dir_init = parse_arguments()
+        size, start, end, dir_init, stops = parse_arguments()
     else:
-        size, start, end, dir_init = get_user_input()
+        size, start, end, dir_init, stops = get_user_input()
+    urkab, line_follower, PID_control = initialize_car()
+
+    return size, start, end, dir_init, stops, urkab, line_follower, PID_control
+
+def initialize_car():
+    """Connect to the Arduino and build the line follower and its PID."""
     # Initialize motor controller and line follower with motor control function
-    urkab = Urkab()
+    urkab = Urkab(async_link=ASYNC_SERIAL)
     if DEACT_EMERGENCY_STOP:
         urkab.carDeactivateEmergencyStop()
     else:
         urkab.carResetEmergencyStop()
-    line_follower = LineFollower(motor_control=motor_control)
-    PID_control = PIDController(3, 0.4, 1.2, 255, 0)  # values: kp, ki, kd, base_speed, setpoint
-
-    return size, start, end, dir_init, urkab, line_follower, PID_control
-
-def go_somewhere(size, start, end, dir_init, urkab, line_follower, PID_control):
+    line_follower = LineFollower(motor_control=motor_control, mode=LINE_ESTIMATOR)
+    # values: kp, ki, kd, base_speed, setpoint; the integral term is bounded to 100 of the 255 of a motor
+    PID_control = PIDController(3, 0.4, 1.2, 255, 0, integral_limit=100, derivative_tau=DERIVATIVE_TAU,
+                                kh=HEADING_GAIN)
+    return urkab, line_follower, PID_control
+
+def camera_grabber():
+    """Frame grabber of the Pi camera, not started."""
+    return FrameGrabber(PiCameraSource(resolution=(160, 128), framerate=32, format=CAPTURE_FORMAT))
+
+def vision_workers(grabber, line_follower):
+    """Vision worker processes for the frames of grabber (VISION_WORKERS), not started."""
+    width, height = grabber.source.resolution
+    luma_only = grabber.format == "yuv" and not LINE_LUT_PATH  # as in go_somewhere
+    shape = (height, width) if luma_only else (height, width, 3)
+    return VisionWorkers(shape, line_follower.mode, INTERSECTION_TRACKING, LINE_LUT_PATH)
+
+def go_somewhere(size, start, end, dir_init, urkab, line_follower, PID_control, routes=None, itinerary=None,
+                 departures=None, grabber=None, timer=NULL_TIMER, recorder=None, streamer=None, commands=None,
+                 telemetry=None, workers=None):
+    """
+    Drive from start to end, starting in the direction dir_init.
+    routes: RouteService kept between trips so repeated itineraries are not planned again.
+    itinerary: edges of an itinerary already planned from start to end (e.g. a delivery tour), planned here if None.
+    departures: earliest time of each direction in seconds from now (AgentPlan.schedule() of the fleet planner),
+    the car waits at the intersection when it is early so the other cars can pass.
+    grabber: frame grabber to read the frames from (e.g. replay.ReplayGrabber), the Pi camera if None. A grabber
+    already running is left running at the end, so the camera stays warm between trips (nav_daemon.py).
+    timer: instrumentation.StageTimer measuring the latency of each stage of the loop.
+    recorder: recorder.FrameRecorder saving each frame processed with the state of the loop.
+    streamer: debug_stream.FrameStreamer publishing the annotated frames.
+    commands: communication.CommandClient, a "stop" from the server ends the itinerary.
+    telemetry: telemetry.TelemetryPublisher sent one sample per frame.
+    workers: started vision_workers() of the grabber, left running at the end. With VISION_WORKERS and no workers,
+    they are started for this trip only.
+    Returns (arrived, node, heading): whether end was reached, the last intersection passed (end when arrived)
+    and the absolute direction the car had when it got there.
+    """
     logging.debug(f"Called go_somewhere with size {size}, start {start}, end {end}, dir_init {dir_init}")
+    urkab.setTimer(timer)
     previous_time = time.perf_counter()
-    delta_time = 0.1
-
-    # Initialize the PiCamera
-    camera = PiCamera()
-    camera.resolution = (160, 128)
-    camera.framerate = 32
-    raw_capture = PiRGBArray(camera, size=camera.resolution)
-    sleep(0.1)  # Allow the camera to warm up
-
-    # Initialize the itinerary
-    g = grid_to_adjacency_matrix(size)
-    itin = bfs_with_edges_from_matrix(g, start, end, size)
-    absolute_path = dir_list_absolute(itin)
-    dir_l = dir_list(absolute_path, dir_init)
+    start_time = previous_time
+    delta_time = 0.1  # measured duration of the previous loop iteration, for the PID run in the loop
+
+    # Initialize the itinerary, nothing is started when there is nothing to drive
+    if routes is None:
+        routes = RouteService(size, MOVE_COSTS)
+    itin = routes.route(start, end, dir_init) if itinerary is None else list(itinerary)
+    if not itin:
+        if tuple(start) == tuple(end):
+            logging.info(f"Already at {tuple(end)}")
+            return True, tuple(start), tuple(dir_init)
+        logging.warning(f"No itinerary from {tuple(start)} to {tuple(end)}")
+        return False, tuple(start), tuple(dir_init)
+
+    # Start capturing frames from the PiCamera on a separate thread
+    keep_grabber = grabber is not None and grabber.running
+    if grabber is None:
+        grabber = camera_grabber()
+    if not keep_grabber:
+        grabber.start()
+
+    # Shared front end: grayscale, edges and white mask are computed once per frame
+    vision = VisionPipeline(lut=ColorLUT.load(LINE_LUT_PATH) if LINE_LUT_PATH else None)
+    yuv = grabber.format == "yuv"
+    # In YUV the frames are only converted to BGR when something shows or keeps them (or for the color table)
+    need_color = not HEADLESS or recorder is not None or streamer is not None or vision.lut is not None
+    resolution = grabber.source.resolution
+    bgr_buffer = np.empty((resolution[1], resolution[0], 3), np.uint8) if yuv and need_color else None
+    luma_only = yuv and vision.lut is None  # the vision only needs the luma plane
+
+    # The planner keeps its search state so a blocked street only needs a local repair
+    planner = IncrementalPlanner(routes.graph, start, end, dir_init, routes.costs, edges=itin)
+    dir_l = list(planner.directions)
     logging.info(f"Initial itinerary: {dir_l}")
 
     # Initialize intersection tracking
@@ -115,24 +232,143 @@ def go_somewhere(size, start, end, dir_init, urkab, line_follower, PID_control):
     previous_intersection = False
     frames_without_intersection = 0  # Counter for consecutive frames without intersection
     direction_index = 0
-
-    # Set the initial direction
+    arrived = False
+    flipping = False  # U-turn away from an obstacle in progress
+    motor_left, motor_right = 0, 0
+    # Predicts where the intersection will be in the next frame and tells when the car drives onto it
+    tracker = IntersectionTracker() if INTERSECTION_TRACKING else None
+    previous_frame_time = None
+
+    keep_workers = workers is not None
+    if workers is None and VISION_WORKERS:
+        workers = vision_workers(grabber, line_follower).start()
+
+    control = None
+    if CONTROL_RATE:
+        # The PID runs on its own thread at a fixed rate, fed with the line measurement of the latest frame
+        def apply(left, right, distance):
+            line_follower.apply_control(left, right, urkab, distance)
+        control = ControlScheduler(PID_control, apply, urkab.carStop, rate=CONTROL_RATE, timer=timer).start()
+
+    def take_motors():
+        """The loop is about to command the motors itself (turn, stop): take them back from the PID thread."""
+        if control is not None:
+            control.pause()
+
+    def hold_time(index):
+        """Seconds to wait before executing direction index to keep to the fleet schedule."""
+        if departures is None or index >= len(departures):
+            return 0.0
+        return departures[index] - (time.perf_counter() - start_time)
+
+    # Set the initial direction, turns run while the frames keep being processed
     logging.debug(f"Starting initial positioning, direction is: {dir_l[direction_index]}")
-    urkab.executeDirection(dir_l[direction_index])
-    logging.debug(f"Should have oriented now... Amen.")
+    turn = None
+    hold_until = None  # while set, the car waits at the intersection for its departure time
+    if hold_time(direction_index) > 0:
+        hold_until = time.perf_counter() + hold_time(direction_index)
+    else:
+        turn = urkab.executeDirection(dir_l[direction_index], blocking=False, stop_on_line=TURN_STOP_ON_LINE)
 
     try:
 
-        # Capture frames continuously from the camera
-        for frame in camera.capture_continuous(raw_capture, format="bgr", use_video_port=True):
+        # Always process the newest frame, the ones we were too slow for are dropped by the grabber
+        while True:
+            timer.begin()
+            frame = grabber.read()
+            timer.lap("capture")
+            if frame is None:
+                if not grabber.running:
+                    logging.warning("Camera stopped, leaving the itinerary")
+                    break
+                logging.warning("No frame received from the camera")
+                continue
             logging.debug("----------Processing frame...----------")
-            image = frame.array  # Get the current frame as an array
+            frame_seq, frame_time, image = frame
+            urkab.origin = frame_time  # the commands sent from now on answer this frame
+            if yuv:
+                yuv_frame = YUVFrame(image, resolution, dst=bgr_buffer)
+                # Without color the annotations are drawn on the luma plane, once the features are computed
+                image = yuv_frame.bgr() if need_color else yuv_frame.y
+                timer.lap("decode")
+
+            if commands is not None and commands.stop_requested.is_set():
+                commands.stop_requested.clear()
+                logging.warning("Stop requested by the command server")
+                take_motors()
+                urkab.carStop()
+                break
 
-            intersection_detected = detect_intersections(image)
+            # With the async serial link, obstacles reported by the Arduino arrive here instead of as exceptions
+            obstacle = urkab.pollObstacle()
+            events = EVENT_OBSTACLE if obstacle is not None else 0
+            if obstacle is not None and flipping:
+                # The obstacle we are turning away from, still in front while the U-turn starts
+                logging.debug(f"Obstacle report ignored during the U-turn: {obstacle}")
+            elif obstacle is not None:
+                # The street we are driving is blocked: turn back and take the repaired itinerary
+                take_motors()
+                blocked = planner.nodes[direction_index], planner.nodes[direction_index + 1]
+                splice_index, new_directions = planner.turn_back(direction_index)
+                if blocked[0] != blocked[1]:  # not on the way back of a previous obstacle
+                    routes.remove_edge(*blocked)
+                dir_l[splice_index:] = new_directions
+                if direction_index + 1 >= len(dir_l):
+                    logging.warning(f"Stopping the itinerary, no way around the obstacle: {obstacle}")
+                    urkab.carStop()
+                    break
+                logging.warning(f"Obstacle on the way, turning back. New itinerary from {splice_index}: {new_directions}")
+                if departures is not None:
+                    logging.warning("Leaving the fleet schedule, the repaired itinerary was not coordinated")
+                    departures = None
+                hold_until = None
+                # The obstacle detection would cut the motors again while the obstacle is in front: off for the
+                # U-turn, re-armed once the car faces the other way
+                urkab.carDeactivateEmergencyStop()
+                turn = urkab.executeDirection("do_a_flip", blocking=False)
+                flipping = True
+                previous_intersection = False
+                frames_without_intersection = 0
+            # No intersection bookkeeping while turning on one or waiting on it
+            on_intersection = turn is not None or hold_until is not None
+            intersection_passed = False  # the tracked intersection went under the car
+            if workers is not None:
+                # The line and the intersections of this frame are processed in parallel by the workers
+                result = None
+                if workers.submit(frame_seq, frame_time, yuv_frame.y if luma_only else image, reset=on_intersection):
+                    result = workers.collect(frame_seq)
+                timer.lap("vision")
+                if result is None:
+                    logging.warning("No result of the vision workers, skipping the frame")
+                    continue
+                line_follower.set_measurement(*result.line)
+                intersection_detected = result.intersections if not on_intersection else []
+                intersection_passed = result.passed
+                for point in intersection_detected:
+                    cv2.circle(image, point, 5, (0, 0, 255), -1)
+            else:
+                features = vision.process_luma(yuv_frame.y) if luma_only else vision.process(image)
+                timer.lap("vision")
+                if on_intersection:
+                    intersection_detected = []
+                    if tracker is not None:
+                        tracker.reset()
+                elif tracker is not None:
+                    frame_dt = frame_time - previous_frame_time if previous_frame_time is not None else 1 / 32
+                    intersection_detected = tracker.update(image, features.edges, frame_dt)
+                    intersection_passed = tracker.passed
+                    if intersection_detected:
+                        logging.debug(f"Intersection in {tracker.distance:.0f} rows, "
+                                      f"confidence {tracker.confidence:.2f}")
+                else:
+                    intersection_detected = detect_intersections(image, edges=features.edges)
+            previous_frame_time = frame_time
+            timer.lap("intersections")
             # Check for intersection
             if intersection_detected:
                 if not previous_intersection: logging.info("Intersection detected!")
                 if DEBUG:
+                    take_motors()
                     urkab.carStop()
                     sleep(0.5)  # Pause for 1 second
                 frames_without_intersection = 0  # Reset the no-intersection counter
@@ -143,8 +379,10 @@ def go_somewhere(size, start, end, dir_init, urkab, line_follower, PID_control):
                 frames_without_intersection += 1  # Increment the no-intersection counter
                 logging.debug(f"Frames without intersection: {frames_without_intersection}")
 
-                # If we have two consecutive frames without detecting an intersection, proceed to the next direction
-                if frames_without_intersection >= 2:
+                # If we have two consecutive frames without detecting an intersection, or the tracked intersection
+                # went under the car, proceed to the next direction
+                if frames_without_intersection >= 2 or intersection_passed:
+                    take_motors()
                     previous_intersection = False
                     frames_without_intersection = 0  # Reset the counter
                     direction_index += 1  # Move to the next direction in dir_l
@@ -157,56 +395,223 @@ def go_somewhere(size, start, end, dir_init, urkab, line_follower, PID_control):
                     if direction_index >= len(dir_l):
                         logging.info("End of itinerary reached. Stopping the car.")
                         urkab.carStop()
+                        arrived = True
                         break
+                    elif hold_time(direction_index) > 0:
+                        logging.info(f"Early at the intersection, waiting {hold_time(direction_index):.1f}s")
+                        urkab.carStop()
+                        hold_until = time.perf_counter() + hold_time(direction_index)
                     else:
-                        urkab.executeDirection(dir_l[direction_index])
+                        turn = urkab.executeDirection(dir_l[direction_index], blocking=False,
+                                                      stop_on_line=TURN_STOP_ON_LINE)
                         logging.info(f"Moving in direction: {dir_l[direction_index]}")
 
-            # Process the frame for line detection
-            processed_frame = line_follower.process_frame(image)
+            if hold_until is not None and time.perf_counter() >= hold_until:
+                hold_until = None
+                turn = urkab.executeDirection(dir_l[direction_index], blocking=False, stop_on_line=TURN_STOP_ON_LINE)
+                logging.info(f"Moving in direction: {dir_l[direction_index]}")
 
-            # Direct the robot based on line detection results
-            motor_left, motor_right = PID_control.update(delta_time,
-                                                         line_follower.get_attributes())  # calculates control motor inputs
-            line_follower.apply_control(motor_left, motor_right, urkab)
+            # Process the frame for line detection (done by the workers already)
+            if workers is None:
+                processed_frame = line_follower.process_frame(image, mask=features.line_mask)
+                timer.lap("line")
+            else:
+                processed_frame = image
+
+            if control is not None:
+                control.update_measurement(line_follower.get_attributes(), frame_time, line_follower.heading)
+
+            if hold_until is not None:
+                pass  # stopped until the departure time
+            elif turn is not None:
+                # The motors belong to the turn until it is over
+                if turn.poll(line_follower.line_found):
+                    logging.debug("Should have oriented now... Amen.")
+                    turn = None
+                    if flipping:
+                        flipping = False
+                        if not DEACT_EMERGENCY_STOP:
+                            urkab.carResetEmergencyStop()
+            elif control is not None:
+                control.resume()  # the PID thread drives until the next turn
+                motor_left, motor_right = control.output
+            else:
+                # Direct the robot based on line detection results
+                distance = line_follower.get_attributes()
+                motor_left, motor_right = PID_control.update(delta_time,
+                                                             distance,
+                                                             line_follower.heading)  # calculates control motor inputs
+                line_follower.apply_control(motor_left, motor_right, urkab, distance)
+            timer.lap("control")
+
+            if recorder is not None:
+                recorder.write(image, frame_time, line_follower.distance, motor_left, motor_right, direction_index)
+                timer.lap("record")
+            if telemetry is not None:
+                if intersection_detected:
+                    events |= EVENT_INTERSECTION
+                if turn is not None:
+                    events |= EVENT_TURN
+                if hold_until is not None:
+                    events |= EVENT_HOLD
+                telemetry.add(frame_time, line_follower.distance, PID_control.output, motor_left, motor_right,
+                              direction_index, events, urkab.serialRtt())
+                timer.lap("telemetry")
 
             current_time = time.perf_counter()
             delta_t = current_time - previous_time
             previous_time = current_time
-
-            # Display the processed frame for visual feedback
-            cv2.imshow("Line Following", processed_frame)
-
-            # Press 'q' to quit the loop early
-            if cv2.waitKey(1) & 0xFF == ord('q'):
-                break
-
-            # Clear the stream for the next frame
-            raw_capture.truncate(0)
-
+            timer.record("frame_to_command", current_time - frame_time)
+            timer.record("loop_period", delta_t)
+            delta_time = delta_t
+
+            if streamer is not None:
+                streamer.offer(processed_frame, frame_time)  # a copy at most STREAM_RATE times per second
+            if not HEADLESS:
+                # Display the processed frame for visual feedback
+                cv2.imshow("Line Following", processed_frame)
+
+                # Press 'q' to quit the loop early
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
+                timer.lap("display")
+            timer.tick()
+
+    except Exception as e:
+        logging.exception(f"Leaving the itinerary after an error: {e}")
+        urkab.carStop()
     finally:
-        camera.close()
-        current_abs_dir = absolute_path[direction_index-1]
+        if control is not None:
+            control.stop()
+        if workers is not None and not keep_workers:
+            workers.stop()
+        if not keep_grabber:
+            grabber.stop()
+    # The last intersection passed, and the heading the car had on the edge leading there
+    node = planner.nodes[min(direction_index, len(planner.nodes) - 1)]
+    current_abs_dir = tuple(planner.headings[direction_index - 1]) if direction_index > 0 else tuple(dir_init)
+    if arrived:
         logging.info(f"Arrived! Current absolute direction after finishing go_somewhere: {current_abs_dir}")
-        return current_abs_dir
+    else:
+        logging.warning(f"Itinerary not finished, last intersection passed {node} heading {current_abs_dir}")
+    return arrived, node, current_abs_dir
+
+def go_tour(size, start, stops, dir_init, urkab, line_follower, PID_control, routes, recorder=None,
+            timer=NULL_TIMER, streamer=None, telemetry=None, grabber=None, commands=None, workers=None):
+    """
+    Deliver every stop in the fastest order, one go_somewhere per stop: a detour only repairs the way to the next
+    stop, then the remaining stops are ordered again from where the car is.
+    Returns (arrived, node, heading) as go_somewhere, arrived once every stop was reached.
+    """
+    tours = TourPlanner(routes)
+    node, heading = tuple(start), tuple(dir_init)
+    remaining = [tuple(stop) for stop in stops]
+    tour = None
+    # The camera and the vision workers keep running from one stop to the next
+    own_grabber = grabber is None
+    if own_grabber:
+        grabber = camera_grabber()
+    own_workers = workers is None and VISION_WORKERS
+    if own_workers:
+        workers = vision_workers(grabber, line_follower).start()
+    if own_grabber:
+        grabber.start()
+    try:
+        while True:
+            if tour is None:
+                tour = tours.plan(node, remaining, heading)
+                if tour is None:
+                    logging.warning(f"No tour from {node}, dropping the stops {remaining}")
+                    return False, node, heading
+                remaining = list(tour.order)  # a stop where the car already is counts as delivered
+                version = routes.version
+                logging.info(f"Tour order: {tour.order}, expected time {tour.cost:.1f}s, itinerary: {tour.dir_list()}")
+            if not remaining:
+                return True, node, heading
+            stop, leg_end = tour.order[0], tour.stop_indices[0]
+            arrived, node, heading = go_somewhere(size, node, stop, heading, urkab, line_follower, PID_control, routes,
+                                                  itinerary=tour.edges[:leg_end], grabber=grabber, recorder=recorder,
+                                                  timer=timer, streamer=streamer, commands=commands,
+                                                  telemetry=telemetry, workers=workers)
+            if not arrived:
+                logging.warning(f"Tour interrupted before {stop}, stops not delivered: {remaining}")
+                return False, node, heading
+            remaining.remove(stop)
+            logging.info(f"Stop {stop} delivered, {len(remaining)} left")
+            if routes.version != version:
+                tour = None  # the map changed on the way, the rest of the tour may not be the fastest anymore
+            else:
+                tour = Tour(tour.order[1:], tour.edges[leg_end:], [i - leg_end for i in tour.stop_indices[1:]],
+                            tour.cost, heading)
+    finally:
+        if own_grabber:
+            grabber.stop()
+        if own_workers:
+            workers.stop()
 
 if __name__ == '__main__':
+    recorder = streamer = commands = telemetry = grabber = workers = None
     try:
-        size, start, end, dir_init, urkab, line_follower, PID_control = initialize()
+        size, start, end, dir_init, stops, urkab, line_follower, PID_control = initialize()
+        routes = RouteService(size, MOVE_COSTS)
+        # The camera and the vision workers run for the whole session, the workers start before any thread
+        grabber = camera_grabber()
+        workers = vision_workers(grabber, line_follower).start() if VISION_WORKERS else None
+        grabber.start()
+        recorder = FrameRecorder(RECORD_PATH) if RECORD_PATH else None
+        streamer = FrameStreamer(STREAM_PORT, STREAM_RATE).start() if STREAM_PORT else None
+        commands = CommandClient(REMOTE_SERVER).start() if REMOTE_SERVER else None
+        telemetry = TelemetryPublisher(TELEMETRY_PORT, TELEMETRY_RATE) if TELEMETRY_PORT else None
+        timer = NULL_TIMER
+        if TIMINGS_PATH:
+            timer = StageTimer(log_interval=TIMINGS_LOG_INTERVAL)
+            atexit.register(timer.dump, TIMINGS_PATH)
         logging.info("Starting to goooooo...")
-        current_dir = go_somewhere(size, start, end, dir_init, urkab, line_follower, PID_control)
+        if stops:
+            arrived, position, current_dir = go_tour(size, start, [end] + stops, dir_init, urkab, line_follower,
+                                                     PID_control, routes, recorder, timer, streamer, telemetry,
+                                                     grabber, commands, workers)
+        else:
+            arrived, position, current_dir = go_somewhere(size, start, end, dir_init, urkab, line_follower,
+                                                          PID_control, routes, grabber=grabber, recorder=recorder,
+                                                          timer=timer, streamer=streamer, commands=commands,
+                                                          telemetry=telemetry, workers=workers)
         while True:
-            go_again, new_end = prompt_user_again()
+            if not arrived:
+                logging.warning(f"Not at the destination, going on from the last intersection passed {position}")
+            if commands is not None:
+                start, current_dir, new_end = wait_remote_command(commands, position, current_dir)
+                go_again = True
+            else:
+                go_again, new_end = prompt_user_again()
+                start = position
             logging.debug(f"Am I going again? {go_again}, new end is: {new_end}")
             if go_again:
-                start = end
                 end = new_end
-                current_dir = go_somewhere(size, start, end, current_dir, urkab, line_follower, PID_control)
+                arrived, position, current_dir = go_somewhere(size, start, end, current_dir, urkab, line_follower,
+                                                              PID_control, routes, grabber=grabber,
+                                                              recorder=recorder, timer=timer, streamer=streamer,
+                                                              commands=commands, telemetry=telemetry, workers=workers)
+                logging.debug(f"Route cache: {routes.stats()}")
             else:
                 break
 
     except KeyboardInterrupt:
         urkab.carStop()
         urkab.carDisconnect()
-        cv2.destroyAllWindows()
-        logging.info("Program terminated by user.")
\ No newline at end of file
+        if not HEADLESS:
+            cv2.destroyAllWindows()
+        logging.info("Program terminated by user.")
+    finally:
+        if grabber is not None:
+            grabber.stop()
+        if workers is not None:
+            workers.stop()
+        if recorder is not None:
+            recorder.close()
+        if streamer is not None:
+            streamer.stop()
+        if commands is not None:
+            commands.stop()
+        if telemetry is not None:
+            telemetry.close()
\ No newline at end of file
@@ -0,0 +1,307 @@
+import argparse
+import logging
+import queue
+import threading
+import time
+
+import zmq
+
+import main
+from communication import encode, decode, DIRECTIONS
+from debug_stream import FrameStreamer
+from instrumentation import NULL_TIMER, StageTimer
+from recorder import FrameRecorder
+from route_service import RouteService
+from telemetry import TelemetryPublisher
+from tour import TourPlanner
+
+NAV_ADDRESS = "ipc:///tmp/highfive-nav"  # local socket of the daemon
+
+# Requests, one JSON object answered by one JSON object with "ok" (and "error" when false):
+#   {"cmd": "go", "end": [x, y]}                 queue a trip to end
+#   {"cmd": "tour", "stops": [[x, y], ...]}      queue a delivery tour, the stops in the fastest order
+#   {"cmd": "plan", "nodes": [[x, y], ...], "departures": [s, ...]}   drive an AgentPlan of fleet.py now, when
+#                                                idle: departures[i] is AgentPlan.schedule()[i], the earliest
+#                                                time in seconds the car leaves nodes[i]
+#   {"cmd": "set", "position": [x, y], "heading": [dx, dy]}   where the car is, when idle
+#   {"cmd": "status"}
+#   {"cmd": "stop"}                              stop the current trip and drop the queued ones
+#   {"cmd": "shutdown"}
+
+
+class NavigationDaemon:
+    """
+    Keeps the camera capturing and the Arduino link open between trips, and takes the trips from a local
+    ZMQ REP socket instead of input(): a trip starts on the next frame of the running grabber, without the
+    camera warm up nor the serial handshake.
+    The trips run one after the other on the thread calling run(), the requests are served by another thread.
+    """
+    def __init__(self, size, position, heading, urkab, line_follower, PID_control, grabber, address=NAV_ADDRESS,
+                 timer=NULL_TIMER, recorder=None, streamer=None, telemetry=None, workers=None):
+        self.size = size
+        self.position = tuple(position)
+        self.heading = tuple(heading)
+        self.urkab = urkab
+        self.line_follower = line_follower
+        self.PID_control = PID_control
+        self.grabber = grabber
+        self.address = address
+        self.timer = timer
+        self.recorder = recorder
+        self.streamer = streamer
+        self.telemetry = telemetry
+        self.workers = workers  # started main.vision_workers() of the grabber, stopped by close()
+        self.routes = RouteService(size, main.MOVE_COSTS)
+
+        self.stop_requested = threading.Event()  # read by go_somewhere, as CommandClient.stop_requested
+        self.trips = queue.Queue()  # (generation, request)
+        self.current = None         # request of the trip being driven
+        self._generation = 0        # incremented by each stop, the trips queued before it are not driven
+        self._lock = threading.Lock()  # between taking a trip and a stop
+        self.completed = 0
+        self.position_known = True  # False after a trip not finished: the car is somewhere on the way
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        if not self.grabber.running:
+            self.grabber.start()
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, name="NavigationDaemon", daemon=True)
+        self._thread.start()
+        logging.info(f"Navigation daemon listening on {self.address}, at {self.position} facing {self.heading}")
+        return self
+
+    def close(self):
+        self._running = False
+        self.stop_requested.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+            self._thread = None
+        self.grabber.stop()
+        if self.workers is not None:
+            self.workers.stop()
+        self.urkab.carStop()
+
+    def run(self):
+        """Drive the queued trips until shutdown."""
+        while self._running:
+            try:
+                generation, request = self.trips.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            with self._lock:
+                if generation != self._generation:
+                    logging.info(f"Trip {request} dropped, stopped before it started")
+                    continue
+                # A stop from now on finds the trip current, and its stop_requested is not cleared by this one
+                self.current = request
+                self.stop_requested.clear()
+            started = time.perf_counter()
+            try:
+                self._drive(request)
+            except Exception as e:
+                logging.error(f"Trip {request} failed: {e}")
+                self.urkab.carStop()
+                self.position_known = False
+            finally:
+                with self._lock:
+                    self.current = None
+            logging.info(f"Trip {request} over in {time.perf_counter() - started:.1f}s, at {self.position} "
+                         f"facing {self.heading}")
+
+    def _drive(self, request):
+        common = dict(grabber=self.grabber, timer=self.timer, recorder=self.recorder, streamer=self.streamer,
+                      commands=self, telemetry=self.telemetry, workers=self.workers)
+        # An unreachable destination is refused before driving: the car stays where it is, position known
+        if request["cmd"] == "go":
+            end = tuple(request["end"])
+            if end != self.position and not self.routes.route(self.position, end, self.heading):
+                logging.warning(f"No itinerary from {self.position} to {end}, staying there")
+                return
+            arrived, node, heading = main.go_somewhere(self.size, self.position, end, self.heading, self.urkab,
+                                                       self.line_follower, self.PID_control, self.routes, **common)
+        elif request["cmd"] == "plan":
+            nodes = [tuple(node) for node in request["nodes"]]
+            arrived, node, heading = main.go_somewhere(self.size, self.position, nodes[-1], self.heading, self.urkab,
+                                                       self.line_follower, self.PID_control, self.routes,
+                                                       itinerary=list(zip(nodes[:-1], nodes[1:])),
+                                                       departures=request["departures"], **common)
+        else:
+            stops = [tuple(stop) for stop in request["stops"]]
+            if TourPlanner(self.routes).plan(self.position, stops, self.heading) is None:
+                logging.warning(f"No tour from {self.position} through {stops}, staying there")
+                return
+            arrived, node, heading = main.go_tour(self.size, self.position, stops, self.heading, self.urkab,
+                                                  self.line_follower, self.PID_control, self.routes, **common)
+        self.position, self.heading = tuple(node), tuple(heading)
+        if not arrived:
+            # Stopped, blocked or camera lost: the car is somewhere after the last intersection passed
+            logging.warning("Trip not finished, the position has to be set again")
+            self.position_known = False
+            return
+        self.completed += 1
+
+    def _serve(self):
+        socket = zmq.Context.instance().socket(zmq.REP)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.bind(self.address)
+        try:
+            while self._running:
+                if not socket.poll(200):
+                    continue
+                try:
+                    request = decode(socket.recv())
+                    reply = self.handle(request)
+                except Exception as e:
+                    reply = {"ok": False, "error": str(e)}
+                socket.send(encode(reply))
+        finally:
+            socket.close()
+
+    def _cell(self, value):
+        x, y = (int(v) for v in value)
+        if not (0 <= x < self.size and 0 <= y < self.size):
+            raise ValueError(f"{(x, y)} is not on the {self.size}x{self.size} grid")
+        return [x, y]
+
+    def handle(self, request):
+        """Answer a request of the socket API."""
+        cmd = request.get("cmd")
+        if cmd in ("go", "tour", "plan"):
+            if not self.position_known:
+                return {"ok": False, "error": "Position unknown since the last stop, send set first"}
+            if cmd == "go":
+                trip = {"cmd": "go", "end": self._cell(request["end"])}
+            elif cmd == "plan":
+                trip = {"cmd": "plan", "nodes": [self._cell(node) for node in request["nodes"]],
+                        "departures": [float(t) for t in request["departures"]]}
+                if len(trip["nodes"]) < 2 or len(trip["departures"]) != len(trip["nodes"]) - 1:
+                    return {"ok": False, "error": "A plan has at least one edge and one departure per edge"}
+                if any(abs(a[0] - b[0]) + abs(a[1] - b[1]) != 1 for a, b in zip(trip["nodes"], trip["nodes"][1:])):
+                    return {"ok": False, "error": "The nodes of a plan are neighbours on the grid"}
+                # The schedule is shared with the other cars: it starts now, from where the car is
+                if self.current is not None or not self.trips.empty():
+                    return {"ok": False, "error": "Driving, a plan only starts when idle"}
+                if tuple(trip["nodes"][0]) != self.position:
+                    return {"ok": False, "error": f"The plan starts at {trip['nodes'][0]}, the car is at "
+                                                  f"{list(self.position)}"}
+            else:
+                trip = {"cmd": "tour", "stops": [self._cell(stop) for stop in request["stops"]]}
+                if not trip["stops"]:
+                    return {"ok": False, "error": "No stops"}
+            with self._lock:
+                self.trips.put((self._generation, trip))
+            return {"ok": True, "queued": self.trips.qsize()}
+        if cmd == "set":
+            if self.current is not None:
+                return {"ok": False, "error": "Driving, stop first"}
+            position = tuple(self._cell(request["position"]))
+            heading = tuple(int(v) for v in request.get("heading", self.heading))
+            if heading not in DIRECTIONS.values():
+                return {"ok": False, "error": f"{heading} is not a heading"}
+            self.position, self.heading = position, heading
+            self.position_known = True
+            return {"ok": True}
+        if cmd == "status":
+            return {"ok": True, "position": list(self.position), "heading": list(self.heading),
+                    "position_known": self.position_known, "driving": self.current, "queued": self.trips.qsize(),
+                    "completed": self.completed, "camera": self.grabber.running,
+                    "frames": self.grabber.captured}
+        if cmd == "stop":
+            with self._lock:
+                self._generation += 1
+                while not self.trips.empty():
+                    self.trips.get_nowait()
+                current = self.current
+                if current is not None:
+                    self.stop_requested.set()
+            return {"ok": True, "stopped": current}
+        if cmd == "shutdown":
+            self.handle({"cmd": "stop"})
+            self._running = False
+            return {"ok": True}
+        return {"ok": False, "error": f"Unknown command {cmd}"}
+
+
+def request(message, address=NAV_ADDRESS, timeout=2.0):
+    """Send a request to the daemon and return its reply, None if it does not answer."""
+    socket = zmq.Context.instance().socket(zmq.REQ)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.connect(address)
+    try:
+        socket.send(encode(message))
+        if not socket.poll(timeout * 1000):
+            return None
+        return decode(socket.recv())
+    finally:
+        socket.close()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Navigation daemon keeping the camera and the Arduino link open "
+                                                 "between trips, and its client")
+    parser.add_argument("--address", default=NAV_ADDRESS, help="Socket of the daemon")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="Run the daemon")
+    serve.add_argument("--size", type=int, required=True, help="Size of the grid")
+    serve.add_argument("--start", type=int, nargs=2, required=True, help="Where the car is")
+    serve.add_argument("--dir_init", type=int, nargs=2, required=True, help="Heading of the car")
+    go = commands.add_parser("go", help="Drive to a point")
+    go.add_argument("end", type=int, nargs=2)
+    tour = commands.add_parser("tour", help="Deliver stops X Y [X Y ...] in the fastest order")
+    tour.add_argument("stops", type=int, nargs="+")
+    set_position = commands.add_parser("set", help="Set where the car is")
+    set_position.add_argument("position", type=int, nargs=2)
+    set_position.add_argument("heading", type=int, nargs=2)
+    for name in ("status", "stop", "shutdown"):
+        commands.add_parser(name)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.DEBUG if main.DEBUG else logging.INFO,
+                        force=True)  # car_lib already logged at import, which configured the root logger
+    if args.command != "serve":
+        if args.command == "tour":
+            if len(args.stops) % 2:
+                raise SystemExit("tour needs pairs of coordinates")
+            message = {"cmd": "tour", "stops": [args.stops[i:i + 2] for i in range(0, len(args.stops), 2)]}
+        elif args.command == "go":
+            message = {"cmd": "go", "end": args.end}
+        elif args.command == "set":
+            message = {"cmd": "set", "position": args.position, "heading": args.heading}
+        else:
+            message = {"cmd": args.command}
+        reply = request(message, args.address)
+        print(reply if reply is not None else f"No answer from {args.address}")
+        raise SystemExit(0 if reply and reply["ok"] else 1)
+
+    # The camera and the Arduino link are opened once, here
+    urkab, line_follower, PID_control = main.initialize_car()
+    grabber = main.camera_grabber()
+    # The vision workers too, before the threads of the streamer and the daemon
+    workers = main.vision_workers(grabber, line_follower).start() if main.VISION_WORKERS else None
+    timer = StageTimer(log_interval=main.TIMINGS_LOG_INTERVAL) if main.TIMINGS_PATH else NULL_TIMER
+    recorder = FrameRecorder(main.RECORD_PATH) if main.RECORD_PATH else None
+    streamer = FrameStreamer(main.STREAM_PORT, main.STREAM_RATE).start() if main.STREAM_PORT else None
+    telemetry = TelemetryPublisher(main.TELEMETRY_PORT, main.TELEMETRY_RATE) if main.TELEMETRY_PORT else None
+    daemon = NavigationDaemon(args.size, args.start, args.dir_init, urkab, line_follower, PID_control,
+                              grabber, args.address, timer=timer, recorder=recorder, streamer=streamer,
+                              telemetry=telemetry, workers=workers)
+    daemon.start()
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+        urkab.carDisconnect()
+        for closing in (recorder, telemetry):
+            if closing is not None:
+                closing.close()
+        if streamer is not None:
+            streamer.stop()
+        if main.TIMINGS_PATH:
+            timer.dump(main.TIMINGS_PATH)
@@ -0,0 +1,120 @@
+import logging
+import os
+
+import numpy as np
+
+FRAME_SHAPE = (128, 160, 3)  # frames of the Pi camera at 160x128, BGR
+
+
+def record_dtype(frame_shape=FRAME_SHAPE):
+    """One slot of a recording: the frame and the state of the control loop when it was processed."""
+    return np.dtype([("seq", "<u8"),              # 0 for a slot never written, then increasing
+                     ("timestamp", "<f8"),        # perf_counter time of the capture
+                     ("distance", "<f4"),         # LineFollower.distance
+                     ("motor_left", "<i2"),       # PID outputs
+                     ("motor_right", "<i2"),
+                     ("direction_index", "<i2"),
+                     ("frame", "u1", frame_shape)])
+
+
+class FrameRecorder:
+    """
+    Records the frames of the control loop in a ring file of capacity slots, preallocated and memory mapped.
+    The file is a plain .npy of a structured array (see record_dtype), so it loads with np.load; once full,
+    the oldest slots are overwritten. Writing a frame is a copy into the mapping, the kernel writes the pages
+    back to the SD card in the background.
+    """
+    def __init__(self, path, capacity=32 * 60, frame_shape=FRAME_SHAPE):
+        self.path = path
+        self.capacity = capacity
+        self.records = np.lib.format.open_memmap(path, mode="w+", dtype=record_dtype(frame_shape),
+                                                 shape=(capacity,))
+        self._preallocate()
+        # Field views, so a write does not look the fields up by name
+        self._seq = self.records["seq"]
+        self._timestamp = self.records["timestamp"]
+        self._distance = self.records["distance"]
+        self._motor_left = self.records["motor_left"]
+        self._motor_right = self.records["motor_right"]
+        self._direction_index = self.records["direction_index"]
+        self._frames = self.records["frame"]
+        self.written = 0
+        logging.info(f"Recording up to {capacity} frames to {path} "
+                     f"({self.records.nbytes / 2**20:.0f} MiB)")
+
+    def _preallocate(self):
+        # The memmap file is sparse: reserve its blocks now rather than while driving
+        if not hasattr(os, "posix_fallocate"):
+            return
+        with open(self.path, "r+b") as f:
+            try:
+                os.posix_fallocate(f.fileno(), 0, os.fstat(f.fileno()).st_size)
+            except OSError as e:
+                logging.debug(f"Could not preallocate {self.path}: {e}")
+
+    def write(self, frame, timestamp, distance=0.0, motor_left=0, motor_right=0, direction_index=0):
+        slot = self.written % self.capacity
+        self._seq[slot] = 0  # the slot is invalid while it is being overwritten
+        self._frames[slot] = frame
+        self._timestamp[slot] = timestamp
+        self._distance[slot] = distance
+        self._motor_left[slot] = motor_left
+        self._motor_right[slot] = motor_right
+        self._direction_index[slot] = direction_index
+        self.written += 1
+        self._seq[slot] = self.written
+
+    def flush(self):
+        self.records.flush()
+
+    def close(self):
+        if self.records is None:
+            return
+        self.records.flush()
+        self.records = None
+        self._frames = None
+        logging.info(f"Recorded {self.written} frames to {self.path}"
+                     + (f", the first {self.written - self.capacity} were overwritten"
+                        if self.written > self.capacity else ""))
+
+
+class Recording:
+    """
+    Read-only view of a FrameRecorder file, mapped without copying anything.
+    records holds the slots in file order; order gives the indices of the written slots oldest first,
+    so records[order] is the chronological recording and frames[i] the i-th frame recorded.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.records = np.load(path, mmap_mode="r")
+        if self.records.dtype.names is None or "frame" not in self.records.dtype.names:
+            raise ValueError(f"{path} is not a frame recording")
+        seq = np.asarray(self.records["seq"])
+        written = np.flatnonzero(seq)
+        self.order = written[np.argsort(seq[written], kind="stable")]
+
+    def __len__(self):
+        return len(self.order)
+
+    @property
+    def ring_frames(self):
+        """Every slot's frame in file order, a view of the mapping."""
+        return self.records["frame"]
+
+    @property
+    def frame_shape(self):
+        return self.records.dtype["frame"].shape
+
+    def frame(self, i):
+        """i-th frame recorded, a view of the mapping."""
+        return self.records["frame"][self.order[i]]
+
+    def frames(self):
+        """Yield the frames oldest first, each one a view of the mapping."""
+        ring = self.records["frame"]
+        for slot in self.order:
+            yield ring[slot]
+
+    def field(self, name):
+        """Chronological values of a field, e.g. "distance" (copied, the fields are small)."""
+        return np.asarray(self.records[name][self.order])
@@ -0,0 +1,205 @@
+import heapq
+import logging
+
+from graphe_go_brrrrr import HEADINGS, MoveCosts, GridGraph, dir_list, dir_list_absolute
+
+INF = float("inf")
+
+
+class IncrementalPlanner:
+    """
+    D* Lite planner over (node, heading) states with the turn costs of astar_with_turns.
+    The search runs backwards from the end and keeps its g/rhs values between queries, so after remove_edge
+    only the states whose cost changed are repaired instead of planning again from scratch.
+
+    The planner also keeps the current itinerary, in the format used by go_somewhere:
+    directions[i] is executed at nodes[i], then the car drives edge i heading headings[i] to nodes[i + 1].
+    edges: itinerary already planned with the same costs (e.g. by the RouteService), the search then only runs
+    at the first repair.
+    """
+    def __init__(self, graph, start, end, dir_init, costs=None, edges=None):
+        if not isinstance(graph, GridGraph):
+            raise TypeError("IncrementalPlanner needs a GridGraph")
+        self.graph = graph
+        self.N = graph.N
+        self.end = tuple(end)
+        self.costs = costs or MoveCosts()
+        self.start_state = (tuple(start), tuple(dir_init))
+        self.last_start = self.start_state
+        self.km = 0.0
+        self.g = {}
+        self.rhs = {}
+        self._queue = []      # heap of (key, counter, state), stale entries are skipped
+        self._queued = {}     # state -> key of its valid heap entry
+        self._counter = 0
+        self.expanded = 0     # states expanded since the creation of the planner
+
+        for heading in HEADINGS:
+            goal = (self.end, heading)
+            self.rhs[goal] = 0.0
+            self._push(goal)
+
+        self.nodes, self.headings, self.directions = [], [], []
+        if edges is None:
+            self._set_itinerary(0, self.start_state)
+        else:
+            self.nodes = [tuple(start)] + [tuple(edge[1]) for edge in edges]
+            self.headings = dir_list_absolute(edges)
+            self.directions = dir_list(self.headings, tuple(dir_init)) if edges else []
+
+    # --- D* Lite core ---
+
+    def _heuristic(self, state):
+        # Distance from the start to the state, admissible since every edge costs at least costs.edge
+        (r1, c1), (r2, c2) = self.start_state[0], state[0]
+        return (abs(r1 - r2) + abs(c1 - c2)) * self.costs.edge
+
+    def _key(self, state):
+        best = min(self.g.get(state, INF), self.rhs.get(state, INF))
+        return (best + self._heuristic(state) + self.km, best)
+
+    def _push(self, state):
+        key = self._key(state)
+        self._queued[state] = key
+        self._counter += 1
+        heapq.heappush(self._queue, (key, self._counter, state))
+
+    def _top(self):
+        while self._queue:
+            key, _, state = self._queue[0]
+            if self._queued.get(state) == key:
+                return key, state
+            heapq.heappop(self._queue)  # stale entry
+        return (INF, INF), None
+
+    def _successors(self, state):
+        node, heading = state
+        for new_heading in HEADINGS:
+            nxt = (node[0] + new_heading[0], node[1] + new_heading[1])
+            if 0 <= nxt[0] < self.N and 0 <= nxt[1] < self.N and self.graph.has_edge(node, nxt):
+                yield (nxt, new_heading), self.costs.move(heading, new_heading)
+
+    def _predecessors(self, state):
+        node, heading = state
+        prev = (node[0] - heading[0], node[1] - heading[1])
+        if 0 <= prev[0] < self.N and 0 <= prev[1] < self.N and self.graph.has_edge(prev, node):
+            for prev_heading in HEADINGS:
+                yield (prev, prev_heading)
+
+    def _update_state(self, state):
+        if state[0] != self.end:
+            self.rhs[state] = min((cost + self.g.get(nxt, INF) for nxt, cost in self._successors(state)),
+                                  default=INF)
+        self._queued.pop(state, None)
+        if self.g.get(state, INF) != self.rhs.get(state, INF):
+            self._push(state)
+
+    def _compute_shortest_path(self):
+        start = self.start_state
+        while True:
+            top_key, state = self._top()
+            if state is None or (top_key >= self._key(start) and
+                                 self.rhs.get(start, INF) == self.g.get(start, INF)):
+                return
+            new_key = self._key(state)
+            if top_key < new_key:
+                self._push(state)
+                continue
+            del self._queued[state]
+            self.expanded += 1
+            if self.g.get(state, INF) > self.rhs.get(state, INF):
+                self.g[state] = self.rhs[state]
+                for prev in self._predecessors(state):
+                    self._update_state(prev)
+            else:
+                self.g[state] = INF
+                self._update_state(state)
+                for prev in self._predecessors(state):
+                    self._update_state(prev)
+
+    def _move_start(self, state):
+        self.start_state = state
+        self.km += self._heuristic(self.last_start)  # heuristic from the new start to the previous one
+        self.last_start = state
+
+    def _path_from(self, state):
+        """Follow the cheapest successors from state to the end, returns the states visited after state."""
+        path = []
+        visited = {state}
+        while state[0] != self.end:
+            if self.g.get(state, INF) == INF and self.rhs.get(state, INF) == INF:
+                return None
+            state = min(self._successors(state), key=lambda move: move[1] + self.g.get(move[0], INF),
+                        default=(None, None))[0]
+            if state is None or state in visited:
+                return None
+            visited.add(state)
+            path.append(state)
+        return path
+
+    # --- Itinerary ---
+
+    def _set_itinerary(self, index, state):
+        """Plan from state, the car executing directions[index] there, and replace the itinerary from index on."""
+        self._move_start(state)
+        self._compute_shortest_path()
+        path = self._path_from(state)
+        if path is None:
+            logging.warning(f"No itinerary left from {state[0]} to {self.end}")
+            path = []
+        node, heading = state
+        self.nodes[index:] = [node] + [s[0] for s in path]
+        self.headings[index:] = [s[1] for s in path]
+        self.directions[index:] = dir_list(self.headings[index:], heading) if path else []
+
+    def edges(self):
+        """Itinerary as a list of edges, like bfs_with_edges_from_matrix."""
+        return list(zip(self.nodes[:-1], self.nodes[1:]))
+
+    def remove_edge(self, node1, node2):
+        """Block an edge and repair the costs of the states that used it, without replanning the itinerary."""
+        node1, node2 = tuple(node1), tuple(node2)
+        self.graph.remove_edge(node1, node2)
+        for node in (node1, node2):
+            for heading in HEADINGS:
+                self._update_state((node, heading))
+
+    def _changed_suffix(self, old_directions, splice_from):
+        index = splice_from
+        while (index < len(old_directions) and index < len(self.directions) and
+               old_directions[index] == self.directions[index]):
+            index += 1
+        return index, self.directions[index:]
+
+    def replan(self, direction_index):
+        """
+        Update the itinerary after edges were removed, the car driving edge direction_index.
+        Its next decision is at nodes[direction_index + 1], so the itinerary is kept up to there.
+        Returns (splice_index, new_directions): the caller replaces its dir_l[splice_index:] with new_directions.
+        """
+        old_directions = list(self.directions)
+        index = direction_index + 1
+        self._set_itinerary(index, (self.nodes[index], self.headings[direction_index]))
+        return self._changed_suffix(old_directions, index)
+
+    def turn_back(self, direction_index):
+        """
+        The edge being driven (edge direction_index) is blocked: remove it and plan the way back.
+        The car does a U-turn on the edge and comes back to nodes[direction_index] facing the other way,
+        where it executes the new directions[direction_index + 1].
+        Returns (splice_index, new_directions) like replan; no new directions when the car was already turning back
+        on that edge.
+        """
+        node, heading = self.nodes[direction_index], self.headings[direction_index]
+        if self.nodes[direction_index + 1] == node:
+            # Already on the way back of a previous turn_back: blocked both ways, there is no edge left to try
+            logging.warning(f"Blocked on both sides of {node}, no itinerary left")
+            del self.nodes[direction_index + 2:], self.headings[direction_index + 1:]
+            del self.directions[direction_index + 1:]
+            return direction_index + 1, []
+        old_directions = list(self.directions)
+        self.remove_edge(node, self.nodes[direction_index + 1])
+        back = (-heading[0], -heading[1])
+        self.headings[direction_index] = back
+        self._set_itinerary(direction_index + 1, (node, back))
+        return self._changed_suffix(old_directions, direction_index + 1)
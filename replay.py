@@ -0,0 +1,296 @@
+import argparse
+import glob
+import logging
+import os
+import struct
+import time
+
+import cv2
+import numpy as np
+
+import main
+from camera_stream import yuv_shape
+from car_lib import Urkab, TURNING_CONST, TICKS_PER_TURN
+from instrumentation import NULL_TIMER, StageTimer
+from line_detection import LineFollower
+from PID import PIDController
+from recorder import FrameRecorder, Recording
+from debug_stream import FrameStreamer
+from telemetry import TelemetryPublisher
+from serial_link import FrameReader
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+class _ReplaySource:
+    """
+    Frame source replaying recorded frames, resized to the resolution of the camera.
+    format "yuv" converts them to I420 like the camera in YUV capture (camera_stream.YUVFrame).
+    """
+    def __init__(self, path, resolution=(160, 128), fps=None, format="bgr"):
+        self.path = path
+        self.resolution = resolution
+        self.fps = fps  # None replays as fast as the loop goes
+        self.format = format
+        self.frame_shape = yuv_shape(resolution) if format == "yuv" else (resolution[1], resolution[0], 3)
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _read(self):
+        raise NotImplementedError
+
+    def frames(self):
+        period = 1 / self.fps if self.fps else 0
+        next_time = time.perf_counter()
+        for image in self._read():
+            if image.shape[:2] != self.resolution[::-1]:
+                image = cv2.resize(image, self.resolution, interpolation=cv2.INTER_AREA)
+            if self.format == "yuv":
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2YUV_I420)
+            if period:
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                next_time += period
+            yield image
+
+
+class ImageFolderSource(_ReplaySource):
+    """Images of a folder in file name order, e.g. data/."""
+    def _read(self):
+        files = sorted(f for f in glob.glob(os.path.join(self.path, "*")) if f.lower().endswith(IMAGE_EXTENSIONS))
+        if not files:
+            raise FileNotFoundError(f"No image in {self.path}")
+        for file in files:
+            image = cv2.imread(file, cv2.IMREAD_COLOR)
+            if image is None:
+                logging.warning(f"Skipping unreadable image {file}")
+                continue
+            yield image
+
+
+class VideoSource(_ReplaySource):
+    """Frames of a video file readable by OpenCV."""
+    def _read(self):
+        capture = cv2.VideoCapture(self.path)
+        if not capture.isOpened():
+            raise FileNotFoundError(f"Cannot open the video {self.path}")
+        try:
+            while True:
+                ok, image = capture.read()
+                if not ok:
+                    return
+                yield image
+        finally:
+            capture.release()
+
+
+class NpySource(_ReplaySource):
+    """
+    Frames of a .npy array of shape (n, height, width, 3) in BGR, memory mapped instead of loaded,
+    or of a recording of recorder.FrameRecorder.
+    """
+    def _read(self):
+        frames = np.load(self.path, mmap_mode="r")
+        # The mapping is read-only and the loop draws on its frames: each frame is copied out of it
+        if frames.dtype.names is not None:
+            for image in Recording(self.path).frames():
+                yield np.array(image)
+            return
+        if frames.ndim != 4 or frames.shape[-1] != 3:
+            raise ValueError(f"{self.path} holds an array of shape {frames.shape}, expected (n, h, w, 3)")
+        for image in frames:
+            yield np.array(image)
+
+
+def open_source(path, resolution=(160, 128), fps=None, format="bgr"):
+    """Frame source for a folder of images, a .npy recording or a video file."""
+    if os.path.isdir(path):
+        return ImageFolderSource(path, resolution, fps, format)
+    if path.endswith(".npy"):
+        return NpySource(path, resolution, fps, format)
+    return VideoSource(path, resolution, fps, format)
+
+
+class ReplayGrabber:
+    """
+    Same interface as camera_stream.FrameGrabber, but every frame of the source is read in order on the
+    caller's thread: nothing is dropped, so a replay gives the same results however fast the loop runs.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.format = source.format
+        self.captured = 0
+        self.dropped = 0
+        self._frames = None
+        self._running = False
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        self.source.open()
+        self._frames = self.source.frames()
+        self._running = True
+        return self
+
+    def stop(self):
+        self._running = False
+        self.source.close()
+        logging.info(f"Replay stopped after {self.captured} frames")
+
+    def read(self, timeout=1.0):
+        if not self._running:
+            return None
+        image = next(self._frames, None)
+        if image is None:
+            self._running = False
+            return None
+        self.captured += 1
+        return self.captured, time.perf_counter(), image
+
+
+class RecordingUrkab(Urkab):
+    """
+    Stand-in for Urkab that records the command stream instead of talking to the Arduino.
+    The encoders are simulated from the turn commands so that the turns calibrated in ticks end as on the car.
+    obstacles: times, in seconds after the creation, at which an obstacle is reported as by the async link.
+    """
+    def __init__(self, obstacles=()):
+        self.link = None
+        self.framed = False
+        self.seq = 0
+        self.frame_reader = FrameReader()
+        self.timer = NULL_TIMER
+        self.origin = None
+        self.last_rtt = 0.0
+        self.arduino = None
+        self.commands = []   # (perf_counter time, command letter, arguments)
+        self.start_time = time.perf_counter()
+        self._obstacles = sorted(obstacles)
+        self._motors = (0, 0)
+        self._encoder_reset = self.start_time
+        logging.info("Recording the commands instead of sending them to the Arduino")
+
+    def sendCmd(self, payload, key=None):
+        cmd = payload[:1]
+        args = struct.unpack('<4h', payload[1:]) if cmd in (b'B', b'C', b'D', b'G') else payload[1:]
+        self.commands.append((time.perf_counter(), cmd.decode(), args))
+        if cmd == b'B':
+            self._encoder_reset = time.perf_counter()
+        elif cmd in (b'C', b'D'):
+            self._motors = args[:2]
+        return "OK"
+
+    def recupCmdi(self, cmd):
+        self.commands.append((time.perf_counter(), cmd.decode(), ()))
+        return 0, 0, 0, 0
+
+    def recupCmdl(self, cmd):
+        self.commands.append((time.perf_counter(), cmd.decode(), ()))
+        if cmd != b'N' or not TICKS_PER_TURN:
+            return 0, 0
+        # Wheels turning in opposite directions: the car turns on the spot at the calibrated speed
+        if self._motors[0] * self._motors[1] >= 0:
+            return 0, 0
+        ticks = int(TICKS_PER_TURN * (time.perf_counter() - self._encoder_reset) / TURNING_CONST)
+        return ticks, -ticks
+
+    def getUltrasonicDist(self):
+        return 1000
+
+    def pollObstacle(self):
+        if self._obstacles and time.perf_counter() - self.start_time >= self._obstacles[0]:
+            return f"OB replayed at {self._obstacles.pop(0):.1f}s"
+        return None
+
+    def carDisconnect(self):
+        pass
+
+    def command_counts(self):
+        counts = {}
+        for _, cmd, _ in self.commands:
+            counts[cmd] = counts.get(cmd, 0) + 1
+        return counts
+
+    def dump(self, path):
+        """Write the command stream as CSV: time since the start, command letter, arguments."""
+        with open(path, "w") as f:
+            f.write("time,command,args\n")
+            for t, cmd, args in self.commands:
+                args = " ".join(str(a) for a in args) if isinstance(args, tuple) else args.hex()
+                f.write(f"{t - self.start_time:.4f},{cmd},{args}\n")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Replay recorded frames through the go_somewhere loop")
+    parser.add_argument("source", help="Folder of images, .npy recording or video file")
+    parser.add_argument("--size", type=int, default=5, help="Size of the grid (N)")
+    parser.add_argument("--start", type=int, nargs=2, default=(0, 0), help="Starting coordinates")
+    parser.add_argument("--end", type=int, nargs=2, default=(4, 4), help="Ending coordinates")
+    parser.add_argument("--dir_init", type=int, nargs=2, default=(1, 0), help="Initial direction")
+    parser.add_argument("--fps", type=float, default=None, help="Replay at this frame rate instead of full speed")
+    parser.add_argument("--estimator", choices=("contour", "scanline"), default="contour",
+                        help="Line estimator of the LineFollower")
+    parser.add_argument("--lut", help="Color table of the line mask built by color_lut.py")
+    parser.add_argument("--yuv", action="store_true", help="Feed the frames in I420 like the YUV capture")
+    parser.add_argument("--workers", action="store_true", help="Process the frames in the vision worker processes")
+    parser.add_argument("--display", action="store_true", help="Show the frames as on the car")
+    parser.add_argument("--obstacle", type=float, action="append", default=[],
+                        help="Report an obstacle this many seconds after the start")
+    parser.add_argument("--commands", help="Write the command stream to this CSV file")
+    parser.add_argument("--stream", type=int, metavar="PORT", help="Publish the annotated frames on this port")
+    parser.add_argument("--telemetry", type=int, metavar="PORT", help="Publish the telemetry on this port")
+    parser.add_argument("--record", help="Record the replayed frames and the loop state to this .npy ring file")
+    parser.add_argument("--debug", action="store_true")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.DEBUG if args.debug else logging.INFO,
+                        force=True)  # car_lib already logged at import, which configured the root logger
+    main.HEADLESS = not args.display
+    main.LINE_LUT_PATH = args.lut
+    main.VISION_WORKERS = args.workers
+
+    urkab = RecordingUrkab(obstacles=args.obstacle)
+    line_follower = LineFollower(mode=args.estimator)
+    # same values as main.initialize_car
+    PID_control = PIDController(3, 0.4, 1.2, 255, 0, integral_limit=100, derivative_tau=main.DERIVATIVE_TAU)
+    grabber = ReplayGrabber(open_source(args.source, fps=args.fps, format="yuv" if args.yuv else "bgr"))
+    workers = main.vision_workers(grabber, line_follower).start() if args.workers else None
+    timer = StageTimer(log_interval=5.0)
+    recorder = FrameRecorder(args.record) if args.record else None
+    streamer = FrameStreamer(args.stream).start() if args.stream else None
+    telemetry = TelemetryPublisher(args.telemetry) if args.telemetry else None
+
+    start = time.perf_counter()
+    arrived, node, heading = main.go_somewhere(args.size, tuple(args.start), tuple(args.end), tuple(args.dir_init),
+                                               urkab, line_follower, PID_control, grabber=grabber, timer=timer,
+                                               recorder=recorder, streamer=streamer, telemetry=telemetry,
+                                               workers=workers)
+    elapsed = time.perf_counter() - start
+    if workers is not None:
+        workers.stop()
+
+    print(f"{'Arrived at' if arrived else 'Stopped after'} {node}, heading {heading}")
+    print(f"{grabber.captured} frames in {elapsed:.2f}s ({grabber.captured / elapsed:.1f} fps)")
+    print(timer.report())
+    print(f"Commands: {urkab.command_counts()}")
+    if args.commands:
+        urkab.dump(args.commands)
+        print(f"Command stream written to {args.commands}")
+    if recorder is not None:
+        recorder.close()
+    if streamer is not None:
+        streamer.stop()
+    if telemetry is not None:
+        telemetry.close()
+    if args.display:
+        cv2.destroyAllWindows()
@@ -0,0 +1,109 @@
+import logging
+from collections import OrderedDict
+
+from graphe_go_brrrrr import GridGraph, MoveCosts, astar_with_turns, dijkstra_with_turns, path_from_tree
+
+
+def _edge_key(node1, node2):
+    """Undirected edge as an order-independent key."""
+    return (node1, node2) if node1 <= node2 else (node2, node1)
+
+
+class RouteService:
+    """
+    Owns the grid map and caches the itineraries planned on it.
+    Routes are cached per (start, end, heading) in a bounded LRU, and single-source trees (every route from one
+    start and heading) can be precomputed on demand. Removing an edge bumps the map version and only drops the
+    cached routes and trees that used it: removing an edge never makes another path cheaper, so the others stay
+    optimal.
+    """
+    def __init__(self, N, costs=None, max_routes=256, max_trees=16):
+        self.graph = GridGraph(N)
+        self.N = N
+        self.costs = costs or MoveCosts()
+        self.version = 0
+        self.max_routes = max_routes
+        self.max_trees = max_trees
+        self._routes = OrderedDict()   # (start, end, heading) -> (edges, cost, edge keys used)
+        self._trees = OrderedDict()    # (start, heading) -> (best, parent, edge keys used)
+
+        self.hits = 0
+        self.tree_hits = 0      # misses of the route cache answered by a cached tree
+        self.misses = 0
+        self.invalidated = 0
+
+    @staticmethod
+    def _edge_keys(edges):
+        return frozenset(_edge_key(a, b) for a, b in edges)
+
+    def _store(self, cache, key, value, max_size):
+        cache[key] = value
+        cache.move_to_end(key)
+        if len(cache) > max_size:
+            cache.popitem(last=False)
+
+    def route(self, start, end, heading):
+        """Edges of the fastest itinerary from start, facing heading, to end ([] if unreachable)."""
+        start, end, heading = tuple(start), tuple(end), tuple(heading)
+        key = (start, end, heading)
+        if key in self._routes:
+            self.hits += 1
+            self._routes.move_to_end(key)
+            return list(self._routes[key][0])
+
+        tree = self._trees.get((start, heading))
+        if tree is not None:
+            self.tree_hits += 1
+            self._trees.move_to_end((start, heading))
+            edges, cost = path_from_tree(tree[0], tree[1], start, end)
+            edges = edges or []
+        else:
+            self.misses += 1
+            edges = astar_with_turns(self.graph, start, end, heading, self.costs, self.N)
+            cost = None
+        self._store(self._routes, key, (edges, cost, self._edge_keys(edges)), self.max_routes)
+        return list(edges)
+
+    def precompute(self, start, heading):
+        """Compute and cache the tree of every fastest route from start facing heading."""
+        start, heading = tuple(start), tuple(heading)
+        best, parent = dijkstra_with_turns(self.graph, start, heading, self.costs, self.N)
+        used = frozenset(_edge_key(prev[0], state[0]) for state, prev in parent.items() if prev is not None)
+        self._store(self._trees, (start, heading), (best, parent, used), self.max_trees)
+        logging.debug(f"Precomputed {len(best)} states from {start} facing {heading}")
+
+    def tree(self, start, heading):
+        """(best, parent) tree of dijkstra_with_turns from start facing heading, computed if not cached."""
+        start, heading = tuple(start), tuple(heading)
+        if (start, heading) not in self._trees:
+            self.precompute(start, heading)
+        self._trees.move_to_end((start, heading))
+        best, parent, _ = self._trees[(start, heading)]
+        return best, parent
+
+    def remove_edge(self, node1, node2):
+        """Block an edge of the map and drop the cached routes and trees using it."""
+        node1, node2 = tuple(node1), tuple(node2)
+        self.graph.remove_edge(node1, node2)
+        self.version += 1
+        edge = _edge_key(node1, node2)
+        for cache in (self._routes, self._trees):
+            stale = [key for key, value in cache.items() if edge in value[-1]]
+            for key in stale:
+                del cache[key]
+            self.invalidated += len(stale)
+        logging.debug(f"Map version {self.version}: removed {edge}")
+
+    def clear(self):
+        self._routes.clear()
+        self._trees.clear()
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.tree_hits + self.misses
+        return (self.hits + self.tree_hits) / lookups if lookups else 0.0
+
+    def stats(self):
+        return {"version": self.version, "routes": len(self._routes), "trees": len(self._trees),
+                "hits": self.hits, "tree_hits": self.tree_hits, "misses": self.misses,
+                "invalidated": self.invalidated, "hit_rate": self.hit_rate}
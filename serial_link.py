@@ -0,0 +1,329 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+from instrumentation import NULL_TIMER
+
+MOTORS_KEY = "motors"  # coalescing key shared by every command setting the motor voltages
+
+# Protocol v2, negotiated with 'A23' when connecting (see arduino/serial_link.ino)
+# command: 0xA5 LEN SEQ CMD args[LEN-2] CRC8(LEN..args)
+# reply:   0x5A SEQ STATUS LEN data[LEN] CRC8(SEQ..data)
+PROTOCOL_VERSION = 2
+FRAME_SYNC = 0xA5
+REPLY_SYNC = 0x5A
+FRAME_MAX_LEN = 16
+STATUS_OK = 0
+STATUS_OBSTACLE = 1
+STATUS_ERROR = 2
+STATUS_BAD_CRC = 3
+
+
+def _crc8_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return bytes(table)
+
+
+CRC8_TABLE = _crc8_table()
+
+
+def crc8(data, crc=0):
+    """CRC-8 with polynomial 0x07, the same as crc8() in the firmware."""
+    for byte in data:
+        crc = CRC8_TABLE[crc ^ byte]
+    return crc
+
+
+def encode_frame(seq, payload):
+    """Wrap a command (command letter followed by its arguments) into a v2 frame."""
+    body = bytes((len(payload) + 1, seq)) + payload
+    return bytes((FRAME_SYNC,)) + body + bytes((crc8(body),))
+
+
+class FrameReader:
+    """
+    Incremental parser of the v2 reply frames.
+    Bytes that do not start a reply with a valid length and CRC are skipped one by one,
+    so the parser resynchronises on the next reply after line noise.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.discarded = 0   # bytes skipped while resynchronising
+
+    def feed(self, data):
+        """Add received bytes, returns the list of (seq, status, data) of the replies completed."""
+        self.buffer += data
+        replies = []
+        while True:
+            start = self.buffer.find(REPLY_SYNC)
+            if start < 0:
+                self.discarded += len(self.buffer)
+                self.buffer.clear()
+                return replies
+            if start:
+                self.discarded += start
+                del self.buffer[:start]
+            if len(self.buffer) < 4:
+                return replies
+            length = self.buffer[3]
+            if length > FRAME_MAX_LEN:
+                self._skip()
+                continue
+            if len(self.buffer) < length + 5:
+                return replies
+            if crc8(self.buffer[1:length + 4]) != self.buffer[length + 4]:
+                self._skip()
+                continue
+            replies.append((self.buffer[1], self.buffer[2], bytes(self.buffer[4:length + 4])))
+            del self.buffer[:length + 5]
+
+    def _skip(self):
+        self.discarded += 1
+        del self.buffer[:1]
+
+
+class PendingReply:
+    """Reply expected from the Arduino for one command: a text line (acknowledgement) or nbytes binary bytes."""
+    def __init__(self, nbytes=None, origin=None):
+        self.nbytes = nbytes
+        self.origin = origin  # perf_counter time of the camera frame the command answers, if any
+        self.seq = None
+        self.status = None
+        self.reply = None
+        self.obstacle = False
+        self.sent_at = None
+        self.received_at = None
+        self._done = threading.Event()
+
+    def resolve(self, reply):
+        self.reply = reply
+        self.received_at = time.perf_counter()
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Block until the reply arrived, returns it (None on timeout)."""
+        self._done.wait(timeout)
+        return self.reply
+
+
+class AsyncSerialLink:
+    """
+    Pipelined transport over an open serial port.
+    A writer thread sends the queued commands, keeping at most max_in_flight of them unacknowledged,
+    and a reader thread matches the replies to the commands in the order they were sent
+    (the Arduino answers its commands one after the other).
+    Commands sharing a key (the motor setpoint) are coalesced: while waiting to be written, a new command replaces
+    the queued one, and a command identical to the last one written for its key is not sent at all.
+    Obstacle acknowledgements ("OB ..." or the obstacle status of v2 replies) are put on the obstacles queue
+    instead of raising in the caller.
+    framed: use the v2 frames, replies are then matched by sequence number and the ones lost to line noise
+    are skipped instead of shifting every later reply.
+    timer: instrumentation.StageTimer receiving the round trip of each command ("serial_ack") and, for the
+    commands sent with an origin, the time from the camera frame to the acknowledgement ("camera_to_ack").
+    """
+    def __init__(self, port, max_in_flight=2, on_obstacle=None, framed=False, reply_timeout=0.5, timer=NULL_TIMER):
+        self.port = port
+        self.timer = timer
+        self.framed = framed
+        self.reply_timeout = reply_timeout  # v2 only: a command unanswered for this long is considered lost
+        self.max_in_flight = max_in_flight
+        self.on_obstacle = on_obstacle
+        self.obstacles = queue.Queue()   # (perf_counter time, message) of each obstacle report
+
+        self.sent = 0         # commands written on the port
+        self.coalesced = 0    # commands replaced by a newer one before being written
+        self.skipped = 0      # commands identical to the last one written for their key
+        self.lost = 0         # v2 commands whose reply never came back
+        self.last_rtt = 0.0   # round trip of the last command acknowledged, in seconds
+
+        self._seq = 0
+        self._frame_reader = FrameReader()
+
+        self._cond = threading.Condition()
+        self._outgoing = deque()    # [payload, key, reply] waiting to be written
+        self._in_flight = deque()   # replies waiting for the Arduino
+        self._last_sent = {}        # key -> last payload written
+        self._running = False
+        self._threads = []
+
+    def start(self):
+        self._running = True
+        self._threads = [threading.Thread(target=self._write_loop, name="SerialWriter", daemon=True),
+                         threading.Thread(target=self._read_loop, name="SerialReader", daemon=True)]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self, timeout=1.0):
+        """Let the queued commands go out, then stop both threads."""
+        with self._cond:
+            self._cond.wait_for(lambda: not self._outgoing and not self._in_flight, timeout)
+            self._running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+        self._threads = []
+        logging.info(f"Serial link stopped: {self.sent} commands sent, {self.coalesced} coalesced, "
+                     f"{self.skipped} skipped")
+
+    def send(self, payload, key=None, origin=None):
+        """
+        Queue a command acknowledged by a text line and return immediately.
+        origin: perf_counter time of the camera frame the command answers, to measure camera_to_ack.
+        Returns the PendingReply of the command, or None if it was skipped as unchanged.
+        """
+        with self._cond:
+            if key is not None:
+                for entry in self._outgoing:
+                    if entry[1] == key:
+                        # A newer setpoint supersedes the one still waiting to be written
+                        entry[0] = payload
+                        entry[2].origin = origin
+                        self.coalesced += 1
+                        return entry[2]
+                if self._last_sent.get(key) == payload:
+                    self.skipped += 1
+                    return None
+            reply = PendingReply(origin=origin)
+            self._outgoing.append([payload, key, reply])
+            self._cond.notify_all()
+            return reply
+
+    def query(self, payload, nbytes, timeout=1.0):
+        """Send a command answered with nbytes binary bytes and wait for them."""
+        with self._cond:
+            reply = PendingReply(nbytes)
+            self._outgoing.append([payload, None, reply])
+            self._cond.notify_all()
+        data = reply.wait(timeout)
+        if data is None:
+            raise TimeoutError(f"No reply from the Arduino to {payload!r}")
+        if reply.status not in (None, STATUS_OK, STATUS_OBSTACLE):
+            raise IOError(f"Arduino rejected {payload!r}: status {reply.status}")
+        return data
+
+    def forget(self, key):
+        """The Arduino state for key changed behind our back: the next command with this key is always sent."""
+        with self._cond:
+            self._last_sent.pop(key, None)
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: not self._running or
+                                    (self._outgoing and len(self._in_flight) < self.max_in_flight))
+                if not self._running:
+                    return
+                payload, key, reply = self._outgoing.popleft()
+                if key is not None:
+                    self._last_sent[key] = payload
+                if self.framed:
+                    reply.seq = self._seq
+                    payload = encode_frame(self._seq, payload)
+                    self._seq = (self._seq + 1) & 0xFF
+                reply.sent_at = time.perf_counter()
+                self._in_flight.append(reply)
+                self._cond.notify_all()
+            self.port.write(payload)
+            self.sent += 1
+
+    def _read_loop(self):
+        if self.framed:
+            return self._read_frames_loop()
+        buffer = b''
+        while True:
+            with self._cond:
+                # Nothing is read while no command is waiting for its reply
+                self._cond.wait_for(lambda: not self._running or self._in_flight)
+                if not self._running:
+                    return
+                reply = self._in_flight[0]
+
+            if reply is not None and reply.nbytes is not None:
+                buffer += self.port.read(reply.nbytes - len(buffer))
+                if len(buffer) < reply.nbytes:
+                    continue
+                data, buffer = buffer, b''
+            else:
+                data = self.port.readline()
+                if data == b'':
+                    continue
+                logging.debug(f"Acquitted response is: {data}")
+                if data.startswith(b"OB"):
+                    self._report_obstacle(data, reply)
+
+            with self._cond:
+                self._in_flight.popleft()
+                self._cond.notify_all()
+            reply.resolve(data)
+            self._record(reply)
+
+    def _read_frames_loop(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: not self._running or self._in_flight)
+                if not self._running:
+                    return
+            data = self.port.read(max(1, self.port.in_waiting))
+            if not data:
+                self._expire_in_flight()
+                continue
+            for seq, status, reply_data in self._frame_reader.feed(data):
+                self._resolve_frame(seq, status, reply_data)
+
+    def _expire_in_flight(self):
+        with self._cond:
+            if not self._in_flight or time.perf_counter() - self._in_flight[0].sent_at < self.reply_timeout:
+                return
+            lost = self._in_flight.popleft()
+            self.lost += 1
+            self._cond.notify_all()
+        logging.warning(f"No reply to command seq {lost.seq}")
+        lost.resolve(None)
+
+    def _resolve_frame(self, seq, status, data):
+        with self._cond:
+            if not any(reply.seq == seq for reply in self._in_flight):
+                logging.debug(f"Reply to an unknown command: seq {seq}, status {status}")
+                return
+            # The replies come back in order, the commands before this one lost theirs
+            while self._in_flight[0].seq != seq:
+                lost = self._in_flight.popleft()
+                lost.resolve(None)
+                self.lost += 1
+                logging.warning(f"No reply to command seq {lost.seq}")
+            reply = self._in_flight.popleft()
+            self._cond.notify_all()
+        reply.status = status
+        if status == STATUS_OBSTACLE:
+            self._report_obstacle(b"OB", reply)
+        elif status != STATUS_OK:
+            logging.warning(f"Arduino rejected command seq {seq}: status {status}")
+        reply.resolve(data)
+        self._record(reply)
+
+    def _record(self, reply):
+        self.last_rtt = reply.received_at - reply.sent_at
+        self.timer.record("serial_ack", self.last_rtt)
+        if reply.origin is not None:
+            self.timer.record("camera_to_ack", reply.received_at - reply.origin)
+
+    def _report_obstacle(self, data, reply):
+        message = data.decode(errors="replace").strip()
+        reply.obstacle = True
+        # The Arduino cut the motors, whatever setpoint we sent last is no longer applied
+        self.forget(MOTORS_KEY)
+        self.obstacles.put((time.perf_counter(), message))
+        logging.warning(f"Obstacle detected: {message}")
+        if self.on_obstacle is not None:
+            self.on_obstacle(message)
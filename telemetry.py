@@ -0,0 +1,124 @@
+import argparse
+import json
+import logging
+import time
+
+import numpy as np
+import zmq
+
+TELEMETRY_PORT = 5007  # next to the ports of communication.py and debug_stream.py
+TOPIC = b"telemetry"
+TELEMETRY_VERSION = 1
+
+# One sample per processed frame, little endian and packed so the batches can be decoded anywhere
+TELEMETRY_DTYPE = np.dtype([("timestamp", "<f8"),        # perf_counter time of the frame on the car
+                            ("offset", "<f4"),           # LineFollower.distance, pixels
+                            ("pid_output", "<f4"),       # PIDController.output
+                            ("motor_left", "<i2"),       # motor commands
+                            ("motor_right", "<i2"),
+                            ("direction_index", "<i2"),  # index in the itinerary
+                            ("events", "u1"),            # EVENT_* flags
+                            ("serial_rtt", "<f4")])      # last serial round trip, seconds
+
+EVENT_INTERSECTION = 1  # an intersection is in sight
+EVENT_TURN = 2          # turning on an intersection
+EVENT_OBSTACLE = 4      # obstacle reported by the Arduino
+EVENT_HOLD = 8          # waiting for the fleet schedule
+
+
+class TelemetryPublisher:
+    """
+    Batches telemetry samples into a preallocated TELEMETRY_DTYPE array and publishes the batch over ZMQ
+    rate times per second (or when it is full), as raw bytes: adding a sample is one row assignment,
+    nothing is serialized per sample.
+    """
+    def __init__(self, port=TELEMETRY_PORT, rate=5.0, capacity=256, robot="robot"):
+        self.period = 1.0 / rate
+        self.robot = robot
+        self.batches = 0
+        self.dropped = 0    # batches ZMQ could not take
+        self._batch = np.zeros(capacity, TELEMETRY_DTYPE)
+        self._count = 0
+        self._next_send = time.perf_counter() + self.period
+        self._socket = zmq.Context.instance().socket(zmq.PUB)
+        self._socket.setsockopt(zmq.SNDHWM, 16)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        self._socket.bind(f"tcp://*:{port}")
+        logging.info(f"Publishing telemetry on port {port}")
+
+    def add(self, timestamp, offset, pid_output, motor_left, motor_right, direction_index, events, serial_rtt):
+        self._batch[self._count] = (timestamp, offset, pid_output, motor_left, motor_right, direction_index,
+                                    events, serial_rtt)
+        self._count += 1
+        if self._count == len(self._batch) or time.perf_counter() >= self._next_send:
+            self.flush()
+
+    def flush(self):
+        self._next_send = time.perf_counter() + self.period
+        if not self._count:
+            return
+        header = json.dumps({"robot": self.robot, "seq": self.batches, "version": TELEMETRY_VERSION}).encode()
+        try:
+            self._socket.send_multipart([TOPIC, header, self._batch[:self._count].tobytes()], flags=zmq.NOBLOCK)
+            self.batches += 1
+        except zmq.Again:
+            self.dropped += 1
+        self._count = 0
+
+    def close(self):
+        self.flush()
+        self._socket.close()
+        logging.info(f"Telemetry stopped: {self.batches} batches sent, {self.dropped} dropped")
+
+
+class TelemetryReceiver:
+    """Receives the batches of a TelemetryPublisher as TELEMETRY_DTYPE arrays."""
+    def __init__(self, address):
+        self._socket = zmq.Context.instance().socket(zmq.SUB)
+        self._socket.setsockopt(zmq.SUBSCRIBE, TOPIC)
+        self._socket.connect(address)
+        self.last_seq = None
+        self.missed = 0   # batches lost on the way
+
+    def recv(self, timeout=None):
+        """Next batch as (header, samples), None on timeout (in seconds)."""
+        if timeout is not None and not self._socket.poll(timeout * 1000):
+            return None
+        _, header, payload = self._socket.recv_multipart()
+        header = json.loads(header)
+        if header["version"] != TELEMETRY_VERSION:
+            raise ValueError(f"Telemetry version {header['version']} is not supported")
+        if self.last_seq is not None and header["seq"] > self.last_seq + 1:
+            self.missed += header["seq"] - self.last_seq - 1
+        self.last_seq = header["seq"]
+        return header, np.frombuffer(payload, TELEMETRY_DTYPE)
+
+    def close(self):
+        self._socket.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print the telemetry published by the car")
+    parser.add_argument("address", help="Address of the car, e.g. tcp://192.168.137.2:5007")
+    parser.add_argument("--save", help="Write every sample received to this .npy file when quitting, replacing it")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logging.INFO)
+
+    receiver = TelemetryReceiver(args.address)
+    batches = []
+    try:
+        while True:
+            header, samples = receiver.recv()
+            if args.save:
+                batches.append(samples)
+            last = samples[-1]
+            print(f"{header['robot']} #{header['seq']}: {len(samples)} samples, offset {last['offset']:.0f}px, "
+                  f"motors {last['motor_left']}/{last['motor_right']}, index {last['direction_index']}, "
+                  f"rtt {last['serial_rtt'] * 1e3:.1f}ms, events {np.bitwise_or.reduce(samples['events'])}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        receiver.close()
+        if args.save and batches:
+            np.save(args.save, np.concatenate(batches))
+            print(f"{sum(len(b) for b in batches)} samples saved to {args.save}, {receiver.missed} batches missed")
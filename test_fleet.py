@@ -0,0 +1,50 @@
+from fleet import FleetPlanner, _edge_key
+from graphe_go_brrrrr import MoveCosts
+
+COSTS = MoveCosts(turn=0.7, uturn=1.4)
+
+
+def occupancy(planner, plan, dir_init):
+    """(node or edge key, first timestep, last timestep) of everything the robot of plan occupies."""
+    edge_steps = max(1, planner._steps(planner.costs.edge))
+    spans = []
+    heading, since = dir_init, 0
+    for i, (node, next_node) in enumerate(plan.edges()):
+        leave = plan.departures[i] + planner._turn_steps(heading, plan.headings[i])
+        spans.append((node, since, leave))
+        spans.append((_edge_key(node, next_node), leave, leave + edge_steps))
+        heading, since = plan.headings[i], leave + edge_steps
+    spans.append((plan.nodes[-1], since, float("inf")))  # parked
+    return spans
+
+
+def check(agents):
+    planner = FleetPlanner(5, COSTS)
+    plans = planner.plan(agents)
+    assert plans is not None
+    spans = {}
+    for name, start, end, dir_init in agents:
+        plan = plans[name]
+        assert plan.nodes[0] == start and plan.nodes[-1] == end
+        spans[name] = occupancy(planner, plan, dir_init)
+    names = [agent[0] for agent in agents]
+    for i, first in enumerate(names):
+        for second in names[i + 1:]:
+            for place, t0, t1 in spans[first]:
+                for other, u0, u1 in spans[second]:
+                    assert not (place == other and t0 <= u1 and u0 <= t1), (first, second, place)
+    return plans
+
+
+def test_swap():
+    check([("a", (0, 0), (4, 4), (1, 0)), ("b", (4, 4), (0, 0), (-1, 0))])
+
+
+def test_follow_into_vacated_node():
+    # a parks where b starts, in both priority orders
+    check([("a", (0, 0), (2, 0), (1, 0)), ("b", (2, 0), (3, 3), (1, 0))])
+    check([("b", (2, 0), (3, 3), (1, 0)), ("a", (0, 0), (2, 0), (1, 0))])
+
+
+def test_rotation_of_three():
+    check([("a", (0, 0), (2, 0), (1, 0)), ("b", (2, 0), (2, 2), (0, 1)), ("c", (2, 2), (0, 0), (-1, 0))])
@@ -0,0 +1,193 @@
+import logging
+from itertools import combinations
+
+from graphe_go_brrrrr import HEADINGS, dir_list, dir_list_absolute
+from route_service import RouteService
+
+INF = float("inf")
+EXACT_MAX_STOPS = 8  # Held-Karp is O(2^n n^2) over (stop, heading) states, fine up to here on the Pi
+
+
+def _edges_to(parent, state):
+    """Edges from the root of a dijkstra_with_turns tree to state."""
+    path_edges = []
+    while parent[state] is not None:
+        previous = parent[state]
+        path_edges.append((previous[0], state[0]))
+        state = previous
+    path_edges.reverse()
+    return path_edges
+
+
+class Tour:
+    """Visiting order of a batch of stops and the itinerary driving through them."""
+    def __init__(self, order, edges, stop_indices, cost, dir_init):
+        self.order = order                  # the stops in the order they are visited
+        self.edges = edges                  # whole itinerary, in the format of bfs_with_edges_from_matrix
+        self.stop_indices = stop_indices    # number of edges driven when reaching each stop of order
+        self.cost = cost                    # expected time with the turn costs of the planner
+        self.dir_init = dir_init
+
+    @property
+    def end(self):
+        return self.order[-1] if self.order else None
+
+    def dir_list(self):
+        """Relative directions of the itinerary, as executed by go_somewhere."""
+        return dir_list(dir_list_absolute(self.edges), self.dir_init) if self.edges else []
+
+    def __repr__(self):
+        return f"Tour(order={self.order}, edges={len(self.edges)}, cost={self.cost:.2f})"
+
+
+class TourPlanner:
+    """
+    Orders a batch of stops to minimise the expected driving time, turns included.
+    The distance matrix is taken from the single-source trees of the RouteService, one per (stop, heading):
+    the cost of a leg depends on the heading the car arrives with at the previous stop, so the matrix is between
+    (stop, arrival heading) states. Batches of up to exact_max_stops stops are solved exactly (Held-Karp), larger
+    ones with nearest neighbour followed by 2-opt, where each candidate order gets its best headings by dynamic
+    programming.
+    """
+    def __init__(self, routes, exact_max_stops=EXACT_MAX_STOPS):
+        if not isinstance(routes, RouteService):
+            raise TypeError("TourPlanner needs a RouteService")
+        self.routes = routes
+        self.exact_max_stops = exact_max_stops
+        self._legs = {}  # (from node, heading) -> {(to node, arrival heading): cost}, for the current map version
+        self._version = routes.version
+
+    def _leg_costs(self, node, heading):
+        if self._version != self.routes.version:
+            self._legs.clear()
+            self._version = self.routes.version
+        key = (node, heading)
+        if key not in self._legs:
+            best, _ = self.routes.tree(node, heading)
+            self._legs[key] = best
+        return self._legs[key]
+
+    def _arrivals(self, node, heading, stop):
+        """[(arrival heading, cost)] of the ways to reach stop from node facing heading."""
+        if stop == node:
+            return [(heading, 0.0)]
+        best = self._leg_costs(node, heading)
+        return [(h, best[(stop, h)]) for h in HEADINGS if (stop, h) in best]
+
+    def _order_cost(self, start, dir_init, order):
+        """Cheapest cost of visiting order, choosing the arrival heading at each stop; returns (cost, headings)."""
+        layer = {dir_init: (0.0, [])}
+        node = start
+        for stop in order:
+            nxt = {}
+            for heading, (cost, headings) in layer.items():
+                for arrival, leg in self._arrivals(node, heading, stop):
+                    if cost + leg < nxt.get(arrival, (INF,))[0]:
+                        nxt[arrival] = (cost + leg, headings + [arrival])
+            if not nxt:
+                return INF, None
+            layer, node = nxt, stop
+        return min(layer.values(), key=lambda entry: entry[0])
+
+    def _held_karp(self, start, dir_init, stops):
+        n = len(stops)
+        # dp[(mask, last stop, arrival heading)] = cost, the start counts as visited
+        dp = {}
+        for j, stop in enumerate(stops):
+            for arrival, leg in self._arrivals(start, dir_init, stop):
+                key = (1 << j, j, arrival)
+                if leg < dp.get(key, INF):
+                    dp[key] = leg
+        parent = {}
+        for size in range(2, n + 1):
+            for subset in combinations(range(n), size):
+                mask = sum(1 << j for j in subset)
+                for j in subset:
+                    prev_mask = mask & ~(1 << j)
+                    for i in subset:
+                        if i == j:
+                            continue
+                        for heading in HEADINGS:
+                            cost = dp.get((prev_mask, i, heading))
+                            if cost is None:
+                                continue
+                            for arrival, leg in self._arrivals(stops[i], heading, stops[j]):
+                                key = (mask, j, arrival)
+                                if cost + leg < dp.get(key, INF):
+                                    dp[key] = cost + leg
+                                    parent[key] = (prev_mask, i, heading)
+        full = (1 << n) - 1
+        finals = [key for key in dp if key[0] == full]
+        if not finals:
+            return None
+        key = min(finals, key=dp.get)
+        order = []
+        while key is not None:
+            order.append(key[1])
+            key = parent.get(key)
+        order.reverse()
+        return [stops[j] for j in order]
+
+    def _nearest_neighbour(self, start, dir_init, stops):
+        order, remaining = [], list(stops)
+        node, heading = start, dir_init
+        while remaining:
+            candidates = [(leg, arrival, stop) for stop in remaining
+                          for arrival, leg in self._arrivals(node, heading, stop)]
+            if not candidates:
+                return None
+            _, heading, node = min(candidates, key=lambda candidate: candidate[0])
+            order.append(node)
+            remaining.remove(node)
+        return order
+
+    def _two_opt(self, start, dir_init, order):
+        # The legs are not symmetric (one way streets after a removal, turn costs), so every reversal is
+        # evaluated on the whole order
+        best_cost = self._order_cost(start, dir_init, order)[0]
+        improved = True
+        while improved:
+            improved = False
+            for i in range(len(order) - 1):
+                for k in range(i + 1, len(order)):
+                    candidate = order[:i] + order[i:k + 1][::-1] + order[k + 1:]
+                    cost = self._order_cost(start, dir_init, candidate)[0]
+                    if cost < best_cost - 1e-9:
+                        order, best_cost = candidate, cost
+                        improved = True
+        return order
+
+    def plan(self, start, stops, dir_init):
+        """
+        Tour from start, facing dir_init, through every stop (in any order, the tour ends at the last one).
+        Returns a Tour, or None if some stop cannot be reached.
+        """
+        start, dir_init = tuple(start), tuple(dir_init)
+        stops = list(dict.fromkeys(tuple(stop) for stop in stops))  # visiting a stop twice is useless
+        if start in stops:
+            stops.remove(start)
+        if dir_init not in HEADINGS:
+            raise ValueError(f"Invalid initial direction: {dir_init}")
+
+        if len(stops) <= self.exact_max_stops:
+            order = self._held_karp(start, dir_init, stops) if stops else []
+        else:
+            order = self._nearest_neighbour(start, dir_init, stops)
+            if order is not None:
+                order = self._two_opt(start, dir_init, order)
+        if order is None:
+            logging.warning(f"Some stops of {stops} cannot be reached from {start}")
+            return None
+
+        cost, headings = self._order_cost(start, dir_init, order)
+        edges, stop_indices = [], []
+        node, heading = start, dir_init
+        for stop, arrival in zip(order, headings):
+            if stop != node:
+                _, parent = self.routes.tree(node, heading)
+                edges += _edges_to(parent, (stop, arrival))
+            stop_indices.append(len(edges))
+            node, heading = stop, arrival
+        tour = Tour(order, edges, stop_indices, cost, dir_init)
+        logging.info(f"Planned {tour}")
+        return tour
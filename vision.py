@@ -0,0 +1,92 @@
+import cv2
+import numpy as np
+import logging
+
+
+class FrameFeatures:
+    """Intermediate images shared by the line follower and the intersection detector."""
+    def __init__(self, gray, thresh, edges, line_mask):
+        self.gray = gray            # grayscale frame (None with a color table)
+        self.thresh = thresh        # binary image used for intersection detection
+        self.edges = edges          # Canny edges of thresh, fed to HoughLinesP
+        self.line_mask = line_mask  # white mask used by the line follower (before erode/dilate)
+
+
+class VisionPipeline:
+    """
+    Single pass front end: every intermediate is computed once per frame
+    and written into buffers allocated on the first frame.
+    lut: color_lut.ColorLUT calibrated for the track; if given, its mask replaces both thresholds.
+    """
+    def __init__(self, line_threshold=168, intersection_threshold=180, canny_low=30, canny_high=100, lut=None):
+        self.lut = lut
+        self.line_threshold = line_threshold
+        self.intersection_threshold = intersection_threshold
+        self.canny_low = canny_low
+        self.canny_high = canny_high
+        self._shape = None
+
+    def _allocate(self, shape):
+        h, w = shape[:2]
+        self._gray = np.empty((h, w), np.uint8)
+        self._thresh = np.empty((h, w), np.uint8)
+        self._edges = np.empty((h, w), np.uint8)
+        self._blur = np.empty((h, w, 3), np.uint8)
+        self._luma_blur = np.empty((h, w), np.uint8)
+        self._channel_min = np.empty((h, w), np.uint8)
+        self._line_mask = np.empty((h, w), np.uint8)
+        self._shape = shape
+        logging.debug(f"Vision pipeline buffers allocated for shape {shape}")
+
+    def line_mask(self, frame):
+        """
+        White mask of the line follower.
+        Thresholding each channel at line_threshold then keeping the HSV pixels with V >= 168 and S <= 111
+        only keeps pixels whose three channels pass the threshold, so we threshold the channel minimum directly.
+        """
+        cv2.blur(frame, (5, 5), dst=self._blur)
+        np.min(self._blur, axis=2, out=self._channel_min)
+        cv2.threshold(self._channel_min, self.line_threshold, 255, cv2.THRESH_BINARY, dst=self._line_mask)
+        return self._line_mask
+
+    def process_luma(self, y, line=True, intersections=True):
+        """
+        Compute the shared intermediates from the luma plane of a YUV frame alone (camera_stream.YUVFrame.y):
+        the grayscale is the plane itself and the line mask only keeps the bright pixels, colour is not looked at.
+        line, intersections: skip the intermediates of the detector not run (vision_workers).
+        """
+        if y.shape != self._shape:
+            self._allocate(y.shape)
+
+        if intersections:
+            cv2.threshold(y, self.intersection_threshold, 255, cv2.THRESH_BINARY, dst=self._thresh)
+            cv2.Canny(self._thresh, self.canny_low, self.canny_high, edges=self._edges, apertureSize=3)
+        if line:
+            cv2.blur(y, (5, 5), dst=self._luma_blur)
+            cv2.threshold(self._luma_blur, self.line_threshold, 255, cv2.THRESH_BINARY, dst=self._line_mask)
+
+        return FrameFeatures(y, self._thresh, self._edges, self._line_mask)
+
+    def process(self, frame, line=True, intersections=True):
+        """
+        Compute the shared intermediates of a BGR frame.
+        line, intersections: skip the intermediates of the detector not run (vision_workers).
+        """
+        if frame.shape != self._shape:
+            self._allocate(frame.shape)
+
+        if self.lut is not None:
+            # One table lookup per pixel gives the mask of the line follower and of the intersections
+            mask = self.lut.classify(frame)
+            if intersections:
+                cv2.Canny(mask, self.canny_low, self.canny_high, edges=self._edges, apertureSize=3)
+            return FrameFeatures(None, mask, self._edges, mask)
+
+        if intersections:
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self._gray)
+            cv2.threshold(self._gray, self.intersection_threshold, 255, cv2.THRESH_BINARY, dst=self._thresh)
+            cv2.Canny(self._thresh, self.canny_low, self.canny_high, edges=self._edges, apertureSize=3)
+        if line:
+            self.line_mask(frame)
+
+        return FrameFeatures(self._gray, self._thresh, self._edges, self._line_mask)
@@ -0,0 +1,194 @@
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from color_lut import ColorLUT
+from croisement import detect_intersections, IntersectionTracker
+from line_detection import LineFollower
+from vision import VisionPipeline
+
+
+class VisionResult:
+    """Results of the workers for one frame."""
+    def __init__(self, seq, line, intersections, passed, distance, confidence):
+        self.seq = seq
+        self.line = line                    # LineFollower.measurement()
+        self.intersections = intersections  # points, as returned by detect_intersections
+        self.passed = passed                # IntersectionTracker.passed
+        self.distance = distance            # IntersectionTracker.distance, None without tracking
+        self.confidence = confidence        # IntersectionTracker.confidence
+
+
+def _worker(task, shm_name, shape, conn, line_mode, tracking, lut_path):
+    """
+    Worker process: waits for (seq, slot, timestamp, reset) on conn, processes that slot of the shared frames
+    and sends back a small result tuple; None stops it. When it fell behind, only the newest frame waiting is
+    processed, the older ones get no result.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    frames = np.ndarray(shape, np.uint8, buffer=shm.buf)
+    vision = VisionPipeline(lut=ColorLUT.load(lut_path) if lut_path else None)
+    follower = LineFollower(mode=line_mode)
+    tracker = IntersectionTracker() if tracking else None
+    # The other worker reads the same slot: the detectors draw on a private copy
+    canvas = np.empty(shape[1:], np.uint8)
+    previous_time = None
+    try:
+        while True:
+            message = conn.recv()
+            if message is None:
+                return
+            seq, slot, timestamp, reset = message
+            while conn.poll():
+                newer = conn.recv()
+                if newer is None:
+                    return
+                # A newer frame is waiting: this one is skipped, its reset still applies to the track
+                seq, slot, timestamp, reset = newer[0], newer[1], newer[2], reset or newer[3]
+            np.copyto(canvas, frames[slot])
+            # Each worker only computes the intermediates of its own detector
+            parts = {"line": task == "line", "intersections": task != "line"}
+            if canvas.ndim == 2 and vision.lut is None:
+                features = vision.process_luma(canvas, **parts)
+            else:
+                features = vision.process(canvas, **parts)
+            if task == "line":
+                follower.process_frame(canvas, mask=features.line_mask)
+                conn.send((seq, follower.measurement()))
+            elif tracker is None:
+                conn.send((seq, detect_intersections(canvas, edges=features.edges), False, None, 0.0))
+            else:
+                if reset:
+                    tracker.reset()
+                    points = []
+                else:
+                    dt = timestamp - previous_time if previous_time is not None else 1 / 32
+                    points = tracker.update(canvas, features.edges, dt)
+                previous_time = timestamp
+                conn.send((seq, points, tracker.passed, tracker.distance, tracker.confidence))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        del frames
+        shm.close()
+
+
+class VisionWorkers:
+    """
+    Runs the line estimation and the intersection detection of each frame in two worker processes, so they use
+    other cores than the control loop and run in parallel with each other.
+    submit() copies the frame into a slot of a shared memory ring and hands its number to both workers through
+    pipes; collect() waits for their results of that frame, the results are matched by frame sequence number.
+    A slot is only written again once both workers answered its frame or a newer one, so a worker late on a frame
+    given up on by collect() never reads a slot being overwritten.
+    frame_shape: (h, w, 3) for BGR frames, (h, w) for the luma plane of a YUV capture.
+    reset: the intersection worker forgets its track (turning on the intersection), as IntersectionTracker.reset().
+    The workers are started once with the grabber and kept from one trip to the next (main.vision_workers()).
+    """
+    TASKS = ("line", "intersections")
+
+    def __init__(self, frame_shape, line_mode="contour", tracking=True, lut_path=None, slots=3):
+        self.frame_shape = tuple(frame_shape)
+        self.slots = slots
+        self.line_mode = line_mode
+        self.tracking = tracking
+        self.lut_path = lut_path
+        self.submitted = 0
+        self.dropped = 0    # frames submit() had no free slot for
+        self._shm = None
+        self._frames = None
+        self._processes = []
+        self._conns = []
+        self._slot_seqs = [None] * slots    # frame in each slot
+        self._answered = []                 # newest frame answered by each worker
+
+    def start(self):
+        shape = (self.slots,) + self.frame_shape
+        self._shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+        self._frames = np.ndarray(shape, np.uint8, buffer=self._shm.buf)
+        # Not fork: the grabber, control and ZMQ threads of the parent may hold locks at the time of the fork.
+        # The workers are forked from a server process without threads; they import the main script again, so
+        # they are started once and kept between the trips
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload([__name__])
+        for task in self.TASKS:
+            conn, child_conn = context.Pipe()
+            process = context.Process(target=_worker, name=f"vision-{task}", daemon=True,
+                                      args=(task, self._shm.name, shape, child_conn, self.line_mode,
+                                            self.tracking, self.lut_path))
+            process.start()
+            child_conn.close()
+            self._processes.append(process)
+            self._conns.append(conn)
+            self._answered.append(-1)
+        logging.info(f"Vision workers started: {', '.join(str(p.pid) for p in self._processes)}")
+        return self
+
+    def stop(self):
+        for conn in self._conns:
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self._processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+        for conn in self._conns:
+            conn.close()
+        self._processes, self._conns, self._answered = [], [], []
+        self._slot_seqs = [None] * self.slots
+        if self._shm is not None:
+            self._frames = None
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+        logging.info(f"Vision workers stopped after {self.submitted} frames, {self.dropped} dropped")
+
+    def _free_slot(self):
+        done = min(self._answered)
+        for slot, seq in enumerate(self._slot_seqs):
+            if seq is None or seq <= done:
+                return slot
+        return None
+
+    def submit(self, seq, timestamp, frame, reset=False):
+        """Hand frame seq to the workers, False if every slot is still read by a late worker (frame dropped)."""
+        slot = self._free_slot()
+        if slot is None:
+            # The results of the frames given up on by collect() free their slots, they are not needed anymore
+            for index, conn in enumerate(self._conns):
+                while conn.poll():
+                    self._answered[index] = conn.recv()[0]
+            slot = self._free_slot()
+            if slot is None:
+                self.dropped += 1
+                return False
+        np.copyto(self._frames[slot], frame)
+        self._slot_seqs[slot] = seq
+        for conn in self._conns:
+            conn.send((seq, slot, timestamp, reset))
+        self.submitted += 1
+        return True
+
+    def collect(self, seq, timeout=1.0):
+        """Results of frame seq, None if a worker did not answer within timeout seconds."""
+        results = []
+        for index, (conn, process) in enumerate(zip(self._conns, self._processes)):
+            while True:
+                if not conn.poll(timeout):
+                    if not process.is_alive():
+                        raise RuntimeError(f"Vision worker {process.name} died (exit code {process.exitcode})")
+                    return None
+                result = conn.recv()
+                self._answered[index] = result[0]
+                if result[0] == seq:
+                    results.append(result)
+                    break
+                if result[0] > seq:
+                    return None  # answered a newer frame already
+                # Result of an older frame given up on by a previous collect(), dropped
+        (_, line), (_, points, passed, distance, confidence) = results
+        return VisionResult(seq, line, points, passed, distance, confidence)